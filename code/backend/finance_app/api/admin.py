@@ -6,3 +6,5 @@ admin.site.register(User)
 admin.site.register(Expense)
 admin.site.register(Receipt)
 admin.site.register(Budget)
+admin.site.register(ReceiptJob)
+admin.site.register(MonthlySpending)
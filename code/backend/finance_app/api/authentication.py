@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.utils.crypto import constant_time_compare, salted_hmac
+from rest_framework.authentication import BasicAuthentication
+import hashlib
+
+BASIC_AUTH_CACHE = 'basic-auth'
+
+'''Basic authentication that remembers verified credentials for a short time so repeat requests skip password hashing.
+Kept for app versions that still send the Basic header from login, newer clients should use the JWT pair instead'''
+class CachedBasicAuthentication(BasicAuthentication):
+    key_salt = "api.authentication.CachedBasicAuthentication"
+
+    @property
+    def cache(self):
+        return caches[BASIC_AUTH_CACHE]
+
+    def credential_key(self, userid, password): #Salted digest, the credentials themselves never reach the cache
+        return "basic:" + salted_hmac(self.key_salt, f"{userid}\0{password}", algorithm="sha256").hexdigest()
+
+    def password_check(self, user): #Changes when the password does, so a new password drops cached credentials straight away
+        return hashlib.sha256(user.password.encode()).hexdigest()
+
+    def authenticate_credentials(self, userid, password, request=None):
+        key = self.credential_key(userid, password)
+        cached = self.cache.get(key)
+        if cached is not None:
+            user_id, password_check = cached
+            user = get_user_model()._default_manager.filter(pk=user_id).first()
+            if user is not None and user.is_active and constant_time_compare(self.password_check(user), password_check):
+                return (user, None)
+            self.cache.delete(key)
+
+        user, auth = super().authenticate_credentials(userid, password, request) #Full password check, raises on bad credentials
+        self.cache.set(key, (user.pk, self.password_check(user)), timeout=settings.BASIC_AUTH_CACHE_TTL)
+        return (user, auth)
@@ -0,0 +1,270 @@
+from azure.ai.documentintelligence import DocumentIntelligenceClient
+from azure.ai.documentintelligence.models import AnalyzeResult, AnalyzeDocumentRequest
+from azure.ai.documentintelligence.aio import DocumentIntelligenceClient as AsyncDocumentIntelligenceClient
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import RequestsTransport
+from azure.storage.blob import (
+    BlobServiceClient,
+    generate_blob_sas,
+    BlobSasPermissions,
+    ContentSettings,
+)
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.utils.module_loading import import_string
+from datetime import datetime, timedelta
+from pathlib import Path
+from urllib.parse import unquote
+from requests.adapters import HTTPAdapter
+import asyncio
+import contextvars
+import itertools
+import json
+import os
+import requests
+import threading
+import time
+import weakref
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+'''Return the backend configured under a BACKEND/OPTIONS setting, each backend is created once per process'''
+def load_backend(setting_name, default_backend):
+    config = getattr(settings, setting_name, {})
+    path = config.get('BACKEND', default_backend)
+    options = config.get('OPTIONS', {})
+    key = (setting_name, path, json.dumps(options, sort_keys=True, default=str))
+    with _backends_lock:
+        if key not in _backends:
+            _backends[key] = import_string(path)(**options)
+        return _backends[key]
+
+'''Receipt storage backend from settings.RECEIPT_STORAGE'''
+def get_receipt_storage():
+    return load_backend('RECEIPT_STORAGE', 'api.backends.AzureBlobReceiptStorage')
+
+'''Receipt analyzer backend from settings.RECEIPT_ANALYZER'''
+def get_receipt_analyzer():
+    return load_backend('RECEIPT_ANALYZER', 'api.backends.AzureReceiptAnalyzer')
+
+'''requests session keeping up to pool_size connections open per host'''
+def pooled_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+'''Shared HTTP transport so every Azure call reuses pooled TLS connections'''
+def pooled_transport(pool_size):
+    return RequestsTransport(session=pooled_session(pool_size), session_owner=False)
+
+'''Shared aiohttp transport for the async Azure clients of one event loop, so hundreds of calls in flight reuse a bounded set of connections.
+aiohttp is only needed when receipts are processed under ASGI'''
+def pooled_aio_transport(pool_size):
+    import aiohttp
+    from azure.core.pipeline.transport import AioHttpTransport
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=pool_size))
+    return AioHttpTransport(session=session, session_owner=True) #Closing the client closes its session
+
+'''Set when the caller's event loop lives as long as the process, as under an ASGI server. Only then are the per loop aiohttp clients used,
+a loop made for one call (async_to_sync under WSGI) would drop its clients unclosed, so the async methods use the pooled sync clients instead'''
+native_aio = contextvars.ContextVar("native_aio", default=False)
+
+_loop_clients = weakref.WeakSet()
+
+'''Async clients of a backend, one per event loop as aiohttp sessions can not be shared between loops'''
+class LoopClients:
+    def __init__(self, factory):
+        self.factory = factory
+        self.clients = weakref.WeakKeyDictionary()
+        _loop_clients.add(self)
+
+    def get(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self.clients:
+            self.clients[loop] = self.factory()
+        return self.clients[loop]
+
+    async def aclose(self): #Close the client of the running loop, the next get makes a new one
+        client = self.clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.close()
+
+'''Close the async clients every backend opened on the running loop, call it before the loop stops'''
+async def close_loop_clients():
+    await asyncio.gather(*(clients.aclose() for clients in list(_loop_clients)))
+
+'''Wrap an ASGI application so the server's lifespan shutdown closes the clients opened on its loop, Django itself only answers HTTP.
+Under a server without lifespan events the clients are closed with the process'''
+def close_loop_clients_on_shutdown(application):
+    async def lifespan_application(scope, receive, send):
+        if scope["type"] != "lifespan":
+            return await application(scope, receive, send)
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await close_loop_clients()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    return lifespan_application
+
+'''Interface for where compressed receipt images are kept'''
+class ReceiptStorage:
+    def save(self, image_io, blob_name, content_type="image/jpeg"): #Store the image and return a url the analyzer and app can read
+        raise NotImplementedError
+
+    async def asave(self, image_io, blob_name, content_type="image/jpeg"): #Backends without native async IO save on a worker thread
+        return await sync_to_async(self.save, thread_sensitive=False)(image_io, blob_name, content_type)
+
+    def read(self, image_url): #Bytes of a stored image, downloaded from its url unless the backend can do better
+        from .fetching import fetch_image #fetching builds on this module
+        return fetch_image(image_url)
+
+'''Stores receipt images in Azure Blob Storage using one client for the whole process'''
+class AzureBlobReceiptStorage(ReceiptStorage):
+    def __init__(self, account_name=None, account_key=None, container_name=None, sas_expiry_days=365 * 100, pool_size=10, aio_pool_size=100):
+        self.account_name = account_name or os.getenv("AZURE_STORAGE_ACCOUNT_NAME")
+        self.account_key = account_key or os.getenv("AZURE_STORAGE_ACCOUNT_KEY")
+        self.container_name = container_name or os.getenv("AZURE_CONTAINER_NAME")
+        self.sas_expiry_days = sas_expiry_days
+
+        blob_service_client = BlobServiceClient( #Connect to Azure Blob Storage, the client is thread safe
+            f'https://{self.account_name}.blob.core.windows.net',
+            credential=self.account_key,
+            transport=pooled_transport(pool_size),
+        )
+        self.container_client = blob_service_client.get_container_client(self.container_name)
+        self.async_service_clients = LoopClients(lambda: AsyncBlobServiceClient( #Kept rather than its container client, which can not close the shared transport
+            f'https://{self.account_name}.blob.core.windows.net',
+            credential=self.account_key,
+            transport=pooled_aio_transport(aio_pool_size),
+        ))
+
+    def save(self, image_io, blob_name, content_type="image/jpeg"):
+        blob_client = self.container_client.get_blob_client(blob_name)
+        blob_client.upload_blob(image_io, overwrite=True, content_settings=ContentSettings(content_type=content_type)) #Headers are sent with the upload, no second request
+        return self.signed_url(blob_client.url, blob_name)
+
+    async def asave(self, image_io, blob_name, content_type="image/jpeg"):
+        if not native_aio.get():
+            return await super().asave(image_io, blob_name, content_type)
+        blob_client = self.async_service_clients.get().get_blob_client(self.container_name, blob_name)
+        await blob_client.upload_blob(image_io, overwrite=True, content_settings=ContentSettings(content_type=content_type))
+        return self.signed_url(blob_client.url, blob_name)
+
+    def signed_url(self, url, blob_name):
+        sas_token = generate_blob_sas( # Generate SAS URL with expiration time
+            account_name=self.account_name,
+            container_name=self.container_name,
+            blob_name=blob_name,
+            account_key=self.account_key,
+            permission=BlobSasPermissions(read=True),
+            expiry=datetime.utcnow() + timedelta(days=self.sas_expiry_days)
+        )
+        return f"{url}?{sas_token}"
+
+'''Stores receipt images on the local filesystem, used for offline runs and benchmarks'''
+class FileSystemReceiptStorage(ReceiptStorage):
+    def __init__(self, location=None, base_url=None):
+        self.storage = FileSystemStorage(
+            location=location or Path(settings.MEDIA_ROOT) / 'receipts',
+            base_url=base_url or 'http://localhost:8000/media/receipts/',
+        )
+
+    def save(self, image_io, blob_name, content_type="image/jpeg"):
+        if self.storage.exists(blob_name):
+            self.storage.delete(blob_name) #Match the overwrite behaviour of blob storage
+        name = self.storage.save(blob_name, image_io)
+        return self.storage.url(name)
+
+    def read(self, image_url):
+        if not image_url.startswith(self.storage.base_url):
+            return super().read(image_url)
+        with self.storage.open(unquote(image_url[len(self.storage.base_url):])) as image_file:
+            return image_file.read()
+
+'''Interface for the OCR service that reads receipts'''
+class ReceiptAnalyzer:
+    def analyze(self, image_url, image_hash=None): #Return the AnalyzeResult for the receipt at image_url
+        raise NotImplementedError
+
+    async def aanalyze(self, image_url, image_hash=None): #Backends without native async IO analyse on a worker thread
+        return await sync_to_async(self.analyze, thread_sensitive=False)(image_url, image_hash=image_hash)
+
+'''Runs the Document Intelligence prebuilt receipt model using one client for the whole process'''
+class AzureReceiptAnalyzer(ReceiptAnalyzer):
+    model_id = "prebuilt-receipt"
+
+    def __init__(self, endpoint=None, api_key=None, pool_size=10, aio_pool_size=100):
+        endpoint = endpoint or str(os.getenv("DOCUMENTINTELLIGENCE_ENDPOINT"))
+        credential = AzureKeyCredential(api_key or str(os.getenv("DOCUMENTINTELLIGENCE_API_KEY")))
+        self.client = DocumentIntelligenceClient( #Initialise azure document intelligence client, the client is thread safe
+            endpoint=endpoint,
+            credential=credential,
+            transport=pooled_transport(pool_size),
+        )
+        self.async_clients = LoopClients(lambda: AsyncDocumentIntelligenceClient(
+            endpoint=endpoint,
+            credential=credential,
+            transport=pooled_aio_transport(aio_pool_size),
+        ))
+
+    def analyze(self, image_url, image_hash=None):
+        poller = self.client.begin_analyze_document(
+            self.model_id, #Use the prebuilt model 'receipt' for scanning and processing
+            AnalyzeDocumentRequest(url_source=image_url)
+        )
+        return poller.result()
+
+    async def aanalyze(self, image_url, image_hash=None): #Polling waits with asyncio.sleep, so a call in flight holds no thread
+        if not native_aio.get():
+            return await super().aanalyze(image_url, image_hash=image_hash)
+        poller = await self.async_clients.get().begin_analyze_document(self.model_id, AnalyzeDocumentRequest(url_source=image_url))
+        return await poller.result()
+
+'''Replays recorded analysis results from a folder of JSON files so the pipeline runs without Azure'''
+class ReplayReceiptAnalyzer(ReceiptAnalyzer): #A file named <image hash>.json is used for that image, otherwise the files are used in turn
+    def __init__(self, fixtures_dir=None, latency=0.0):
+        self.fixtures_dir = Path(fixtures_dir or Path(__file__).resolve().parent / 'analysis_fixtures')
+        self.latency = latency #Seconds to sleep per call, to imitate the real service in benchmarks
+        self.fixtures = {path.stem: json.loads(path.read_text()) for path in sorted(self.fixtures_dir.glob('*.json'))}
+        if not self.fixtures:
+            raise ValueError(f"No analysis fixtures found in {self.fixtures_dir}")
+        self._rotation = itertools.cycle(sorted(self.fixtures))
+        self._lock = threading.Lock()
+
+    def analyze(self, image_url, image_hash=None):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.result(image_hash)
+
+    async def aanalyze(self, image_url, image_hash=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.result(image_hash)
+
+    def result(self, image_hash):
+        if image_hash in self.fixtures:
+            return AnalyzeResult(self.fixtures[image_hash])
+        with self._lock:
+            name = next(self._rotation)
+        return AnalyzeResult(self.fixtures[name])
+
+'''Wraps another analyzer and saves every result as a replay fixture'''
+class RecordingReceiptAnalyzer(ReceiptAnalyzer):
+    def __init__(self, fixtures_dir, backend='api.backends.AzureReceiptAnalyzer', options=None):
+        self.fixtures_dir = Path(fixtures_dir)
+        self.fixtures_dir.mkdir(parents=True, exist_ok=True)
+        self.analyzer = import_string(backend)(**(options or {}))
+
+    def analyze(self, image_url, image_hash=None):
+        result = self.analyzer.analyze(image_url, image_hash=image_hash)
+        if image_hash:
+            (self.fixtures_dir / f"{image_hash}.json").write_text(json.dumps(result.as_dict(), indent=2))
+        return result
@@ -0,0 +1,59 @@
+from datetime import datetime, timezone
+from pathlib import Path
+import json
+import platform
+import resource
+import statistics
+import sys
+
+'''Peak resident memory of this process in bytes'''
+def peak_rss_bytes():
+    try:
+        with open("/proc/self/status") as status_file: #Linux, follows reset_peak_rss
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024 #Linux reports kilobytes, macOS bytes
+
+'''Reset the peak memory mark so the next reading only covers what runs after it, returns False where unsupported'''
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+'''Summary statistics for a list of timings in seconds, reported in milliseconds'''
+def summarise_timings(samples):
+    ordered = sorted(samples)
+
+    def percentile(fraction):
+        index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+        return round(ordered[index] * 1000, 3)
+
+    return {
+        "runs": len(ordered),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        "p50_ms": percentile(0.50),
+        "p90_ms": percentile(0.90),
+        "p99_ms": percentile(0.99),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+'''Write benchmark results as JSON together with details of the machine they came from'''
+def write_results(path, name, results):
+    document = {
+        "benchmark": name,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    output = json.dumps(document, indent=2, default=str)
+    if path:
+        Path(path).write_text(output)
+    return output
@@ -0,0 +1,91 @@
+from django.core.cache import caches
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from django.views.decorators.vary import vary_on_headers
+import hashlib
+
+RECEIPT_ANALYSIS_CACHE = 'receipt-analysis'
+BUDGET_REPORT_CACHE = 'budget-reports'
+
+'''Cache of extracted receipt fields keyed by a hash of the normalised image bytes'''
+class ReceiptAnalysisCache: #Size and TTL eviction come from TIMEOUT and MAX_ENTRIES of the cache alias in settings.CACHES
+    version = 1 #Bump when parse_receipt_result changes shape so old entries are ignored
+    stat_names = ('hits', 'misses')
+
+    def __init__(self, alias=RECEIPT_ANALYSIS_CACHE):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get(self, image_hash): #Return cached fields for an image or None, counting the hit or miss
+        extracted_data = self.cache.get(f"analysis:{image_hash}", version=self.version)
+        self._count('hits' if extracted_data is not None else 'misses')
+        return extracted_data
+
+    def set(self, image_hash, extracted_data):
+        self.cache.set(f"analysis:{image_hash}", extracted_data, version=self.version)
+
+    def stats(self): #Hit and miss counters, every hit is one Document Intelligence call saved
+        counts = self.cache.get_many([f"stats:{name}" for name in self.stat_names])
+        hits = counts.get("stats:hits", 0)
+        misses = counts.get("stats:misses", 0)
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def _count(self, name):
+        key = f"stats:{name}"
+        self.cache.add(key, 0, timeout=None) #Counters never expire on their own
+        try:
+            self.cache.incr(key)
+        except ValueError: #Counter was evicted between add and incr
+            self.cache.set(key, 1, timeout=None)
+
+'''Cache of budget report output keyed by budget and report_version, a new version is the only invalidation needed'''
+class BudgetReportCache: #Old versions are never read again and age out through TIMEOUT and MAX_ENTRIES of the cache alias
+    version = 1 #Bump when a report changes shape so old entries are ignored
+    max_entry_bytes = 2 * 1024 * 1024 #Bigger xlsx files are streamed every time rather than filling the cache
+
+    def __init__(self, alias=BUDGET_REPORT_CACHE):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def key(self, budget, kind):
+        return f"report:{kind}:{budget.pk}:{budget.report_version}"
+
+    def get(self, budget, kind): #Return the cached report for this version of the budget or None
+        return self.cache.get(self.key(budget, kind), version=self.version)
+
+    def set(self, budget, kind, report):
+        self.cache.set(self.key(budget, kind), report, version=self.version)
+
+'''Hash of image bytes used as the analysis cache key'''
+def hash_image(image_io):
+    return hashlib.sha256(image_io.getbuffer()).hexdigest()
+
+analysis_cache = ReceiptAnalysisCache()
+budget_report_cache = BudgetReportCache()
+
+'''Weak ETag of everything the requesting user owns, it only changes when their data version does'''
+def user_data_etag(request, *args, **kwargs):
+    if not request.user.is_authenticated:
+        return None
+    return f'W/"{request.user.pk}-{request.user.data_version}"'
+
+def user_data_last_modified(request, *args, **kwargs):
+    return request.user.data_changed_at if request.user.is_authenticated else None
+
+'''Answer If-None-Match and If-Modified-Since from the user's data version before the view runs, so an unchanged list is never queried or serialised.
+The user is already loaded by authentication, so a 304 costs no extra query'''
+def conditional_on_user_data(view):
+    view = condition(etag_func=user_data_etag, last_modified_func=user_data_last_modified)(view)
+    view = vary_on_headers("Accept", "Authorization")(view)
+    return cache_control(private=True, no_cache=True)(view) #Clients may keep a copy but must check it is still current
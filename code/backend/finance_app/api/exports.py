@@ -0,0 +1,120 @@
+from django.core.serializers.json import DjangoJSONEncoder
+from .models import Expense, Receipt
+import csv
+import json
+import zipfile
+
+CHUNK_SIZE = 2000 #Rows fetched per database round trip, memory stays at one chunk however big the account is
+WRITE_BYTES = 64 * 1024 #Rows are sent in pieces of about this size rather than one tiny write per row
+
+RECEIPT_COLUMNS = ["id", "merchant", "total_amount", "transaction_date", "uploaded_at", "receipt_category", "image_url"]
+ITEM_COLUMNS = ["receipt_id", "line", "description", "quantity", "total_price"]
+EXPENSE_COLUMNS = ["id", "name", "category", "vendor", "amount", "date"]
+
+'''Receipts of a user as dicts, oldest first'''
+def receipt_rows(user):
+    return Receipt.objects.filter(user=user).order_by("uploaded_at", "id").values(*RECEIPT_COLUMNS).iterator(chunk_size=CHUNK_SIZE)
+
+'''Value of one field of a parsed line item, None when the field is missing or not the {"value": ...} shape the analyzer writes'''
+def item_field(item, name):
+    field = item.get(name)
+    return field.get("value") if isinstance(field, dict) else None
+
+'''Parsed line items of a user's receipts as dicts, one per item. parsed_items can be edited through the API, items that are not dicts are skipped
+so one bad receipt can not cut a streamed export short'''
+def item_rows(user):
+    receipts = Receipt.objects.filter(user=user).exclude(parsed_items=None).order_by("uploaded_at", "id").values_list("id", "parsed_items")
+    for receipt_id, items in receipts.iterator(chunk_size=CHUNK_SIZE):
+        if not isinstance(items, list):
+            continue
+        for line, item in enumerate(items, start=1):
+            if not isinstance(item, dict):
+                continue
+            yield {
+                "receipt_id": receipt_id,
+                "line": line,
+                "description": item_field(item, "description"),
+                "quantity": item_field(item, "quantity"),
+                "total_price": item_field(item, "total_price"),
+            }
+
+'''Expenses of a user as dicts'''
+def expense_rows(user):
+    return Expense.objects.filter(user=user).order_by("id").values(*EXPENSE_COLUMNS).iterator(chunk_size=CHUNK_SIZE)
+
+DATASETS = {
+    "receipts": (receipt_rows, RECEIPT_COLUMNS),
+    "items": (item_rows, ITEM_COLUMNS),
+    "expenses": (expense_rows, EXPENSE_COLUMNS),
+}
+
+'''File-like object for csv.writer that hands back what was written instead of storing it'''
+class Echo:
+    def write(self, value):
+        return value
+
+'''CSV text, one chunk per row'''
+def csv_chunks(rows, columns):
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow([row[column] for column in columns])
+
+'''Newline delimited JSON, one object per line'''
+def ndjson_chunks(rows, columns):
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder) + "\n"
+
+FORMATS = {
+    "csv": (csv_chunks, "text/csv"),
+    "ndjson": (ndjson_chunks, "application/x-ndjson"),
+}
+
+'''Encoded chunks of one dataset for a user in csv or ndjson'''
+def export_chunks(user, dataset, file_type):
+    rows, columns = DATASETS[dataset]
+    chunks, _ = FORMATS[file_type]
+    pending, size = [], 0
+    for chunk in chunks(rows(user), columns):
+        pending.append(chunk)
+        size += len(chunk)
+        if size >= WRITE_BYTES:
+            yield "".join(pending).encode()
+            pending, size = [], 0
+    if pending:
+        yield "".join(pending).encode()
+
+'''Write-only file for zipfile that keeps only the bytes not yet sent'''
+class ZipStreamBuffer:
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+'''Zip archive of every dataset for a user, produced as it is read, entries use data descriptors since the stream can not seek back'''
+def zip_export_chunks(user, file_type):
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for dataset in DATASETS:
+            with archive.open(f"{dataset}.{file_type}", "w", force_zip64=True) as entry:
+                for chunk in export_chunks(user, dataset, file_type):
+                    entry.write(chunk)
+                    data = buffer.take()
+                    if data:
+                        yield data
+    yield buffer.take() #Central directory
@@ -0,0 +1,97 @@
+from django.conf import settings
+from asgiref.sync import sync_to_async
+from .backends import LoopClients, native_aio, pooled_session
+import asyncio
+import requests
+import threading
+import time
+
+CHUNK_BYTES = 64 * 1024 #Read size while streaming, the cap is checked after every chunk
+ACCEPTED_CONTENT_TYPES = ("image/", "application/octet-stream", "binary/octet-stream") #Some object stores serve photos without an image type
+
+'''Raised when a receipt image can not be downloaded from the given url'''
+class ImageDownloadError(Exception):
+    pass
+
+_session = None
+_session_lock = threading.Lock()
+
+'''Shared HTTP session for image downloads, connections to the same hosts are kept open between receipts'''
+def fetch_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = pooled_session(settings.RECEIPT_IMAGE_FETCH_POOL_SIZE)
+        return _session
+
+'''Refuse a response before its body is read if the headers already show it is not a usable image'''
+def check_headers(headers, max_bytes):
+    content_type = headers.get("Content-Type", "").split(";")[0].strip().lower()
+    if content_type and not content_type.startswith(ACCEPTED_CONTENT_TYPES):
+        raise ImageDownloadError(f"URL did not return an image ({content_type}).")
+    content_length = headers.get("Content-Length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        raise ImageDownloadError(f"Image is larger than {max_bytes} bytes.")
+
+'''Collect streamed chunks until the body ends, grows past max_bytes or passes the deadline from time.monotonic().
+The server may not send Content-Length or may send the wrong one, and a slow one could trickle bytes in under the per-read timeout forever'''
+def read_capped(chunks, max_bytes, deadline):
+    received, size = [], 0
+    for chunk in chunks:
+        size += len(chunk)
+        if size > max_bytes:
+            raise ImageDownloadError(f"Image is larger than {max_bytes} bytes.")
+        if time.monotonic() > deadline:
+            raise ImageDownloadError("Image download took too long.")
+        received.append(chunk)
+    return b"".join(received) #The one copy, these bytes go to the compression stage as they are
+
+'''Download a receipt image from a url and return its bytes, at most max_bytes are ever held'''
+def fetch_image(image_url, max_bytes=None):
+    max_bytes = max_bytes or settings.RECEIPT_IMAGE_FETCH_MAX_BYTES
+    deadline = time.monotonic() + settings.RECEIPT_IMAGE_FETCH_TIMEOUT #requests only limits the connect and each read, this limits the whole download
+    try:
+        with fetch_session().get(image_url, stream=True, timeout=settings.RECEIPT_IMAGE_FETCH_TIMEOUT) as response: #Closing returns the connection to the pool
+            if response.status_code != 200:
+                raise ImageDownloadError("Failed to download image from URL.")
+            check_headers(response.headers, max_bytes)
+            return read_capped(response.iter_content(CHUNK_BYTES), max_bytes, deadline)
+    except requests.exceptions.RequestException as e:
+        raise ImageDownloadError(f"Error fetching image from URL: {str(e)}")
+
+'''Shared HTTP session for image downloads on one event loop, aiohttp is only needed when serving under ASGI'''
+def async_fetch_session():
+    import aiohttp
+    return aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=settings.RECEIPT_IMAGE_FETCH_TIMEOUT),
+        connector=aiohttp.TCPConnector(limit=settings.RECEIPT_IMAGE_FETCH_POOL_SIZE),
+    )
+
+async_fetch_sessions = LoopClients(async_fetch_session)
+
+'''Errors aiohttp raises for a failed download, imported only once a native download has failed'''
+def aiohttp_errors():
+    import aiohttp
+    return (aiohttp.ClientError, asyncio.TimeoutError)
+
+'''Async fetch_image, the body is streamed without blocking the event loop. Outside a long lived loop (see native_aio) the pooled sync session is used on a worker thread'''
+async def afetch_image(image_url, max_bytes=None):
+    if not native_aio.get():
+        return await sync_to_async(fetch_image, thread_sensitive=False)(image_url, max_bytes)
+    max_bytes = max_bytes or settings.RECEIPT_IMAGE_FETCH_MAX_BYTES
+    try:
+        async with async_fetch_sessions.get().get(image_url) as response:
+            if response.status != 200:
+                raise ImageDownloadError("Failed to download image from URL.")
+            check_headers(response.headers, max_bytes)
+            received, size = [], 0
+            async for chunk in response.content.iter_chunked(CHUNK_BYTES):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ImageDownloadError(f"Image is larger than {max_bytes} bytes.")
+                received.append(chunk)
+            return b"".join(received)
+    except ImageDownloadError:
+        raise
+    except aiohttp_errors() as e:
+        raise ImageDownloadError(f"Error fetching image from URL: {str(e)}")
@@ -0,0 +1,127 @@
+from asgiref.sync import sync_to_async
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from PIL import Image, ImageOps
+import asyncio
+import multiprocessing
+import threading
+
+MAX_DIMENSION = 2000 #Longest edge kept for OCR, receipt text stays well above the minimum height Document Intelligence needs. 4032px and 8064px phone photos draft-decode to just above this
+TARGET_BYTES = 400 * 1024
+QUALITY_STEPS = (85, 75, 65, 55)
+MIN_DIMENSION = 1024 #Never shrink below this to hit the byte target, small text would stop being readable
+THUMBNAIL_SIZES = (128, 512) #Longest edge of each preview, list rows and the receipt screen
+THUMBNAIL_QUALITY = 70
+
+'''Decode an image at the smallest size that still covers max_dimension'''
+def open_for_compression(image_data, max_dimension=MAX_DIMENSION):
+    img = Image.open(BytesIO(image_data))
+    scale = min(1.0, max_dimension / max(img.size))
+    img.draft("RGB", (round(img.width * scale), round(img.height * scale))) #JPEGs are decoded at 1/2, 1/4 or 1/8 scale straight from the file when that still covers the target, other formats ignore this
+    ImageOps.exif_transpose(img, in_place=True) #Phones store rotation in EXIF, OCR needs the pixels upright
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB") #JPEG only supports RGB or greyscale
+    img.thumbnail((max_dimension, max_dimension), Image.Resampling.BICUBIC, reducing_gap=3.0) #Downscale in place, keeps the aspect ratio
+    return img
+
+'''Encode an image as a JPEG'''
+def encode_jpeg(img, quality):
+    img_io = BytesIO()
+    img.save(img_io, format="JPEG", quality=quality, optimize=True)
+    return img_io
+
+'''Compress raw image bytes to a JPEG close to target_bytes, returns the JPEG bytes'''
+def compress_image_data(image_data, max_dimension=MAX_DIMENSION, target_bytes=TARGET_BYTES):
+    return compress_decoded(open_for_compression(image_data, max_dimension), target_bytes)
+
+'''Encode a decoded image as a JPEG close to target_bytes'''
+def compress_decoded(img, target_bytes=TARGET_BYTES):
+    img_io = None
+    while True:
+        candidates = [img] if img.mode == "L" else [img, img.convert("L")] #Receipts are mostly black on white, greyscale is a lot smaller
+        for candidate in candidates:
+            for quality in QUALITY_STEPS: #Try the best quality first and stop as soon as it fits
+                img_io = encode_jpeg(candidate, quality)
+                if img_io.tell() <= target_bytes:
+                    return img_io.getvalue()
+
+        if max(img.size) <= MIN_DIMENSION: #Still too big, keep the smallest attempt rather than losing legibility
+            return img_io.getvalue()
+        scale = max(MIN_DIMENSION / max(img.size), 0.75)
+        img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.Resampling.BICUBIC)
+
+'''JPEG previews of a decoded image keyed by longest edge, each one is shrunk from the last so the full image is only resampled once'''
+def encode_thumbnails(img, sizes=THUMBNAIL_SIZES):
+    thumbnail = img.copy()
+    thumbnails = {}
+    for size in sorted(sizes, reverse=True):
+        thumbnail.thumbnail((size, size), Image.Resampling.BICUBIC, reducing_gap=3.0) #Never enlarges, small photos keep their size
+        thumbnails[size] = encode_jpeg(thumbnail, THUMBNAIL_QUALITY).getvalue()
+    return thumbnails
+
+'''compress_image_data that also returns thumbnails made from the same decode'''
+def compress_with_thumbnails(image_data, max_dimension=MAX_DIMENSION, target_bytes=TARGET_BYTES, thumbnail_sizes=THUMBNAIL_SIZES):
+    img = open_for_compression(image_data, max_dimension)
+    return compress_decoded(img, target_bytes), encode_thumbnails(img, thumbnail_sizes)
+
+'''Thumbnails of image bytes, decoded only as large as the biggest one needs'''
+def thumbnail_image_data(image_data, sizes=THUMBNAIL_SIZES):
+    return encode_thumbnails(open_for_compression(image_data, max(sizes)), sizes)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+'''Process pool for compression, Pillow holds the GIL for most of the work so threads would block requests'''
+def get_executor(max_workers):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) #Spawn, forking a threaded server is unsafe
+        return _executor
+
+'''Forget a pool that lost a worker, the next get_executor starts a fresh one. A worker killed mid image (the OOM killer on a huge PNG) breaks the whole pool'''
+def discard_executor(executor):
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False)
+
+'''Run an imaging function, on the process pool when processes is above zero. Tried once more on a fresh pool if the pool was broken'''
+def run(function, *args, processes=0):
+    if processes <= 0:
+        return function(*args)
+    for retries_left in (1, 0):
+        executor = get_executor(processes)
+        try:
+            return executor.submit(function, *args).result()
+        except BrokenProcessPool:
+            discard_executor(executor) #Also after the retry, the image itself may be what kills the worker and later calls still need a pool
+            if not retries_left:
+                raise
+
+'''Run an imaging function without blocking the event loop, on the process pool when processes is above zero and a worker thread otherwise'''
+async def arun(function, *args, processes=0):
+    if processes <= 0:
+        return await sync_to_async(function, thread_sensitive=False)(*args)
+    for retries_left in (1, 0):
+        executor = get_executor(processes)
+        try:
+            return await asyncio.wrap_future(executor.submit(function, *args))
+        except BrokenProcessPool:
+            discard_executor(executor)
+            if not retries_left:
+                raise
+
+'''Compress image bytes and make its thumbnails, returns the JPEG bytes and a dict of thumbnail bytes by size'''
+def compress_renditions(image_data, max_dimension=MAX_DIMENSION, target_bytes=TARGET_BYTES, thumbnail_sizes=THUMBNAIL_SIZES, processes=0):
+    return run(compress_with_thumbnails, image_data, max_dimension, target_bytes, thumbnail_sizes, processes=processes)
+
+'''Async compress_renditions'''
+async def acompress_renditions(image_data, max_dimension=MAX_DIMENSION, target_bytes=TARGET_BYTES, thumbnail_sizes=THUMBNAIL_SIZES, processes=0):
+    return await arun(compress_with_thumbnails, image_data, max_dimension, target_bytes, thumbnail_sizes, processes=processes)
+
+'''Thumbnails of image bytes by size, on the process pool when processes is above zero'''
+def thumbnails(image_data, sizes=THUMBNAIL_SIZES, processes=0):
+    return run(thumbnail_image_data, image_data, sizes, processes=processes)
@@ -0,0 +1,131 @@
+from django.db import transaction
+from rest_framework.parsers import BaseParser
+from .models import Expense, MonthlySpending, RollupChanges, User
+from .serializers import ExpenseSerializer
+import codecs
+import csv
+import json
+
+BATCH_SIZE = 1000 #Rows validated and inserted together, memory stays at one batch however big the file is
+READ_BYTES = 64 * 1024
+MAX_ROW_CHARS = 64 * 1024 #A JSON row that is still not complete after this much text is rejected instead of read to the end of the file
+MAX_REPORTED_ERRORS = 100 #Errors past this are counted but not listed, a file of nothing but bad rows must not fill the response
+WHITESPACE = " \t\r\n"
+
+'''Raised when an import file can not be read at all, as opposed to rows that fail validation'''
+class ImportFormatError(Exception):
+    pass
+
+'''Expense rows of a CSV file as dicts, blank cells are left out so the serializer defaults apply'''
+def csv_rows(stream):
+    reader = csv.DictReader(codecs.getreader("utf-8-sig")(stream)) #Decoded as it is read, a BOM from spreadsheet exports is dropped
+    try:
+        for row in reader:
+            yield {column: value for column, value in row.items() if column is not None and value not in ("", None)}
+    except (csv.Error, UnicodeDecodeError) as e:
+        raise ImportFormatError(f"Invalid CSV: {e}")
+
+'''Items of a JSON array, decoded one at a time so the whole array is never held in memory'''
+def json_rows(stream):
+    reader = codecs.getreader("utf-8-sig")(stream)
+    decoder = json.JSONDecoder()
+    buffer, eof = "", False
+
+    def read_more():
+        nonlocal buffer, eof
+        try:
+            chunk = reader.read(READ_BYTES)
+        except UnicodeDecodeError as e:
+            raise ImportFormatError(f"Invalid JSON: {e}")
+        eof = not chunk
+        buffer += chunk
+        return not eof
+
+    def next_char(): #First character after any whitespace, empty at the end of the file
+        nonlocal buffer
+        while True:
+            buffer = buffer.lstrip(WHITESPACE)
+            if buffer or not read_more():
+                return buffer[:1]
+
+    if next_char() != "[":
+        raise ImportFormatError("Invalid JSON: expected a list of expenses.")
+    buffer = buffer[1:]
+    first = True
+    while True:
+        char = next_char()
+        if char == "]":
+            return
+        if not first:
+            if char != ",":
+                raise ImportFormatError("Invalid JSON: expected ',' or ']' between expenses.")
+            buffer = buffer[1:]
+            char = next_char()
+        if not char:
+            raise ImportFormatError("Invalid JSON: the list is not closed.")
+
+        while True:
+            try:
+                row, end = decoder.raw_decode(buffer)
+                if end < len(buffer) or eof or not read_more(): #A number at the very end of the buffer may continue in the next read
+                    break
+            except json.JSONDecodeError as e:
+                if len(buffer) > MAX_ROW_CHARS or not read_more():
+                    raise ImportFormatError(f"Invalid JSON: {e.msg}")
+        buffer = buffer[end:]
+        first = False
+        yield row
+
+FORMATS = {
+    "csv": csv_rows,
+    "json": json_rows,
+}
+CONTENT_TYPES = {
+    "text/csv": "csv",
+    "application/json": "json",
+}
+
+'''Rows in batches of BATCH_SIZE, each with its 1-based row number'''
+def batches(rows):
+    batch = []
+    for number, row in enumerate(rows, start=1):
+        batch.append((number, row))
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+'''Validate and insert expense rows for a user a batch at a time, rows that fail validation are reported and the rest are kept.
+An unreadable file raises ImportFormatError and nothing from it is kept'''
+def import_expenses(user, rows):
+    created, failed, errors = 0, 0, []
+    with transaction.atomic():
+        for batch in batches(rows):
+            serializer = ExpenseSerializer(data=[row for _, row in batch], many=True)
+            if not serializer.is_valid(): #Set the bad rows aside and validate the rest again, validated_data is empty while any row fails
+                valid = []
+                for (number, row), row_errors in zip(batch, serializer.errors):
+                    if row_errors:
+                        failed += 1
+                        if len(errors) < MAX_REPORTED_ERRORS:
+                            errors.append({"row": number, "errors": row_errors})
+                    else:
+                        valid.append(row)
+                serializer = ExpenseSerializer(data=valid, many=True)
+                serializer.is_valid(raise_exception=True)
+
+            expenses = Expense.objects.bulk_create([Expense(user=user, **data) for data in serializer.validated_data])
+            MonthlySpending.objects.apply(user.pk, RollupChanges.for_expenses(expenses)) #bulk_create sends no signals
+            created += len(serializer.validated_data)
+        if created:
+            User.objects.record_change(user.pk)
+
+    return {"created": created, "failed": failed, "errors": errors}
+
+'''Hands the view the request body as a stream instead of reading all of it in'''
+class StreamParser(BaseParser):
+    media_type = '*/*'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        return stream
@@ -0,0 +1,139 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils.timezone import now
+from .models import ReceiptJob
+from .backends import load_backend
+from .fetching import ImageDownloadError
+import logging
+import uuid
+
+logger = logging.getLogger(__name__)
+
+FAILED_JOB_ERROR = "The receipt could not be processed." #Shown to the client, the cause is only logged as it can name internal services
+ABANDONED_JOB_ERROR = "The receipt could not be processed in time."
+
+DEFAULT_JOB_BACKEND = 'api.jobs.ThreadPoolJobBackend'
+
+'''Base class for receipt job queue backends'''
+class BaseJobBackend:
+    def __init__(self, **options):
+        self.options = options
+
+    def enqueue(self, job): #Hand a pending job to the backend
+        raise NotImplementedError
+
+'''Runs jobs on a pool of threads inside the web process, good for local runs'''
+class ThreadPoolJobBackend(BaseJobBackend):
+    def __init__(self, max_workers=4, **options):
+        super().__init__(**options)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="receipt-job")
+
+    def enqueue(self, job):
+        job_id = job.pk
+        transaction.on_commit(lambda: self.executor.submit(run_receipt_job_in_thread, job_id)) #Only start once the job row is visible to other connections
+
+'''Leaves jobs in the ReceiptJob table, they are picked up by the process_receipt_jobs worker command'''
+class DatabaseJobBackend(BaseJobBackend):
+    def enqueue(self, job):
+        pass
+
+'''Runs jobs straight away in the calling thread, used by tests'''
+class ImmediateJobBackend(BaseJobBackend):
+    def enqueue(self, job):
+        run_receipt_job(job.pk)
+
+'''Return the configured job backend, backends are created once per process'''
+def get_job_backend():
+    return load_backend('RECEIPT_JOBS', DEFAULT_JOB_BACKEND)
+
+'''Create a pending job for an uploaded file or image url and queue it'''
+def submit_receipt_job(user, image_file=None, image_url=None):
+    image_path = None
+    if image_file is not None: #Keep the upload around until a worker gets to it
+        image_path = default_storage.save(f"receipt_jobs/{uuid.uuid4().hex}_{image_file.name}", image_file)
+
+    job = ReceiptJob.objects.create(user=user, image_path=image_path, image_url=None if image_path else image_url)
+    get_job_backend().enqueue(job)
+    return job
+
+'''Jobs a worker may claim, pending ones and running ones whose worker has gone quiet for longer than the claim timeout'''
+def claimable_jobs():
+    stale_before = now() - timedelta(seconds=settings.RECEIPT_JOB_CLAIM_TIMEOUT)
+    return ReceiptJob.objects.filter(
+        Q(status=ReceiptJob.Status.PENDING) | Q(status=ReceiptJob.Status.RUNNING, started_at__lt=stale_before),
+        attempts__lt=settings.RECEIPT_JOB_MAX_ATTEMPTS,
+    )
+
+'''Claim a job, returns None if another worker already has it'''
+def claim_job(job_id):
+    claimed = claimable_jobs().filter(pk=job_id).update(
+        status=ReceiptJob.Status.RUNNING,
+        started_at=now(),
+        attempts=F('attempts') + 1,
+    )
+    if not claimed:
+        return None
+    return ReceiptJob.objects.select_related('user').get(pk=job_id)
+
+'''Fail jobs whose worker went away on their last attempt, returns how many were failed'''
+def fail_abandoned_jobs():
+    stale_before = now() - timedelta(seconds=settings.RECEIPT_JOB_CLAIM_TIMEOUT)
+    abandoned = ReceiptJob.objects.filter(status=ReceiptJob.Status.RUNNING, started_at__lt=stale_before, attempts__gte=settings.RECEIPT_JOB_MAX_ATTEMPTS)
+    failed = 0
+    for job in abandoned:
+        if ReceiptJob.objects.filter(pk=job.pk, status=ReceiptJob.Status.RUNNING, started_at=job.started_at).update(
+            status=ReceiptJob.Status.FAILED, error=ABANDONED_JOB_ERROR, image_path=None, finished_at=now(),
+        ): #Only the worker that fails it deletes the upload
+            failed += 1
+            if job.image_path:
+                default_storage.delete(job.image_path)
+    return failed
+
+'''Upload, analyse and store the receipt for a job. A failed job is queued again until it runs out of attempts'''
+def run_receipt_job(job_id):
+    from .views import process_receipt_image #Imported here as the views import this module
+
+    job = claim_job(job_id)
+    if job is None:
+        return None
+
+    try:
+        if job.image_path:
+            with default_storage.open(job.image_path, 'rb') as image_file:
+                extracted_data = process_receipt_image(job.user, image_file=image_file, filename=job.image_path)
+        else:
+            extracted_data = process_receipt_image(job.user, image_url=job.image_url)
+    except ImageDownloadError as e: #The url will not work any better next time, and the message is meant for the client
+        job.status = ReceiptJob.Status.FAILED
+        job.error = str(e)
+    except Exception:
+        logger.exception("Receipt job %s failed on attempt %s", job.pk, job.attempts)
+        job.status = ReceiptJob.Status.PENDING if job.attempts < settings.RECEIPT_JOB_MAX_ATTEMPTS else ReceiptJob.Status.FAILED
+        job.error = FAILED_JOB_ERROR
+    else:
+        job.status = ReceiptJob.Status.SUCCEEDED
+        job.receipt_id = extracted_data['id']
+        job.error = None
+    finally:
+        finished = job.status in (ReceiptJob.Status.SUCCEEDED, ReceiptJob.Status.FAILED)
+        if finished and job.image_path: #Done with the upload, the receipt now lives in blob storage or the job has given up
+            default_storage.delete(job.image_path)
+            job.image_path = None
+        job.finished_at = now() if finished else None
+        job.save(update_fields=['status', 'receipt', 'error', 'image_path', 'finished_at'])
+
+    if job.status == ReceiptJob.Status.PENDING:
+        get_job_backend().enqueue(job)
+    return job
+
+'''Run a job from a pool thread, which needs its own database connection handling'''
+def run_receipt_job_in_thread(job_id):
+    close_old_connections()
+    try:
+        return run_receipt_job(job_id)
+    finally:
+        close_old_connections()
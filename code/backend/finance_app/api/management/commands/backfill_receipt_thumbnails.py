@@ -0,0 +1,71 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from urllib.parse import unquote, urlparse
+from api import imaging
+from api.backends import get_receipt_storage
+from api.models import Receipt, User
+from api.views import upload_thumbnails
+import logging
+
+logger = logging.getLogger(__name__)
+
+'''Blob name of a stored receipt image from its url'''
+def blob_name(image_url):
+    return unquote(urlparse(image_url).path.rsplit("/", 1)[-1])
+
+'''Read a stored receipt image, make its thumbnails and store them next to it, runs on a worker thread and never touches the database'''
+def make_thumbnails(image_url, sizes):
+    image_data = get_receipt_storage().read(image_url)
+    thumbnail_images = imaging.thumbnails(image_data, sizes, processes=settings.RECEIPT_IMAGE_PROCESSES) #Resizing runs on the process pool, the threads only wait on storage
+    return upload_thumbnails(thumbnail_images, blob_name(image_url))
+
+'''Give receipts stored before thumbnails existed their thumbnails, several at a time'''
+class Command(BaseCommand):
+    help = "Make and store thumbnails for receipts that do not have them yet"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', action='append', dest='emails', metavar='EMAIL', help="Only backfill this user, can be given more than once")
+        parser.add_argument('--workers', type=int, default=8, help="Receipts downloaded, resized and uploaded at the same time")
+        parser.add_argument('--batch-size', type=int, default=200, help="Receipts saved per database write")
+
+    def handle(self, *args, **options):
+        sizes = settings.RECEIPT_THUMBNAIL_SIZES
+        if not sizes:
+            raise CommandError("RECEIPT_THUMBNAIL_SIZES is empty")
+
+        receipts = Receipt.objects.filter(thumbnails={}).exclude(image_url=None).exclude(image_url="")
+        if options['emails']:
+            users = list(User.objects.filter(email__in=options['emails']))
+            missing = set(options['emails']) - {user.email for user in users}
+            if missing:
+                raise CommandError(f"Unknown user(s): {', '.join(sorted(missing))}")
+            receipts = receipts.filter(user__in=users)
+
+        done = failed = 0
+        last_id = 0
+        with ThreadPoolExecutor(max_workers=options['workers'], thread_name_prefix="receipt-thumbnails") as executor:
+            while True:
+                batch = list(receipts.filter(pk__gt=last_id).order_by("pk").values_list("pk", "user_id", "image_url")[:options['batch_size']]) #Keyset on id, receipts that fail are not picked up again in this run
+                if not batch:
+                    break
+                last_id = batch[-1][0]
+
+                futures = [executor.submit(make_thumbnails, image_url, sizes) for _, _, image_url in batch]
+                updated, user_ids = [], set()
+                for (receipt_id, user_id, image_url), future in zip(batch, futures):
+                    try:
+                        updated.append(Receipt(pk=receipt_id, thumbnails=future.result()))
+                        user_ids.add(user_id)
+                    except Exception:
+                        logger.exception("Failed to make thumbnails for receipt %s from %s", receipt_id, image_url)
+                        failed += 1
+
+                with transaction.atomic():
+                    Receipt.objects.bulk_update(updated, ["thumbnails"]) #No signals, only the thumbnails change
+                    User.objects.record_change(*user_ids) #Serialized receipts changed, so cached lists must not match
+                done += len(updated)
+                self.stderr.write(f"{done} receipt(s) done, {failed} failed")
+
+        self.stdout.write(self.style.SUCCESS(f"Added thumbnails to {done} receipt(s), {failed} failed"))
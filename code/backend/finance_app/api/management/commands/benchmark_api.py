@@ -0,0 +1,213 @@
+from datetime import date, datetime, time as datetime_time, timedelta
+from decimal import Decimal
+from django.core.cache import caches
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import make_aware
+from rest_framework.test import APIClient
+from api.benchmarking import peak_rss_bytes, reset_peak_rss, summarise_timings, write_results
+from api.caching import BUDGET_REPORT_CACHE
+from api.models import Budget, CategoryChoices, Expense, MonthlySpending, Receipt, User
+from api.views import analyse_receipt
+import random
+import statistics
+import time
+
+CATEGORIES = [choice.value for choice in CategoryChoices]
+MERCHANTS = ["Tesco", "Dunnes Stores", "Lidl", "Aldi", "Centra", "Spar", "Circle K", "Boots", "Nandos", "Cineworld", "Irish Rail", "Eir"]
+PRODUCTS = ["Milk", "Bread", "Eggs", "Coffee", "Sandwich", "Batteries", "Printer Paper", "Diesel", "Shampoo", "Chicken Wrap", "Cinema Ticket", "Phone Top Up"]
+
+'''Parsed line items shaped like the ones parse_receipt_result stores, returns them with the receipt total'''
+def make_items(rng, count):
+    items, total = [], Decimal("0")
+    for _ in range(count):
+        quantity = rng.randint(1, 3)
+        price = Decimal(rng.randint(99, 2499)) / 100 * quantity
+        total += price
+        items.append({
+            "description": {"value": rng.choice(PRODUCTS)},
+            "quantity": {"value": str(quantity)},
+            "total_price": {"value": str(price)},
+        })
+    return items, total
+
+'''Seed users with budgets, receipts and expenses spread over the last year, bulk inserted with the derived tables rebuilt afterwards'''
+def seed(users, budgets, receipts, items_per_receipt, expenses, seed_value=0):
+    rng = random.Random(seed_value)
+    today = date.today()
+    seeded = []
+    for index in range(users):
+        user = User.objects.create_user(email=f"api-benchmark-{index}@example.com", full_name="Benchmark", date_of_birth="2000-01-01") #No password, hashing would dominate the seeding
+
+        user_budgets = []
+        for number in range(budgets):
+            start = today - timedelta(days=30 * (number + 1))
+            budget = Budget(user=user, name=f"Budget {number}", limit_amount=Decimal("1500.00"), start_date=start, end_date=start + timedelta(days=59))
+            if number % 3 == 1:
+                budget.filter_categories = rng.sample(CATEGORIES, 3) #Some budgets only count a few categories
+            user_budgets.append(budget)
+        user_budgets = Budget.objects.bulk_create(user_budgets)
+
+        user_receipts = []
+        for _ in range(receipts):
+            parsed_items, total = make_items(rng, items_per_receipt)
+            day = today - timedelta(days=rng.randint(0, 364))
+            user_receipts.append(Receipt(
+                user=user,
+                image_url=f"https://example.com/receipts/{rng.getrandbits(64):016x}.jpg",
+                merchant=rng.choice(MERCHANTS),
+                total_amount=total,
+                parsed_items=parsed_items,
+                transaction_date=make_aware(datetime.combine(day, datetime_time(12))),
+                uploaded_at=make_aware(datetime.combine(day, datetime_time(18))),
+                receipt_category=rng.choice(CATEGORIES),
+            ))
+        user_receipts = Receipt.objects.bulk_create(user_receipts, batch_size=500)
+
+        links = [
+            Receipt.budget.through(receipt_id=receipt.pk, budget_id=budget.pk)
+            for receipt in user_receipts for budget in user_budgets
+            if budget.start_date <= receipt.transaction_date.date() <= budget.end_date
+            and (not budget.filter_categories or receipt.receipt_category in budget.filter_categories)
+        ]
+        Receipt.budget.through.objects.bulk_create(links, batch_size=1000)
+        for budget in user_budgets:
+            budget.update_spending()
+
+        Expense.objects.bulk_create([
+            Expense(
+                user=user,
+                name=rng.choice(PRODUCTS),
+                category=rng.choice(CATEGORIES),
+                vendor=rng.choice(MERCHANTS),
+                amount=Decimal(rng.randint(99, 9999)) / 100,
+                date=today - timedelta(days=rng.randint(0, 364)),
+            )
+            for _ in range(expenses)
+        ], batch_size=1000)
+        seeded.append((user, user_budgets, user_receipts))
+
+    MonthlySpending.objects.rebuild([user for user, _, _ in seeded])
+    return seeded
+
+'''Read a response to the end, streamed ones included, and check it succeeded'''
+def read(response):
+    if getattr(response, "streaming", False):
+        body = b"".join(response.streaming_content)
+    else:
+        body = response.content
+    if response.status_code != 200:
+        raise CommandError(f"{response.request['PATH_INFO']} returned {response.status_code}: {body[:200]!r}")
+    return len(body)
+
+'''Local memory caches in place of every configured alias, so clearing them between runs never touches a shared Redis or Memcached'''
+def throwaway_caches():
+    return {
+        alias: {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': f'api-benchmark-{alias}',
+            'TIMEOUT': config.get('TIMEOUT', 300),
+            'OPTIONS': {'MAX_ENTRIES': config.get('OPTIONS', {}).get('MAX_ENTRIES', 300)},
+        }
+        for alias, config in settings.CACHES.items()
+    }
+
+'''Hot paths to measure for one seeded user, each is (prepare, run), prepare is called before every run and is not timed'''
+def scenarios(user, budget, receipt):
+    client = APIClient()
+    client.force_authenticate(user=user)
+    report_cache = caches[BUDGET_REPORT_CACHE]
+    return {
+        "receipt_list": (None, lambda: read(client.get("/api/receipts/?page_size=50"))),
+        "receipt_list_all": (None, lambda: read(client.get("/api/receipts/"))),
+        "budget_list": (None, lambda: read(client.get("/api/budgets/"))),
+        "expense_list": (None, lambda: read(client.get("/api/expenses/?page_size=50"))),
+        "expense_list_all": (None, lambda: read(client.get("/api/expenses/"))),
+        "budget_report": (report_cache.clear, lambda: read(client.get(f"/api/budget-report/{budget.pk}/"))), #Uncached, the cost of building the report. The cache is a throwaway one, see throwaway_caches
+        "budget_report_xlsx": (report_cache.clear, lambda: read(client.get(f"/api/budget-report/{budget.pk}/xlsx/"))),
+        "assign_to_budget": (receipt.budget.clear, receipt.assign_to_budget),
+        "analyse_receipt": (None, lambda: analyse_receipt(receipt.image_url, user)), #Replayed analysis, so only our parsing and database writes are measured
+    }
+
+'''Time one scenario, returns its timings, queries per run and peak memory'''
+def measure(prepare, run, runs, warmup):
+    for _ in range(warmup):
+        if prepare:
+            prepare()
+        run()
+
+    samples, query_counts = [], []
+    reset_peak_rss()
+    baseline = peak_rss_bytes()
+    for _ in range(runs):
+        if prepare:
+            prepare()
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            run()
+            samples.append(time.perf_counter() - start)
+        query_counts.append(len(queries))
+    return {
+        "timings": summarise_timings(samples),
+        "queries": {"median": statistics.median(query_counts), "max": max(query_counts)},
+        "peak_rss_increase_bytes": max(0, peak_rss_bytes() - baseline),
+    }
+
+SCENARIOS = [
+    "receipt_list", "receipt_list_all", "budget_list", "expense_list", "expense_list_all",
+    "budget_report", "budget_report_xlsx", "assign_to_budget", "analyse_receipt",
+]
+
+'''Benchmark the API hot paths against seeded data, everything seeded is rolled back afterwards'''
+class Command(BaseCommand):
+    help = "Seed users, budgets, receipts and expenses and measure latency, queries and peak memory of the API hot paths"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=3, help="Users seeded, the first one is measured")
+        parser.add_argument('--budgets', type=int, default=12, help="Budgets per user")
+        parser.add_argument('--receipts', type=int, default=2000, help="Receipts per user")
+        parser.add_argument('--items-per-receipt', type=int, default=8, help="Parsed line items per receipt")
+        parser.add_argument('--expenses', type=int, default=2000, help="Expenses per user")
+        parser.add_argument('--runs', type=int, default=20, help="Timed runs per scenario")
+        parser.add_argument('--warmup', type=int, default=2, help="Untimed runs per scenario first")
+        parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+        parser.add_argument('--output', help="Write the JSON results to this file")
+
+    def handle(self, *args, **options):
+        results = []
+        with transaction.atomic(), override_settings( #Nothing seeded is kept, nothing is sent to Azure and no real cache is read or cleared
+            RECEIPT_ANALYZER={'BACKEND': 'api.backends.ReplayReceiptAnalyzer'},
+            CACHES=throwaway_caches(),
+        ):
+            start = time.perf_counter()
+            seeded = seed(options['users'], options['budgets'], options['receipts'], options['items_per_receipt'], options['expenses'])
+            self.stderr.write(f"Seeded {options['users']} user(s) in {time.perf_counter() - start:.1f} s")
+
+            user, user_budgets, user_receipts = seeded[0]
+            budget = max(user_budgets, key=lambda budget: budget.receipts.count()) #The busiest budget, reports grow with receipts
+            available = scenarios(user, budget, user_receipts[len(user_receipts) // 2])
+
+            for name in options['scenarios']:
+                prepare, run = available[name]
+                result = measure(prepare, run, options['runs'], options['warmup'])
+                results.append({
+                    "scenario": name,
+                    "users": options['users'],
+                    "budgets_per_user": options['budgets'],
+                    "receipts_per_user": options['receipts'],
+                    "items_per_receipt": options['items_per_receipt'],
+                    "expenses_per_user": options['expenses'],
+                    **result,
+                })
+                timings = result["timings"]
+                self.stderr.write(
+                    f"{name:>18}  {timings['p50_ms']:>9.2f} ms p50  {timings['p99_ms']:>9.2f} ms p99  "
+                    f"{result['queries']['median']:>5} queries  {result['peak_rss_increase_bytes'] / 1024 / 1024:>7.1f} MiB peak"
+                )
+
+            transaction.set_rollback(True)
+
+        self.stdout.write(write_results(options['output'], "api", results))
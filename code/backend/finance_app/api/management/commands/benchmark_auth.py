@@ -0,0 +1,61 @@
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import RequestFactory
+from rest_framework.authentication import BasicAuthentication
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.tokens import RefreshToken
+from api.authentication import BASIC_AUTH_CACHE, CachedBasicAuthentication
+from api.benchmarking import summarise_timings, write_results
+import base64
+import time
+
+EMAIL = "auth-benchmark@example.com"
+PASSWORD = "benchmark-password"
+
+'''Authenticator and Authorization header for each way a client can sign its requests'''
+def methods(user):
+    basic = "Basic " + base64.b64encode(f"{EMAIL}:{PASSWORD}".encode()).decode()
+    return {
+        "basic": (BasicAuthentication(), basic), #Hashes the password on every request, as before
+        "cached-basic": (CachedBasicAuthentication(), basic),
+        "jwt": (JWTAuthentication(), f"Bearer {RefreshToken.for_user(user).access_token}"),
+    }
+
+'''Benchmark the cost authentication adds to each request'''
+class Command(BaseCommand):
+    help = "Measure per-request authentication time for Basic, cached Basic and JWT credentials"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50, help="Authenticated requests per method")
+        parser.add_argument('--methods', nargs='+', choices=["basic", "cached-basic", "jwt"], default=["basic", "cached-basic", "jwt"])
+        parser.add_argument('--output', help="Write the JSON results to this file")
+
+    def handle(self, *args, **options):
+        factory = RequestFactory()
+        results = []
+
+        with transaction.atomic(): #The benchmark user is never kept
+            user = get_user_model().objects.create_user(email=EMAIL, password=PASSWORD, full_name="Benchmark", date_of_birth="2000-01-01")
+            caches[BASIC_AUTH_CACHE].clear()
+            available = methods(user)
+
+            for method in options['methods']:
+                authenticator, header = available[method]
+                samples = []
+                for _ in range(options['requests']):
+                    request = factory.get('/api/receipts/', HTTP_AUTHORIZATION=header)
+                    start = time.perf_counter()
+                    authenticated, _ = authenticator.authenticate(request)
+                    samples.append(time.perf_counter() - start)
+                    assert authenticated.pk == user.pk
+
+                timings = summarise_timings(samples)
+                results.append({"method": method, "requests": options['requests'], "timings": timings})
+                self.stderr.write(f"{method:>12}  {timings['p50_ms']:>9.3f} ms p50  {timings['p99_ms']:>9.3f} ms p99")
+
+            caches[BASIC_AUTH_CACHE].clear()
+            transaction.set_rollback(True)
+
+        self.stdout.write(write_results(options['output'], "authentication", results))
@@ -0,0 +1,105 @@
+from concurrent.futures import ProcessPoolExecutor
+from django.core.management.base import BaseCommand
+from io import BytesIO
+from PIL import Image, ImageDraw
+from api.benchmarking import peak_rss_bytes, reset_peak_rss, summarise_timings, write_results
+from api.imaging import compress_image_data, MAX_DIMENSION, TARGET_BYTES
+import multiprocessing
+import random
+import time
+
+'''The compression used before the bounded stage, full decode and a fixed quality re-encode'''
+def legacy_compress(image_data, max_dimension=None, target_bytes=None):
+    img = Image.open(BytesIO(image_data))
+    img = img.convert("RGB")
+    img_io = BytesIO()
+    img.save(img_io, format="JPEG", quality=90)
+    return img_io.getvalue()
+
+METHODS = {
+    "legacy": legacy_compress,
+    "bounded": compress_image_data,
+}
+
+'''Build a phone-photo-like JPEG of a receipt lying on a table'''
+def make_receipt_photo(megapixels, seed=0):
+    rng = random.Random(seed)
+    width = int((megapixels * 1_000_000 * 3 / 4) ** 0.5)
+    height = int(width * 4 / 3)
+
+    img = Image.new("RGB", (width, height), (96, 84, 70)) #Table
+    draw = ImageDraw.Draw(img)
+    left, right = width // 5, width * 4 // 5
+    draw.rectangle([left, height // 20, right, height * 19 // 20], fill=(246, 244, 238)) #Receipt paper
+
+    line_height = max(6, height // 120)
+    for y in range(height // 10, height * 9 // 10, line_height * 2): #Lines of "text"
+        x = left + (right - left) // 12
+        while x < right - (right - left) // 12:
+            word = rng.randint(line_height, line_height * 5)
+            draw.rectangle([x, y, min(x + word, right), y + line_height], fill=(30, 30, 30))
+            x += word + line_height
+
+    noise = Image.effect_noise((width, height), 24).convert("RGB") #Sensor noise stops the JPEG being unrealistically small
+    img = Image.blend(img, noise, 0.12)
+
+    img_io = BytesIO()
+    img.save(img_io, format="JPEG", quality=92)
+    return img_io.getvalue()
+
+'''Run one compression in this process and report its cost, called in a fresh process per run'''
+def measure_once(method, image_data, max_dimension, target_bytes):
+    reset_peak_rss()
+    baseline = peak_rss_bytes()
+    start = time.perf_counter()
+    output = METHODS[method](image_data, max_dimension, target_bytes)
+    elapsed = time.perf_counter() - start
+    return {
+        "seconds": elapsed,
+        "peak_rss_increase_bytes": max(0, peak_rss_bytes() - baseline),
+        "output_bytes": len(output),
+    }
+
+'''Benchmark memory and time per megapixel of the old and new image compression'''
+class Command(BaseCommand):
+    help = "Measure peak memory and time per megapixel of receipt image compression"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--megapixels', type=float, nargs='+', default=[2, 8, 12, 24], help="Image sizes to test")
+        parser.add_argument('--runs', type=int, default=3, help="Runs per size and method")
+        parser.add_argument('--methods', nargs='+', choices=sorted(METHODS), default=sorted(METHODS))
+        parser.add_argument('--max-dimension', type=int, default=MAX_DIMENSION)
+        parser.add_argument('--target-bytes', type=int, default=TARGET_BYTES)
+        parser.add_argument('--output', help="Write the JSON results to this file")
+
+    def handle(self, *args, **options):
+        context = multiprocessing.get_context("spawn")
+        results = []
+
+        for megapixels in options['megapixels']:
+            image_data = make_receipt_photo(megapixels)
+            for method in options['methods']:
+                runs = []
+                for _ in range(options['runs']):
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor: #A new process per run so peak RSS is not shared between runs
+                        runs.append(executor.submit(measure_once, method, image_data, options['max_dimension'], options['target_bytes']).result())
+
+                peak_rss = max(run["peak_rss_increase_bytes"] for run in runs)
+                timings = summarise_timings([run["seconds"] for run in runs])
+                result = {
+                    "method": method,
+                    "megapixels": megapixels,
+                    "input_bytes": len(image_data),
+                    "output_bytes": runs[-1]["output_bytes"],
+                    "timings": timings,
+                    "ms_per_megapixel": round(timings["p50_ms"] / megapixels, 3),
+                    "peak_rss_increase_bytes": peak_rss,
+                    "peak_rss_bytes_per_megapixel": round(peak_rss / megapixels),
+                }
+                results.append(result)
+                self.stderr.write(
+                    f"{method:>8} {megapixels:>5}MP  {timings['p50_ms']:>9.1f} ms  "
+                    f"{peak_rss / 1024 / 1024:>7.1f} MiB peak  {result['output_bytes'] / 1024:>7.1f} KiB out"
+                )
+
+        self.stdout.write(write_results(options['output'], "compression", results))
@@ -0,0 +1,114 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from io import BytesIO
+from PIL import Image
+from api.backends import close_loop_clients, native_aio
+from api.benchmarking import summarise_timings, write_results
+from api.views import ascan_receipt_image, scan_receipt_image
+import asyncio
+import tempfile
+import threading
+import time
+
+'''Small noisy receipt images, no two hash the same so none of them is answered from the analysis cache'''
+def make_images(count):
+    images = []
+    for _ in range(count):
+        image_io = BytesIO()
+        Image.merge("RGB", [Image.effect_noise((64, 64), 64)] * 3).save(image_io, format="JPEG")
+        images.append(image_io.getvalue())
+    return images
+
+'''Scan every image on a pool of threads, one blocked thread per scan in flight as under WSGI'''
+def run_threads(images, threads):
+    latencies, peak_threads = [], threading.active_count()
+
+    def scan(image_data, submitted):
+        nonlocal peak_threads
+        scan_receipt_image(image_file=SimpleUploadedFile("receipt.jpg", image_data, content_type="image/jpeg"))
+        peak_threads = max(peak_threads, threading.active_count())
+        latencies.append(time.perf_counter() - submitted) #Includes time spent waiting for a free thread
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(scan, image_data, time.perf_counter()) for image_data in images]
+    elapsed = time.perf_counter() - start
+    errors = [future.exception() for future in futures if future.exception() is not None]
+    return elapsed, latencies, peak_threads, errors
+
+'''Scan every image on one event loop with at most concurrency scans in flight, as one ASGI worker would'''
+def run_event_loop(images, concurrency):
+    latencies, peak_threads = [], threading.active_count()
+
+    async def scan(image_data, limit):
+        nonlocal peak_threads
+        submitted = time.perf_counter()
+        async with limit:
+            await ascan_receipt_image(image_file=SimpleUploadedFile("receipt.jpg", image_data, content_type="image/jpeg"))
+        peak_threads = max(peak_threads, threading.active_count())
+        latencies.append(time.perf_counter() - submitted)
+
+    async def scan_all():
+        native_aio.set(True) #The loop runs for the whole benchmark, as an ASGI server's would
+        limit = asyncio.Semaphore(concurrency)
+        try:
+            return await asyncio.gather(*(scan(image_data, limit) for image_data in images), return_exceptions=True)
+        finally:
+            await close_loop_clients()
+
+    start = time.perf_counter()
+    outcomes = asyncio.run(scan_all())
+    elapsed = time.perf_counter() - start
+    return elapsed, latencies, peak_threads, [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+
+MODES = {
+    "threads": run_threads,
+    "asyncio": run_event_loop,
+}
+
+'''Benchmark how many receipt scans one worker keeps in flight, thread per scan against one event loop'''
+class Command(BaseCommand):
+    help = "Measure receipt scan throughput and latency with a thread pool against the async pipeline on one event loop"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scans', type=int, default=500, help="Receipt images scanned per run")
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[8, 64, 256], help="Threads, or scans in flight on the event loop")
+        parser.add_argument('--latency', type=float, default=0.5, help="Seconds each replayed analysis waits, like the OCR service")
+        parser.add_argument('--modes', nargs='+', choices=sorted(MODES), default=sorted(MODES))
+        parser.add_argument('--output', help="Write the JSON results to this file")
+
+    def handle(self, *args, **options):
+        results = []
+
+        with tempfile.TemporaryDirectory() as location, override_settings( #Local storage and replayed analysis, nothing is sent to Azure
+            RECEIPT_STORAGE={'BACKEND': 'api.backends.FileSystemReceiptStorage', 'OPTIONS': {'location': location}},
+            RECEIPT_ANALYZER={'BACKEND': 'api.backends.ReplayReceiptAnalyzer', 'OPTIONS': {'latency': options['latency']}},
+        ):
+            for concurrency in options['concurrency']:
+                for mode in options['modes']:
+                    images = make_images(options['scans'])
+                    elapsed, latencies, peak_threads, errors = MODES[mode](images, concurrency)
+                    if not latencies:
+                        raise CommandError(f"Every {mode} scan failed, first error: {errors[0]!r}")
+                    timings = summarise_timings(latencies) #Only scans that finished, a failed one would look fast
+                    completed = len(images) - len(errors)
+                    results.append({
+                        "mode": mode,
+                        "concurrency": concurrency,
+                        "scans": len(images),
+                        "errors": len(errors),
+                        "analysis_latency_s": options['latency'],
+                        "scans_per_second": round(completed / elapsed, 2),
+                        "peak_threads": peak_threads,
+                        "timings": timings,
+                    })
+                    self.stderr.write(
+                        f"{mode:>8} {concurrency:>5} in flight  {completed / elapsed:>8.1f} scans/s  "
+                        f"{timings['p50_ms']:>9.1f} ms p50  {timings['p99_ms']:>9.1f} ms p99  {peak_threads:>4} threads  {len(errors)} errors"
+                    )
+                    if errors:
+                        self.stderr.write(self.style.ERROR(f"First error: {errors[0]!r}"))
+
+        self.stdout.write(write_results(options['output'], "receipt_concurrency", results))
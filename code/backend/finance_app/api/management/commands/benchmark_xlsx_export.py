@@ -0,0 +1,138 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from django.core.management.base import BaseCommand
+from io import BytesIO
+from types import SimpleNamespace
+from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
+from api.benchmarking import peak_rss_bytes, reset_peak_rss, summarise_timings, write_results
+from api.reports import write_budget_report_xlsx, receipt_rows
+import multiprocessing
+import openpyxl
+import tempfile
+import time
+
+'''The export used before write-only mode, every cell held in memory and a second pass over all of them to size the columns'''
+def legacy_export(output, budget, summary, receipts):
+    wb = openpyxl.Workbook()
+    bold_font = Font(bold=True)
+
+    summary_ws = wb.active
+    summary_ws.title = "Budget Summary"
+    summary_headers = ["Budget Name", "User", "Limit Amount", "Total Spent", "Start Date", "End Date"]
+    summary_values = [
+        budget.name, budget.user.email, f"{budget.limit_amount:.2f}",
+        f"{budget.current_spending:.2f}", budget.start_date.strftime('%d-%m-%Y'), budget.end_date.strftime('%d-%m-%Y')
+    ]
+    for col_num, (header, value) in enumerate(zip(summary_headers, summary_values), start=1):
+        summary_ws.cell(row=1, column=col_num, value=header).font = bold_font
+        summary_ws.cell(row=2, column=col_num, value=value)
+
+    breakdown_ws = wb.create_sheet(title="Spending Breakdown")
+    breakdown_ws.append(["Category", "Total Spent", "Item Count"])
+    for cell in breakdown_ws[1]:
+        cell.font = bold_font
+    for category, amount in summary["category_spending"].items():
+        breakdown_ws.append([category, f"{amount:.2f}", summary["category_items"][category]])
+
+    receipts_ws = wb.create_sheet(title="Receipts")
+    receipts_ws.append(["ID", "Merchant", "Total Amount", "Transaction Date", "Category", "Item Name", "Item Price"])
+    for cell in receipts_ws[1]:
+        cell.font = bold_font
+    for row in receipt_rows(list(receipts)): #The queryset was evaluated in full before
+        receipts_ws.append(row)
+
+    for sheet in [summary_ws, breakdown_ws, receipts_ws]:
+        for col_num, col_cells in enumerate(sheet.columns, 1):
+            max_length = max((len(str(cell.value)) for cell in col_cells if cell.value), default=0)
+            sheet.column_dimensions[get_column_letter(col_num)].width = max_length + 2
+
+    wb.save(output)
+
+'''The write-only export used by BudgetReportXlsxView'''
+def streaming_export(output, budget, summary, receipts):
+    write_budget_report_xlsx(output, budget, summary, receipts)
+
+METHODS = {
+    "legacy": legacy_export,
+    "streaming": streaming_export,
+}
+
+'''Receipt-like rows with items_per_receipt parsed items each, made lazily like queryset.iterator()'''
+def make_receipts(line_items, items_per_receipt):
+    start = datetime(2024, 1, 1)
+    for receipt_id in range(1, line_items // items_per_receipt + 1):
+        yield SimpleNamespace(
+            id=receipt_id,
+            merchant=f"Merchant {receipt_id % 250}",
+            total_amount=Decimal("42.50"),
+            transaction_date=start + timedelta(minutes=receipt_id),
+            uploaded_at=start,
+            receipt_category="Meal",
+            parsed_items=[
+                {"description": {"value": f"Item {receipt_id}-{item}"}, "total_price": {"value": 8.5}}
+                for item in range(items_per_receipt)
+            ],
+        )
+
+'''Export line_items rows with one method in this process and report its cost, called in a fresh process per run'''
+def measure_once(method, line_items, items_per_receipt):
+    budget = SimpleNamespace(
+        name="Benchmark", user=SimpleNamespace(email="benchmark@example.com"), limit_amount=Decimal("1000"),
+        current_spending=Decimal("0"), start_date=date(2024, 1, 1), end_date=date(2024, 12, 31),
+    )
+    receipts = line_items // items_per_receipt
+    summary = {"category_spending": {"Meal": Decimal("42.50") * receipts}, "category_items": {"Meal": receipts * items_per_receipt}}
+
+    reset_peak_rss()
+    baseline = peak_rss_bytes()
+    start = time.perf_counter()
+    with tempfile.TemporaryFile() as output:
+        METHODS[method](output, budget, summary, make_receipts(line_items, items_per_receipt))
+        output_bytes = output.tell()
+    elapsed = time.perf_counter() - start
+    return {
+        "seconds": elapsed,
+        "peak_rss_increase_bytes": max(0, peak_rss_bytes() - baseline),
+        "output_bytes": output_bytes,
+    }
+
+'''Benchmark memory and time of the budget report xlsx export'''
+class Command(BaseCommand):
+    help = "Measure peak memory and time of the budget report xlsx export, legacy against write-only streaming"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--line-items', type=int, nargs='+', default=[100000], help="Rows in the receipts sheet")
+        parser.add_argument('--items-per-receipt', type=int, default=5)
+        parser.add_argument('--runs', type=int, default=3, help="Runs per size and method")
+        parser.add_argument('--methods', nargs='+', choices=sorted(METHODS), default=sorted(METHODS))
+        parser.add_argument('--output', help="Write the JSON results to this file")
+
+    def handle(self, *args, **options):
+        context = multiprocessing.get_context("spawn")
+        results = []
+
+        for line_items in options['line_items']:
+            for method in options['methods']:
+                runs = []
+                for _ in range(options['runs']):
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor: #A new process per run so peak RSS is not shared between runs
+                        runs.append(executor.submit(measure_once, method, line_items, options['items_per_receipt']).result())
+
+                peak_rss = max(run["peak_rss_increase_bytes"] for run in runs)
+                timings = summarise_timings([run["seconds"] for run in runs])
+                results.append({
+                    "method": method,
+                    "line_items": line_items,
+                    "items_per_receipt": options['items_per_receipt'],
+                    "output_bytes": runs[-1]["output_bytes"],
+                    "timings": timings,
+                    "peak_rss_increase_bytes": peak_rss,
+                })
+                self.stderr.write(
+                    f"{method:>9} {line_items:>8} rows  {timings['p50_ms']:>9.1f} ms  "
+                    f"{peak_rss / 1024 / 1024:>7.1f} MiB peak  {runs[-1]['output_bytes'] / 1024:>8.1f} KiB out"
+                )
+
+        self.stdout.write(write_results(options['output'], "xlsx_export", results))
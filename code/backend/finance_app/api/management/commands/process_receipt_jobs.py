@@ -0,0 +1,54 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from django.core.management.base import BaseCommand
+from api.jobs import claimable_jobs, fail_abandoned_jobs, run_receipt_job_in_thread
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+'''Worker for the database job backend, claims pending receipt jobs and runs them on a thread pool.
+Jobs left running by a worker that died are claimed again once their claim times out'''
+class Command(BaseCommand):
+    help = "Process pending receipt jobs from the ReceiptJob table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help="Number of jobs to run at the same time")
+        parser.add_argument('--poll-interval', type=float, default=2.0, help="Seconds to wait when the queue is empty")
+        parser.add_argument('--once', action='store_true', help="Drain the queue once and exit")
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        in_flight = set()
+        processed = errors = 0
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="receipt-job") as executor:
+            while True:
+                abandoned = fail_abandoned_jobs()
+                if abandoned:
+                    self.stdout.write(f"Failed {abandoned} abandoned job(s)")
+
+                free_slots = workers - len(in_flight)
+                if free_slots > 0:
+                    claimable_ids = list(claimable_jobs().order_by('created_at').values_list('id', flat=True)[:free_slots])
+                    for job_id in claimable_ids: #Each job is claimed atomically inside the thread, so several workers can share the table
+                        in_flight.add(executor.submit(run_receipt_job_in_thread, job_id))
+
+                if not in_flight:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+                    continue
+
+                done, in_flight = wait(in_flight, timeout=options['poll_interval'], return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        job = future.result()
+                    except Exception: #A job that could not even record its failure, the claim times out and it is tried again
+                        errors += 1
+                        logger.exception("Receipt job worker thread failed")
+                        continue
+                    if job is not None:
+                        processed += 1
+                        self.stdout.write(f"Job {job.id} {job.status}")
+
+        self.stdout.write(self.style.SUCCESS(f"Processed {processed} receipt job(s), {errors} error(s)"))
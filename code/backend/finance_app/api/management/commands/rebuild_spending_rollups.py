@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from api.models import MonthlySpending, User
+
+'''Recount monthly spending rollups from receipts and expenses, for after bulk changes made outside the ORM or if they ever drift'''
+class Command(BaseCommand):
+    help = "Rebuild the monthly spending rollups used by the time series endpoint"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', action='append', dest='emails', metavar='EMAIL', help="Only rebuild this user, can be given more than once")
+
+    def handle(self, *args, **options):
+        users = None
+        if options['emails']:
+            users = list(User.objects.filter(email__in=options['emails']))
+            missing = set(options['emails']) - {user.email for user in users}
+            if missing:
+                raise CommandError(f"Unknown user(s): {', '.join(sorted(missing))}")
+
+        cells = MonthlySpending.objects.rebuild(users)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {cells} monthly spending rollup(s)"))
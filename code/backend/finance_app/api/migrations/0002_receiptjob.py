@@ -0,0 +1,38 @@
+# Generated by Django 5.1.4 on 2026-10-18 08:27
+
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReceiptJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('image_path', models.CharField(blank=True, max_length=255, null=True)),
+                ('image_url', models.URLField(blank=True, max_length=500, null=True)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('receipt', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='jobs', to='api.receipt')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='receipt_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Receipt Job',
+                'verbose_name_plural': 'Receipt Jobs',
+                'indexes': [models.Index(fields=['status', 'created_at'], name='receiptjob_status_created_idx')],
+            },
+        ),
+    ]
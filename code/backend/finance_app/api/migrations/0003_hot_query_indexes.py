@@ -0,0 +1,34 @@
+# Generated by Django 5.1.4 on 2026-10-18 08:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_receiptjob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='budget',
+            index=models.Index(fields=['user', 'start_date', 'end_date'], name='budget_user_dates_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['user', 'date'], name='expense_user_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='receipt',
+            index=models.Index(fields=['user', '-uploaded_at'], name='receipt_user_uploaded_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='receipt',
+            index=models.Index(fields=['user', 'receipt_category', '-uploaded_at'], name='receipt_user_category_idx'),
+        ),
+        #The auto created Receipt-Budget table only has a unique index led by receipt_id, this covers reading the receipts of a budget
+        migrations.RunSQL(
+            sql='CREATE INDEX receipt_budget_budget_idx ON api_receipt_budget (budget_id, receipt_id)',
+            reverse_sql='DROP INDEX receipt_budget_budget_idx',
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.1.4 on 2026-10-18 08:43
+
+from django.db import migrations, models
+
+#CategoryChoices order when the mask was introduced, bit n is CATEGORIES[n]
+CATEGORIES = ['Meal', 'Supplies', 'Hotel', 'Fuel', 'Transportation', 'Communication', 'Subscriptions', 'Entertainment', 'Training', 'Healthcare', 'Other']
+
+
+def categories_to_mask(apps, schema_editor):
+    Budget = apps.get_model('api', 'Budget')
+    budgets = []
+    for budget in Budget.objects.only('id', 'filter_categories').iterator():
+        categories = budget.filter_categories
+        if isinstance(categories, str): #Stored as "Meal,Fuel"
+            categories = categories.split(',')
+        budget.category_mask = sum(1 << CATEGORIES.index(category) for category in set(categories or []) if category in CATEGORIES)
+        budgets.append(budget)
+    Budget.objects.bulk_update(budgets, ['category_mask'], batch_size=500)
+
+
+def mask_to_categories(apps, schema_editor):
+    Budget = apps.get_model('api', 'Budget')
+    budgets = []
+    for budget in Budget.objects.only('id', 'category_mask').iterator():
+        budget.filter_categories = [category for index, category in enumerate(CATEGORIES) if budget.category_mask & (1 << index)]
+        budgets.append(budget)
+    Budget.objects.bulk_update(budgets, ['filter_categories'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='budget',
+            name='category_mask',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(categories_to_mask, mask_to_categories),
+        migrations.RemoveField(
+            model_name='budget',
+            name='filter_categories',
+        ),
+    ]
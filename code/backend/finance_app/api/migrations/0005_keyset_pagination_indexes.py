@@ -0,0 +1,41 @@
+# Generated by Django 5.1.4 on 2026-10-18 08:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_budget_category_mask'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='expense',
+            name='expense_user_date_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='receipt',
+            name='receipt_user_uploaded_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='receipt',
+            name='receipt_user_category_idx',
+        ),
+        migrations.AddIndex(
+            model_name='budget',
+            index=models.Index(fields=['user', '-start_date', '-id'], name='budget_user_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['user', '-date', '-id'], name='expense_user_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='receipt',
+            index=models.Index(fields=['user', '-uploaded_at', '-id'], name='receipt_user_uploaded_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='receipt',
+            index=models.Index(fields=['user', 'receipt_category', '-uploaded_at', '-id'], name='receipt_user_category_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 08:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='budget',
+            name='report_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
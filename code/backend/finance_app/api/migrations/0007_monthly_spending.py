@@ -0,0 +1,58 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:07
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, DecimalField, Sum
+from django.db.models.functions import Coalesce, TruncMonth
+from decimal import Decimal
+
+
+def count_existing_spending(apps, schema_editor): #Same counts as MonthlySpending.objects.rebuild(), later saves move them by deltas
+    Receipt = apps.get_model('api', 'Receipt')
+    Expense = apps.get_model('api', 'Expense')
+    MonthlySpending = apps.get_model('api', 'MonthlySpending')
+    cells = {}
+
+    def cell(user_id, month, category):
+        month = (month.date() if hasattr(month, 'date') else month).replace(day=1)
+        return cells.setdefault((user_id, month, category), MonthlySpending(user_id=user_id, month=month, category=category))
+
+    receipts = Receipt.objects.order_by().values('user_id', 'receipt_category', month=TruncMonth(Coalesce('transaction_date', 'uploaded_at')))
+    for row in receipts.annotate(total=Coalesce(Sum('total_amount'), Decimal('0'), output_field=DecimalField()), count=Count('id')):
+        rollup = cell(row['user_id'], row['month'], row['receipt_category'])
+        rollup.receipt_total, rollup.receipt_count = row['total'], row['count']
+    expenses = Expense.objects.exclude(date=None).order_by().values('user_id', 'category', month=TruncMonth('date'))
+    for row in expenses.annotate(total=Sum('amount'), count=Count('id')):
+        rollup = cell(row['user_id'], row['month'], row['category'])
+        rollup.expense_total, rollup.expense_count = row['total'], row['count']
+    MonthlySpending.objects.bulk_create(cells.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_budget_report_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlySpending',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('category', models.CharField(choices=[('Meal', 'Meal'), ('Supplies', 'Supplies'), ('Hotel', 'Hotel'), ('Fuel', 'Fuel'), ('Transportation', 'Transportation'), ('Communication', 'Communication'), ('Subscriptions', 'Subscriptions'), ('Entertainment', 'Entertainment'), ('Training', 'Training'), ('Healthcare', 'Healthcare'), ('Other', 'Other')], max_length=50)),
+                ('receipt_total', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('receipt_count', models.IntegerField(default=0)),
+                ('expense_total', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('expense_count', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='monthly_spending', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Monthly Spending',
+                'verbose_name_plural': 'Monthly Spending',
+                'constraints': [models.UniqueConstraint(fields=('user', 'month', 'category'), name='monthlyspending_user_month_category_uniq')],
+            },
+        ),
+        migrations.RunPython(count_existing_spending, migrations.RunPython.noop),
+    ]
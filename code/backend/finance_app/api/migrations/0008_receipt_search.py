@@ -0,0 +1,58 @@
+from django.db import migrations
+
+#Same item text as api.search.item_text when the index was introduced
+def item_text(parsed_items):
+    if not isinstance(parsed_items, list):
+        return ''
+    descriptions = ((item.get('description') or {}).get('value') for item in parsed_items if isinstance(item, dict))
+    return '\n'.join(str(description) for description in descriptions if description)
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(
+            'CREATE VIRTUAL TABLE api_receipt_search USING fts5(merchant, items, user_id UNINDEXED, tokenize="unicode61 remove_diacritics 2")'
+        )
+        insert = 'INSERT INTO api_receipt_search (rowid, user_id, merchant, items) VALUES (%s, %s, %s, %s)'
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE TABLE api_receipt_search ('
+            'receipt_id bigint PRIMARY KEY REFERENCES api_receipt (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, '
+            'user_id bigint NOT NULL, document tsvector NOT NULL)'
+        )
+        schema_editor.execute('CREATE INDEX receipt_search_document_idx ON api_receipt_search USING GIN (document)')
+        insert = (
+            'INSERT INTO api_receipt_search (receipt_id, user_id, document) '
+            "VALUES (%s, %s, setweight(to_tsvector('simple', %s), 'A') || setweight(to_tsvector('simple', %s), 'B'))"
+        )
+    else: #Searched without an index, see api.search.UnindexedSearch
+        return
+
+    Receipt = apps.get_model('api', 'Receipt')
+    receipts = Receipt.objects.order_by('id').values_list('id', 'user_id', 'merchant', 'parsed_items')
+    rows = []
+    with schema_editor.connection.cursor() as cursor:
+        for receipt_id, user_id, merchant, parsed_items in receipts.iterator(chunk_size=2000):
+            rows.append([receipt_id, user_id, merchant or '', item_text(parsed_items)])
+            if len(rows) == 2000:
+                cursor.executemany(insert, rows)
+                rows = []
+        if rows:
+            cursor.executemany(insert, rows)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute('DROP TABLE api_receipt_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_monthly_spending'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
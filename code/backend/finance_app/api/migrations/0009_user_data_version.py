@@ -0,0 +1,24 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:16
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_receipt_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='data_changed_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='data_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
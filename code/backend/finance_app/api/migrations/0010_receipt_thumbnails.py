@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_user_data_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receipt',
+            name='thumbnails',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
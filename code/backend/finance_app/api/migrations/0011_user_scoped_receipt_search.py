@@ -0,0 +1,64 @@
+from django.db import migrations
+import re
+
+TERM = re.compile(r'[^\W_]+')
+
+#Same item text and user tokens as api.search when the index was scoped to users
+def item_text(parsed_items):
+    if not isinstance(parsed_items, list):
+        return ''
+    descriptions = ((item.get('description') or {}).get('value') for item in parsed_items if isinstance(item, dict))
+    return '\n'.join(str(description) for description in descriptions if description)
+
+
+def user_tokens(user_id, text):
+    return ' '.join(f'u{user_id}x{word}' for word in TERM.findall(text.lower()))
+
+
+def reindex_sqlite(apps, schema_editor, scoped):
+    Receipt = apps.get_model('api', 'Receipt')
+    receipts = Receipt.objects.order_by('id').values_list('id', 'user_id', 'merchant', 'parsed_items')
+    insert = 'INSERT INTO api_receipt_search (rowid, user_id, merchant, items) VALUES (%s, %s, %s, %s)'
+    rows = []
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('DELETE FROM api_receipt_search')
+        for receipt_id, user_id, merchant, parsed_items in receipts.iterator(chunk_size=2000):
+            merchant, items = merchant or '', item_text(parsed_items)
+            if scoped:
+                merchant, items = user_tokens(user_id, merchant), user_tokens(user_id, items)
+            rows.append([receipt_id, user_id, merchant, items])
+            if len(rows) == 2000:
+                cursor.executemany(insert, rows)
+                rows = []
+        if rows:
+            cursor.executemany(insert, rows)
+
+
+def scope_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite': #Words are stored as per-user tokens, see api.search.user_tokens
+        reindex_sqlite(apps, schema_editor, scoped=True)
+    elif vendor == 'postgresql': #btree_gin lets one GIN index cover the user id and the document
+        schema_editor.execute('CREATE EXTENSION IF NOT EXISTS btree_gin')
+        schema_editor.execute('CREATE INDEX receipt_search_user_document_idx ON api_receipt_search USING GIN (user_id, document)')
+        schema_editor.execute('DROP INDEX receipt_search_document_idx')
+
+
+def unscope_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        reindex_sqlite(apps, schema_editor, scoped=False)
+    elif vendor == 'postgresql':
+        schema_editor.execute('CREATE INDEX receipt_search_document_idx ON api_receipt_search USING GIN (document)')
+        schema_editor.execute('DROP INDEX receipt_search_user_document_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_receipt_thumbnails'),
+    ]
+
+    operations = [
+        migrations.RunPython(scope_search_index, unscope_search_index),
+    ]
@@ -1,10 +1,12 @@
-from django.db import models
-from django.conf import settings
+from django.db import models, transaction, IntegrityError
 from django.contrib.auth.models import AbstractUser, BaseUserManager
-from django.db.models import Sum, FloatField, Q
-from django.db.models.functions import Cast
-from django.utils.timezone import now
-from multiselectfield import MultiSelectField
+from django.db.models import Sum, Count, Q, F, Func, OuterRef, Subquery, DecimalField, IntegerField, Case, When, Value
+from django.db.models.functions import Coalesce, NullIf, TruncMonth
+from django.db.models.lookups import GreaterThan
+from django.utils.timezone import now, is_aware, localtime
+from datetime import datetime
+from decimal import Decimal
+import uuid
 
 class UserManager(BaseUserManager):
     '''Custom user manager that supports email-based authentication.'''
@@ -38,6 +40,9 @@ class UserManager(BaseUserManager):
             raise ValueError('Superuser must have is_superuser=True.')
 
         return self._create_user(email, password, **extra_fields)
+
+    def record_change(self, *user_ids): #Bump the data version of users whose receipts, budgets or expenses changed, conditional GETs compare against it
+        return self.filter(pk__in=user_ids).update(data_version=F("data_version") + 1, data_changed_at=now())
     
 '''User model using email instead of username.'''
 class User(AbstractUser):
@@ -46,15 +51,37 @@ class User(AbstractUser):
     email = models.EmailField('Email Address', unique=True, db_index=True)
     full_name = models.CharField(max_length=150, blank=True)
     date_of_birth = models.DateField(blank=True, null=True)
+    data_version = models.PositiveIntegerField(default=0) #Bumped on any write to the user's receipts, budgets or expenses, ETags are built from it
+    data_changed_at = models.DateTimeField(default=now)
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['full_name', 'date_of_birth']
 
     objects = UserManager()
+
+    def save(self, *args, **kwargs): #The data version is only ever bumped in SQL, writing back a copy loaded earlier could reuse an old version
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in ("data_version", "data_changed_at")
+            ]
+        super().save(*args, **kwargs)
     
     def __str__(self):
         return self.email
 
+'''Receipt total as a Decimal, missing totals count as zero'''
+def spending_amount(value):
+    return Decimal(str(value)).quantize(Decimal("0.01")) if value is not None else Decimal("0")
+
+'''First day of the month of a date or datetime, datetimes are taken in the current time zone like TruncMonth does'''
+def month_start(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        value = (localtime(value) if is_aware(value) else value).date()
+    return value.replace(day=1)
+
 '''Category choices for budget, expense and receipts'''
 class CategoryChoices(models.TextChoices):
     MEAL = "Meal", "Meal"
@@ -69,6 +96,19 @@ class CategoryChoices(models.TextChoices):
     HEALTHCARE = "Healthcare", "Healthcare"
     OTHER = "Other", "Other"
 
+CATEGORY_BITS = {choice.value: 1 << index for index, choice in enumerate(CategoryChoices)} #One bit per category for budget filters, new categories must be added at the end so stored masks keep their meaning
+
+'''Bitmask for a list of categories'''
+def category_mask(categories):
+    mask = 0
+    for category in categories or ():
+        mask |= CATEGORY_BITS[category]
+    return mask
+
+'''Categories set in a bitmask, in CategoryChoices order'''
+def mask_categories(mask):
+    return [category for category, bit in CATEGORY_BITS.items() if mask & bit]
+
 '''Expense Model'''
 class Expense(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="expenses")
@@ -77,40 +117,129 @@ class Expense(models.Model):
     vendor = models.CharField(max_length=100, blank=True, null=True)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     date = models.DateField(blank=True, null=True)    
+    def saved_spending(self): #Amount, category and rollup month as stored in the database
+        saved = Expense.objects.filter(pk=self.pk).values_list("amount", "category", "date").first()
+        if saved is None:
+            return Decimal("0"), self.category, None
+        return spending_amount(saved[0]), saved[1], month_start(saved[2])
+
+    def spending_month(self): #Month the expense counts in for spending rollups, undated expenses are not counted
+        return month_start(self._meta.get_field("date").to_python(self.date))
+
     class Meta:
         verbose_name = "Expense"
         verbose_name_plural = "Expenses"
+        indexes = [
+            models.Index(fields=["user", "-date", "-id"], name="expense_user_date_idx"), #Expense list pages and date ranges per user
+        ]
+
+'''Condition for budgets where a receipt of this category counts, either no filter or the category's bit is set'''
+def accepts_category(category):
+    return Q(category_mask=0) | Q(GreaterThan(F("category_mask").bitand(CATEGORY_BITS.get(category, 0)), 0))
+
+'''Spending change per budget as a CASE, for moving several budgets by different amounts in one UPDATE'''
+def spending_change(*whens):
+    return Case(*whens, default=Value(Decimal("0")), output_field=DecimalField(max_digits=10, decimal_places=2))
+
+'''Queryset helpers used to keep budget spending up to date'''
+class BudgetQuerySet(models.QuerySet):
+    def accepting(self, category): #Budgets where a receipt of this category counts
+        return self.filter(accepts_category(category))
+
+    def including(self, categories): #Budgets whose filter has all of these categories
+        mask = category_mask(categories)
+        return self.alias(category_match=F("category_mask").bitand(mask)).filter(category_match=mask)
+
+    def update(self, **kwargs): #Any change to a budget can change its report, so every UPDATE moves the version on unless it sets it itself
+        kwargs.setdefault("report_version", F("report_version") + 1)
+        return super().update(**kwargs)
+
+    def record_change(self, spending=None): #Shift current spending and bump the report version in one UPDATE, safe with concurrent writers
+        return self.update(
+            current_spending=F("current_spending") + (spending if spending is not None else Value(Decimal("0"))),
+            report_version=F("report_version") + 1,
+        )
 
 '''Budget Model with filtered categories and spending limits'''
 class Budget(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="budgets")
     name = models.CharField(max_length=255, null=True, blank=True, default="Budget")
-    filter_categories = MultiSelectField(choices=CategoryChoices.choices, blank=True)
+    category_mask = models.PositiveIntegerField(default=0) #Filter categories as CATEGORY_BITS, 0 means every category counts
     limit_amount = models.DecimalField(max_digits=10, decimal_places=2)
     current_spending = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     start_date = models.DateField()
     end_date = models.DateField()
+    report_version = models.PositiveIntegerField(default=0) #Bumped whenever the report could change, cached reports are keyed on it
 
-    def update_spending(self): #Update current spending based on linked receipts totals
-        if not self.filter_categories:
-            total_spent = (
-                self.receipts.exclude(total_amount=None)
-                .annotate(total_as_float=Cast("total_amount", FloatField()))
-                .aggregate(total=Sum("total_as_float"))['total'] or 0
-            )
-        else:
-            total_spent = (
-                self.receipts.filter(receipt_category__in=self.filter_categories)
-                .exclude(total_amount=None)
-                .annotate(total_as_float=Cast("total_amount", FloatField()))
-                .aggregate(total=Sum("total_as_float"))['total'] or 0
-            )
-        self.current_spending = total_spent
-        self.save()
+    objects = BudgetQuerySet.as_manager()
+
+    def save(self, *args, **kwargs): #report_version is only ever bumped in SQL, writing back a copy loaded earlier could reuse an old version
+        if self._state.adding:
+            return super().save(*args, **kwargs)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None:
+            update_fields = [field.name for field in self._meta.concrete_fields if not field.primary_key and field.name != "report_version"]
+        if update_fields:
+            update_fields = [*(name for name in update_fields if name != "report_version"), "report_version"]
+            self.report_version = F("report_version") + 1 #Bumped in the same UPDATE, so cached reports of the old name, limit or dates are not used again
+        kwargs["update_fields"] = update_fields
+        super().save(*args, **kwargs)
+        if update_fields:
+            del self.report_version #Deferred, the new value is loaded from the database if it is read
+
+    @property
+    def filter_categories(self): #Category filter as a list of CategoryChoices values
+        return mask_categories(self.category_mask)
+
+    @filter_categories.setter
+    def filter_categories(self, categories):
+        self.category_mask = category_mask(categories)
+
+    def accepts(self, category): #Check if a receipt of this category counts towards the budget
+        return not self.category_mask or bool(self.category_mask & CATEGORY_BITS.get(category, 0))
+
+    def update_spending(self): #Full recompute of current spending from linked receipts, only a fallback as signals.py keeps it up to date with deltas
+        receipts = Receipt.objects.filter(budget=OuterRef("pk")).exclude(total_amount=None)
+        if self.filter_categories:
+            receipts = receipts.filter(receipt_category__in=self.filter_categories)
+        total_spent = receipts.order_by().values("budget").annotate(total=Sum("total_amount")).values("total")
+
+        Budget.objects.filter(pk=self.pk).update( #Sum and write in one statement so a concurrent delta can not be lost in between
+            current_spending=Coalesce(Subquery(total_spent, output_field=DecimalField()), Decimal("0")),
+            report_version=F("report_version") + 1,
+        )
+        User.objects.record_change(self.user_id)
+        self.refresh_from_db(fields=["current_spending", "report_version"])
 
     class Meta:
         verbose_name = "Budget"
         verbose_name_plural = "Budgets"
+        indexes = [
+            models.Index(fields=["user", "start_date", "end_date"], name="budget_user_dates_idx"), #Budget list and matching a receipt date to budgets
+            models.Index(fields=["user", "-start_date", "-id"], name="budget_user_start_idx"), #Budget list pages
+        ]
+
+'''Length of a JSON array column, worked out by the database'''
+class JSONArrayLength(Func):
+    function = "JSON_ARRAY_LENGTH" #SQLite
+    output_field = IntegerField()
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, function="JSONB_ARRAY_LENGTH", **extra_context)
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, function="JSON_LENGTH", **extra_context)
+
+'''Queryset helpers for budget reports'''
+class ReceiptQuerySet(models.QuerySet):
+    def item_count(self): #Items on each receipt, receipts without parsed items count as one
+        return self.annotate(item_count=Coalesce(NullIf(JSONArrayLength("parsed_items"), 0), 1))
+
+    def spending_by_category(self): #One row per category with its spending and item count, biggest spend first
+        return self.item_count().order_by().values("receipt_category").annotate(
+            total=Coalesce(Sum("total_amount"), Decimal("0"), output_field=DecimalField()),
+            items=Sum("item_count"),
+        ).order_by("-total", "receipt_category")
 
 '''Receipt Model'''
 class Receipt(models.Model):
@@ -123,31 +252,179 @@ class Receipt(models.Model):
     parsed_items = models.JSONField(blank=True, null=True)
     transaction_date = models.DateTimeField(blank=True, null=True)
     receipt_category = models.CharField(max_length=50, choices=CategoryChoices.choices, default=CategoryChoices.OTHER)
+    thumbnails = models.JSONField(default=dict, blank=True) #Urls of the smaller renditions of image_url by longest edge, e.g. {"128": url, "512": url}
+
+    objects = ReceiptQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "-uploaded_at", "-id"], name="receipt_user_uploaded_idx"), #Receipt list pages, newest first
+            models.Index(fields=["user", "receipt_category", "-uploaded_at", "-id"], name="receipt_user_category_idx"), #Receipt list pages filtered by category
+        ]
+
+    def save(self, *args, **kwargs): #The stored amount the pre_save signal reads stays locked until post_save has applied the delta, so two edits can not both start from it
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+    def saved_spending(self, with_month=False): #Amount and category as stored in the database, locked for the rest of the transaction when there is one, with_month adds the rollup month
+        receipts = Receipt.objects.filter(pk=self.pk)
+        if transaction.get_connection().in_atomic_block:
+            receipts = receipts.select_for_update()
+        saved = receipts.values_list("total_amount", "receipt_category", "transaction_date", "uploaded_at").first()
+        if saved is None:
+            return (Decimal("0"), self.receipt_category) + ((None,) if with_month else ())
+        return (spending_amount(saved[0]), saved[1]) + ((month_start(saved[2] or saved[3]),) if with_month else ())
+
+    def spending_month(self): #Month the receipt counts in for spending rollups
+        return month_start(self._meta.get_field("transaction_date").to_python(self.transaction_date or self.uploaded_at))
     
-    def assign_to_budget(self):#Assign receipt to relevant budgets based on filtered categories and time of receipt
-        matching_budgets = Budget.objects.filter(
-            user=self.user,
-            start_date__lte=self.transaction_date if self.transaction_date else self.uploaded_at,
-            end_date__gte=self.transaction_date if self.transaction_date else self.uploaded_at,
-        )
-        matching_budgets = matching_budgets.filter( #Check if there are any filter categories, if no then add to budget, if yes see if receipt category is one of the filter categories
-            Q(filter_categories__isnull=True) |
-            Q(filter_categories="") |
-            Q(filter_categories__contains=self.receipt_category)   
-        )
-        
-        current_budgets = self.budget.all()
-        
-        for budget in current_budgets: #Remove from budgets that no longer match
-            if budget not in matching_budgets:
-                self.budget.remove(budget)
-                budget.update_spending()  # Ensure budget reflects changes
-            
-        if matching_budgets.exists():
-            self.budget.set(matching_budgets)
-            self.save()
-            for budget in matching_budgets:
-                budget.update_spending()
-    
+    def assign_to_budget(self):#Assign receipt to relevant budgets based on filtered categories and time of receipt, in a fixed number of queries however many budgets the user has
+        with transaction.atomic():
+            amount, category = self.saved_spending() #Locks the receipt so two assignments of it can not interleave
+            receipt_date = self.transaction_date if self.transaction_date else self.uploaded_at
+            matching_ids = set(Budget.objects.filter(
+                user=self.user_id,
+                start_date__lte=receipt_date,
+                end_date__gte=receipt_date,
+            ).accepting(category).values_list("pk", flat=True)) #Check if there are any filter categories, if no then add to budget, if yes see if receipt category is one of the filter categories
+
+            links = Receipt.budget.through.objects.filter(receipt_id=self.pk)
+            current_ids = set(links.values_list("budget_id", flat=True))
+            added_ids = matching_ids - current_ids
+            removed_ids = current_ids - matching_ids
+
+            #Writing the through rows directly skips the m2m signal, spending is moved below in a single UPDATE instead
+            if removed_ids:
+                links.filter(budget_id__in=removed_ids).delete()
+            if added_ids:
+                Receipt.budget.through.objects.bulk_create(
+                    [Receipt.budget.through(receipt_id=self.pk, budget_id=budget_id) for budget_id in added_ids]
+                )
+            if added_ids or removed_ids:
+                Budget.objects.filter(pk__in=added_ids | removed_ids).record_change(spending_change(
+                    When(pk__in=added_ids, then=Value(amount)), #Matching budgets always accept the category
+                    When(accepts_category(category), then=Value(-amount)),
+                ))
+                User.objects.record_change(self.user_id)
+        getattr(self, "_prefetched_objects_cache", {}).pop("budget", None) #Same as the related manager does after set()
+
+    def __str__(self):
+        return f"Receipt from {self.merchant or 'Unknown Merchant'} uploaded on {self.uploaded_at}"
+
+ROLLUP_FIELDS = ("receipt_total", "receipt_count", "expense_total", "expense_count")
+
+'''Changes to monthly spending rollups waiting to be applied, keyed by month and category'''
+class RollupChanges(dict):
+    def add(self, month, category, **deltas):
+        if month is None: #Undated expenses have no month to count in
+            return
+        cell = self.setdefault((month, category), dict.fromkeys(ROLLUP_FIELDS, 0))
+        for field, delta in deltas.items():
+            cell[field] += delta
+
+    def add_receipt(self, amount, category, month, sign=1):
+        self.add(month, category, receipt_total=sign * amount, receipt_count=sign)
+
+    def add_expense(self, amount, category, month, sign=1):
+        self.add(month, category, expense_total=sign * amount, expense_count=sign)
+
+    @classmethod
+    def for_expenses(cls, expenses): #New expenses written with bulk_create, which sends no signals
+        changes = cls()
+        for expense in expenses:
+            changes.add_expense(spending_amount(expense.amount), expense.category, expense.spending_month())
+        return changes
+
+'''Queryset helpers used to keep monthly spending rollups up to date'''
+class MonthlySpendingQuerySet(models.QuerySet):
+    def apply(self, user_id, changes): #Add RollupChanges to a user's rollups, one UPDATE per changed cell and an INSERT the first time a cell is used
+        for (month, category), deltas in changes.items():
+            if not any(deltas.values()):
+                continue
+            cell = self.filter(user_id=user_id, month=month, category=category)
+            increments = {field: F(field) + delta for field, delta in deltas.items()}
+            if cell.update(**increments) or all(delta <= 0 for delta in deltas.values()): #Only removals and the cell is missing, rollups were never built for it and rebuild_spending_rollups will count it
+                continue
+            try:
+                with transaction.atomic():
+                    self.create(user_id=user_id, month=month, category=category, **deltas)
+            except IntegrityError: #Another request created the cell first
+                cell.update(**increments)
+
+    def rebuild(self, users=None): #Recount the rollups of every user, or only the given ones, from their receipts and expenses
+        receipts = Receipt.objects.order_by()
+        expenses = Expense.objects.exclude(date=None).order_by()
+        rollups = self
+        if users is not None:
+            receipts, expenses, rollups = receipts.filter(user__in=users), expenses.filter(user__in=users), self.filter(user__in=users)
+
+        with transaction.atomic(): #Readers never see the rollups half rebuilt
+            cells = {}
+            def cell(user_id, month, category):
+                key = (user_id, month_start(month), category)
+                return cells.setdefault(key, MonthlySpending(user_id=key[0], month=key[1], category=key[2]))
+
+            for row in receipts.values("user_id", "receipt_category", month=TruncMonth(Coalesce("transaction_date", "uploaded_at"))).annotate(
+                total=Coalesce(Sum("total_amount"), Decimal("0"), output_field=DecimalField()), count=Count("id"),
+            ):
+                rollup = cell(row["user_id"], row["month"], row["receipt_category"])
+                rollup.receipt_total, rollup.receipt_count = row["total"], row["count"]
+            for row in expenses.values("user_id", "category", month=TruncMonth("date")).annotate(total=Sum("amount"), count=Count("id")):
+                rollup = cell(row["user_id"], row["month"], row["category"])
+                rollup.expense_total, rollup.expense_count = row["total"], row["count"]
+
+            rollups.delete()
+            self.bulk_create(cells.values(), batch_size=1000)
+        return len(cells)
+
+'''Spending per user, month and category, kept up to date by signals.py so time series never scan receipts or expenses'''
+class MonthlySpending(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="monthly_spending")
+    month = models.DateField() #First day of the month
+    category = models.CharField(max_length=50, choices=CategoryChoices.choices)
+    receipt_total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    receipt_count = models.IntegerField(default=0)
+    expense_total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    expense_count = models.IntegerField(default=0)
+
+    objects = MonthlySpendingQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = "Monthly Spending"
+        verbose_name_plural = "Monthly Spending"
+        constraints = [
+            models.UniqueConstraint(fields=["user", "month", "category"], name="monthlyspending_user_month_category_uniq"), #Also the index for time series ranges
+        ]
+
+    def __str__(self):
+        return f"{self.category} spending in {self.month:%Y-%m}"
+
+'''Background receipt processing job, created when a scan is submitted in job mode'''
+class ReceiptJob(models.Model):
+    class Status(models.TextChoices):
+        PENDING = "pending", "Pending"
+        RUNNING = "running", "Running"
+        SUCCEEDED = "succeeded", "Succeeded"
+        FAILED = "failed", "Failed"
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="receipt_jobs")
+    status = models.CharField(max_length=20, choices=Status.choices, default=Status.PENDING)
+    image_path = models.CharField(max_length=255, blank=True, null=True) #Uploaded image stashed in default storage until a worker picks it up
+    image_url = models.URLField(max_length=500, blank=True, null=True)
+    receipt = models.ForeignKey(Receipt, on_delete=models.SET_NULL, blank=True, null=True, related_name="jobs")
+    error = models.TextField(blank=True, null=True)
+    attempts = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(default=now)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        verbose_name = "Receipt Job"
+        verbose_name_plural = "Receipt Jobs"
+        indexes = [
+            models.Index(fields=["status", "created_at"], name="receiptjob_status_created_idx"),
+        ]
+
     def __str__(self):
-        return f"Receipt from {self.merchant or 'Unknown Merchant'} uploaded on {self.uploaded_at}"
\ No newline at end of file
+        return f"Receipt job {self.id} ({self.status})"
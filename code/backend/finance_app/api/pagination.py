@@ -0,0 +1,134 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from django.core.exceptions import ValidationError
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+import json
+
+'''Keyset pagination, each page continues after the last row of the one before so deep pages cost the same as the first.
+The view sets keyset_ordering, e.g. ('-uploaded_at', '-id'), which must end in a unique field and should match an index.
+Pages are only used when the client sends page_size or cursor, clients that expect a plain list keep getting one'''
+class KeysetPagination(BasePagination):
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = 50
+    max_page_size = 200
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        params = request.query_params
+        if self.cursor_query_param not in params and self.page_size_query_param not in params:
+            return None
+
+        self.request = request
+        self.ordering = view.keyset_ordering
+        self.fields = [queryset.model._meta.get_field(name.lstrip('-')) for name in self.ordering]
+        self.page_size = self.get_page_size(request)
+
+        queryset = queryset.order_by(*self.order_by())
+        cursor = params.get(self.cursor_query_param)
+        if cursor:
+            queryset = queryset.filter(self.after(self.decode_cursor(cursor)))
+
+        rows = list(queryset[:self.page_size + 1]) #One extra row tells us if there is another page, no COUNT needed
+        self.has_next = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def order_by(self): #Nulls always sort last so the cursor filter is the same on every database
+        return [
+            F(name[1:]).desc(nulls_last=True) if name.startswith('-') else F(name).asc(nulls_last=True)
+            for name in self.ordering
+        ]
+
+    def after(self, values): #Rows that sort after the cursor, (a, b) > (x, y) spelt out as (a > x) or (a = x and b > y)
+        condition = Q(pk__in=[])
+        equal = Q()
+        for name, field, value in zip(self.ordering, self.fields, values):
+            if value is not None: #Nulls sort last, so nothing comes after a null on this key
+                later = Q(**{f"{field.name}__{'lt' if name.startswith('-') else 'gt'}": value})
+                if field.null:
+                    later |= Q(**{f"{field.name}__isnull": True})
+                condition |= equal & later
+            equal &= Q(**{f"{field.name}__isnull": True}) if value is None else Q(**{field.name: value})
+
+        name, field, value = self.ordering[0], self.fields[0], values[0]
+        if value is not None and not field.null: #Same rows, but a range on the leading key lets the database seek in the index instead of stepping over earlier pages
+            condition &= Q(**{f"{field.name}__{'lte' if name.startswith('-') else 'gte'}": value})
+        return condition
+
+    def encode_cursor(self, row):
+        values = [field.value_to_string(row) if getattr(row, field.attname) is not None else None for field in self.fields]
+        return urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            values = json.loads(urlsafe_b64decode(cursor.encode()))
+            if not isinstance(values, list) or len(values) != len(self.fields):
+                raise ValueError
+            return [field.to_python(value) if value is not None else None for field, value in zip(self.fields, values)]
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.page_size_query_param, self.page_size)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_first_link(self):
+        return remove_query_param(self.request.build_absolute_uri(), self.cursor_query_param)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'first': self.get_first_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'first': {'type': 'string', 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+'''Keyset pagination for ranked search hits, the cursor is the rank and id of the last hit so equal ranks still page in a fixed order.
+Instead of a queryset the view passes a callable taking after and limit that returns (id, rank) pairs, best first.
+Where the rank depends on the rest of the index, as bm25 does in SQLite, writes between two pages can shift the order and a hit may repeat or be skipped'''
+class RankedPagination(KeysetPagination):
+    page_size = 20
+
+    def paginate_queryset(self, search, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        cursor = request.query_params.get(self.cursor_query_param)
+        hits = search(after=self.decode_cursor(cursor) if cursor else None, limit=self.page_size + 1)
+        self.has_next = len(hits) > self.page_size
+        self.page = hits[:self.page_size]
+        return self.page
+
+    def encode_cursor(self, hit):
+        receipt_id, rank = hit
+        return urlsafe_b64encode(json.dumps([rank, receipt_id]).encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            rank, hit_id = json.loads(urlsafe_b64decode(cursor.encode()))
+            return float(rank), int(hit_id)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
@@ -0,0 +1,107 @@
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
+import pickle
+import tempfile
+
+XLSX_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+SPOOL_BYTES = 4 * 1024 * 1024 #Receipt rows are kept in memory up to this size while column widths are worked out, then spill to disk
+RECEIPT_HEADERS = ["ID", "Merchant", "Total Amount", "Transaction Date", "Category", "Item Name", "Item Price"]
+RECEIPT_FIELDS = ("id", "merchant", "total_amount", "transaction_date", "uploaded_at", "receipt_category", "parsed_items")
+
+'''Widest value seen in each column, tracked as rows are written so no second pass over the cells is needed'''
+class ColumnWidths:
+    def __init__(self):
+        self.widths = {}
+
+    def track(self, row):
+        for index, value in enumerate(row, start=1):
+            if value:
+                self.widths[index] = max(self.widths.get(index, 0), len(str(value)))
+        return row
+
+    def apply(self, worksheet): #Must run before the first row of a write-only sheet, its column widths are written first
+        for index, width in self.widths.items():
+            worksheet.column_dimensions[get_column_letter(index)].width = width + 2
+
+'''Name and price of a parsed item as shown in the export'''
+def item_cells(item):
+    item_name = item.get("description", {}).get("value", "Unknown Item")
+    item_price = float(item.get("total_price", {}).get("value", "0.00"))
+    return [item_name, f"{item_price:.2f}"]
+
+'''Rows of the receipts sheet, the first item shares the receipt's row and the rest get a row each'''
+def receipt_rows(receipts):
+    for receipt in receipts:
+        transaction_date = receipt.transaction_date or receipt.uploaded_at
+        row = [
+            receipt.id,
+            receipt.merchant,
+            f"{receipt.total_amount:.2f}" if receipt.total_amount is not None else "",
+            transaction_date.strftime('%d/%m/%Y'),
+            receipt.receipt_category,
+        ]
+        items = receipt.parsed_items if isinstance(receipt.parsed_items, list) else []
+        yield row + (item_cells(items[0]) if items else ["No Items", "-"])
+        for item in items[1:]:
+            yield ["", "", "", "", ""] + item_cells(item)
+
+'''Add a write-only sheet with a bold header row, widths are worked out from the rows unless they were tracked already'''
+def write_sheet(workbook, title, headers, rows, widths=None):
+    if widths is None: #Small sheets, the rows are already in memory
+        rows = list(rows)
+        widths = ColumnWidths()
+        for row in [headers] + rows:
+            widths.track(row)
+
+    worksheet = workbook.create_sheet(title=title)
+    widths.apply(worksheet)
+    bold_font = Font(bold=True)
+    header_cells = []
+    for header in headers:
+        cell = WriteOnlyCell(worksheet, value=header)
+        cell.font = bold_font
+        header_cells.append(cell)
+    worksheet.append(header_cells)
+    for row in rows:
+        worksheet.append(row)
+    return worksheet
+
+'''Write rows to a temporary file while tracking widths, then replay them, memory stays flat however many rows there are'''
+def write_spooled_sheet(workbook, title, headers, rows):
+    widths = ColumnWidths()
+    widths.track(headers)
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES) as spool:
+        for row in rows:
+            pickle.dump(widths.track(row), spool, protocol=pickle.HIGHEST_PROTOCOL)
+        spool.seek(0)
+
+        def replay():
+            while True:
+                try:
+                    yield pickle.load(spool)
+                except EOFError:
+                    return
+
+        return write_sheet(workbook, title, headers, replay(), widths)
+
+'''Write the budget report workbook to output using openpyxl write-only mode, receipts can be any iterable such as queryset.iterator()'''
+def write_budget_report_xlsx(output, budget, summary, receipts):
+    workbook = Workbook(write_only=True)
+
+    summary_headers = ["Budget Name", "User", "Limit Amount", "Total Spent", "Start Date", "End Date"]
+    summary_values = [
+        budget.name, budget.user.email, f"{budget.limit_amount:.2f}",
+        f"{budget.current_spending:.2f}", budget.start_date.strftime('%d-%m-%Y'), budget.end_date.strftime('%d-%m-%Y')
+    ]
+    write_sheet(workbook, "Budget Summary", summary_headers, [summary_values])
+
+    breakdown_rows = [
+        [category, f"{amount:.2f}", summary["category_items"][category]]
+        for category, amount in summary["category_spending"].items()
+    ]
+    write_sheet(workbook, "Spending Breakdown", ["Category", "Total Spent", "Item Count"], breakdown_rows)
+
+    write_spooled_sheet(workbook, "Receipts", RECEIPT_HEADERS, receipt_rows(receipts))
+    workbook.save(output)
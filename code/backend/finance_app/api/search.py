@@ -0,0 +1,115 @@
+from django.db import connection
+from django.db.models import Q
+from .models import Receipt
+import re
+
+SEARCH_TABLE = "api_receipt_search"
+MAX_TERMS = 8
+TERM = re.compile(r"[^\W_]+") #Letters and digits only, so what a user types can never change the query syntax
+
+'''Words to search for, lower cased'''
+def search_terms(query):
+    return TERM.findall(query.lower())[:MAX_TERMS]
+
+'''Line item descriptions of a receipt, one per line'''
+def item_text(parsed_items):
+    if not isinstance(parsed_items, list):
+        return ""
+    descriptions = (item["description"].get("value") for item in parsed_items if isinstance(item, dict) and isinstance(item.get("description"), dict))
+    return "\n".join(str(description) for description in descriptions if description)
+
+'''Words of a text as FTS5 tokens owned by one user, u<user id>x<word>. A user's search then only reads that user's postings
+rather than every account's matches for the word'''
+def user_tokens(user_id, text):
+    return " ".join(f"u{user_id}x{word}" for word in TERM.findall(text.lower()))
+
+'''Index of receipt merchants and line items. Hits are (receipt id, rank) pairs, a lower rank is a better match'''
+class SearchIndex:
+    def update(self, receipt): #Add the receipt or replace what is indexed for it
+        raise NotImplementedError
+
+    def delete(self, receipt_id):
+        raise NotImplementedError
+
+    def hits(self, user_id, terms, after=None, limit=20): #Best matches first, after is the (rank, id) of the last hit of the page before
+        raise NotImplementedError
+
+'''SQLite FTS5 table, a merchant match weighs ten times an item match. Words are stored as user_tokens so every lookup is scoped to one user.
+bm25 still takes the row count and average length from the whole table, so ranks can move a little while other users add receipts
+and a later page may then repeat or skip a hit'''
+class SQLiteSearchIndex(SearchIndex):
+    def update(self, receipt):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT OR REPLACE INTO {SEARCH_TABLE} (rowid, merchant, items, user_id) VALUES (%s, %s, %s, %s)",
+                [receipt.pk, user_tokens(receipt.user_id, receipt.merchant or ""), user_tokens(receipt.user_id, item_text(receipt.parsed_items)), receipt.user_id],
+            )
+
+    def delete(self, receipt_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [receipt_id])
+
+    def hits(self, user_id, terms, after=None, limit=20):
+        match = " ".join(f'"{user_tokens(user_id, term)}"*' for term in terms) #Every word, each as a prefix of this user's tokens
+        sql = f"SELECT rowid, bm25({SEARCH_TABLE}, 10.0, 1.0) AS rank FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s AND user_id = %s"
+        params = [match, user_id]
+        if after is not None:
+            sql = f"SELECT rowid, rank FROM ({sql}) WHERE rank > %s OR (rank = %s AND rowid > %s)"
+            params += [after[0], after[0], after[1]]
+        with connection.cursor() as cursor:
+            cursor.execute(f"{sql} ORDER BY rank, rowid LIMIT %s", params + [limit])
+            return cursor.fetchall()
+
+'''Postgres tsvector table with a btree_gin index on (user_id, document), so a search only visits the user's entries. Merchants are weighted A and items B.
+ts_rank_cd only looks at the document itself, so ranks and cursors do not move when other users write'''
+class PostgresSearchIndex(SearchIndex):
+    def update(self, receipt):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {SEARCH_TABLE} (receipt_id, user_id, document) "
+                "VALUES (%s, %s, setweight(to_tsvector('simple', %s), 'A') || setweight(to_tsvector('simple', %s), 'B')) "
+                "ON CONFLICT (receipt_id) DO UPDATE SET user_id = EXCLUDED.user_id, document = EXCLUDED.document",
+                [receipt.pk, receipt.user_id, receipt.merchant or "", item_text(receipt.parsed_items)],
+            )
+
+    def delete(self, receipt_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE receipt_id = %s", [receipt_id])
+
+    def hits(self, user_id, terms, after=None, limit=20):
+        sql = (
+            f"SELECT receipt_id, -ts_rank_cd(document, query)::float8 AS rank FROM {SEARCH_TABLE}, to_tsquery('simple', %s) query "
+            "WHERE user_id = %s AND document @@ query"
+        )
+        params = [" & ".join(f"{term}:*" for term in terms), user_id]
+        if after is not None:
+            sql = f"SELECT receipt_id, rank FROM ({sql}) hits WHERE rank > %s OR (rank = %s AND receipt_id > %s)"
+            params += [after[0], after[0], after[1]]
+        with connection.cursor() as cursor:
+            cursor.execute(f"{sql} ORDER BY rank, receipt_id LIMIT %s", params + [limit])
+            return cursor.fetchall()
+
+'''Fallback for other databases, nothing is indexed and merchants are matched with LIKE, every hit ranks the same'''
+class UnindexedSearch(SearchIndex):
+    def update(self, receipt):
+        pass
+
+    def delete(self, receipt_id):
+        pass
+
+    def hits(self, user_id, terms, after=None, limit=20):
+        receipts = Receipt.objects.filter(user_id=user_id)
+        for term in terms:
+            receipts = receipts.filter(Q(merchant__icontains=term))
+        if after is not None:
+            receipts = receipts.filter(pk__gt=after[1])
+        return [(receipt_id, 0.0) for receipt_id in receipts.order_by("pk").values_list("pk", flat=True)[:limit]]
+
+SEARCH_INDEXES = {
+    "sqlite": SQLiteSearchIndex,
+    "postgresql": PostgresSearchIndex,
+}
+
+'''Search index for the database in use'''
+def search_index():
+    return SEARCH_INDEXES.get(connection.vendor, UnindexedSearch)()
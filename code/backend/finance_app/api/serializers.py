@@ -30,6 +30,19 @@ class ExpenseSerializer(serializers.ModelSerializer):
         fields = ['id', 'user', 'name', 'amount', 'category', 'date', 'vendor']
         read_only_fields = ['user']
 
+'''Serializer for monthly spending rollups'''
+class MonthlySpendingSerializer(serializers.ModelSerializer):
+    month = serializers.DateField(format="%Y-%m")
+
+    class Meta:
+        model = MonthlySpending
+        fields = ['month', 'category', 'receipt_total', 'receipt_count', 'expense_total', 'expense_count']
+
+'''Serializer for monthly spending summed over every category'''
+class MonthlySpendingTotalSerializer(MonthlySpendingSerializer):
+    class Meta(MonthlySpendingSerializer.Meta):
+        fields = ['month', 'receipt_total', 'receipt_count', 'expense_total', 'expense_count']
+
 '''Serializer for receipts'''
 class ReceiptSerializer(serializers.ModelSerializer):
     transaction_date = serializers.DateTimeField(format="%d-%m-%Y", required=False) #Formats transaction date
@@ -37,12 +50,32 @@ class ReceiptSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Receipt
-        fields = ['id', 'user', 'image_url', 'merchant', 'total_amount','transaction_date', 'parsed_items', 'receipt_category', 'uploaded_at']
-        read_only_fields = ['user']
+        fields = ['id', 'user', 'image_url', 'thumbnails', 'merchant', 'total_amount','transaction_date', 'parsed_items', 'receipt_category', 'uploaded_at']
+        read_only_fields = ['user', 'thumbnails']
+
+'''Drops fields the request did not ask for, using the fields and expand lists the view puts in the context'''
+class SparseFieldsMixin:
+    expandable_fields = () #Nested fields that are only sent when expanded
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for name in list(self.fields):
+            if not self.includes_field(name, self.context):
+                self.fields.pop(name)
+
+    @classmethod
+    def includes_field(cls, name, context): #Check if a field will be serialised, without context every field is
+        fields, expand = context.get('fields'), context.get('expand')
+        if fields and name not in fields:
+            return False
+        if name in cls.expandable_fields and expand is not None:
+            return name in expand or bool(fields)
+        return True
 
 '''Serializer for budgets'''
-class BudgetSerializer(serializers.ModelSerializer):
+class BudgetSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     receipts = ReceiptSerializer(many=True, read_only=True) #Includes receipts under the budget
+    expandable_fields = ('receipts',)
     start_date = serializers.DateField(format="%d-%m-%Y") #Formats start date
     end_date = serializers.DateField(format="%d-%m-%Y") #Formats end date
     filter_categories = serializers.MultipleChoiceField(choices=CategoryChoices.choices) #Budget category filters
@@ -52,3 +85,12 @@ class BudgetSerializer(serializers.ModelSerializer):
         fields = ['id', 'user', 'name', 'filter_categories', 'limit_amount', 'current_spending', 'start_date', 'end_date', 'receipts']
         read_only_fields = ['user']
 
+
+'''Serializer for receipt processing jobs'''
+class ReceiptJobSerializer(serializers.ModelSerializer):
+    receipt = ReceiptSerializer(read_only=True) #Includes the receipt once the job has succeeded
+
+    class Meta:
+        model = ReceiptJob
+        fields = ['id', 'status', 'receipt', 'error', 'attempts', 'created_at', 'started_at', 'finished_at']
+        read_only_fields = fields
@@ -0,0 +1,130 @@
+'''Keeps Budget.current_spending up to date with atomic deltas as receipts join or leave budgets, or their amount or category changes.
+Every change also bumps Budget.report_version so cached reports of the affected budgets are no longer used.
+Monthly spending rollups are moved by the same kind of deltas as receipts and expenses are saved and deleted,
+and the receipt search index is updated one receipt at a time.
+Last of all the owner's data version is bumped, so conditional GETs stop matching once every other change is in place'''
+from django.db.models import F, Sum, Value, When
+from django.db.models.signals import m2m_changed, pre_save, post_save, pre_delete, post_delete
+from django.dispatch import receiver
+from .models import Budget, Expense, MonthlySpending, Receipt, RollupChanges, User, accepts_category, spending_amount, spending_change
+from .search import search_index
+
+SEARCHED_FIELDS = {"merchant", "parsed_items", "user"}
+
+@receiver(pre_save, sender=Receipt)
+def remember_receipt_before_save(sender, instance, raw, **kwargs):
+    if raw or instance._state.adding:
+        instance._spending_before_save = None
+        return
+    instance._spending_before_save = instance.saved_spending(with_month=True)
+
+@receiver(post_save, sender=Receipt)
+def apply_receipt_change(sender, instance, created, raw, **kwargs):
+    before = getattr(instance, "_spending_before_save", None)
+    instance._spending_before_save = None
+    if raw:
+        return
+    new_amount, new_category = spending_amount(instance.total_amount), instance.receipt_category
+    changes = RollupChanges()
+    changes.add_receipt(new_amount, new_category, instance.spending_month())
+    if before is not None:
+        changes.add_receipt(*before, sign=-1)
+    MonthlySpending.objects.apply(instance.user_id, changes)
+    if created or before is None: #New receipts have no budgets yet, they are counted when linked
+        return
+
+    old_amount, old_category, _ = before
+    Budget.objects.filter(receipts=instance).record_change(spending_change( #Any edit can change the reports, so this runs even when the amount did not move
+        When(accepts_category(old_category) & accepts_category(new_category), then=Value(new_amount - old_amount)),
+        When(accepts_category(old_category), then=Value(-old_amount)), #The receipt stops counting in budgets with category filters
+        When(accepts_category(new_category), then=Value(new_amount)), #or starts counting
+    ))
+
+@receiver(pre_delete, sender=Receipt)
+def remove_deleted_receipt(sender, instance, **kwargs):
+    amount, category, month = instance.saved_spending(with_month=True)
+    Budget.objects.filter(receipts=instance).record_change(spending_change(When(accepts_category(category), then=Value(-amount))))
+    changes = RollupChanges()
+    changes.add_receipt(amount, category, month, sign=-1)
+    MonthlySpending.objects.apply(instance.user_id, changes)
+
+@receiver(post_save, sender=Receipt)
+def index_receipt(sender, instance, raw, update_fields, **kwargs):
+    if raw or (update_fields is not None and not SEARCHED_FIELDS & set(update_fields)):
+        return
+    search_index().update(instance)
+
+@receiver(post_delete, sender=Receipt)
+def unindex_receipt(sender, instance, **kwargs):
+    search_index().delete(instance.pk)
+
+@receiver(pre_save, sender=Expense)
+def remember_expense_before_save(sender, instance, raw, **kwargs):
+    instance._spending_before_save = None if raw or instance._state.adding else instance.saved_spending()
+
+@receiver(post_save, sender=Expense)
+def apply_expense_change(sender, instance, raw, **kwargs):
+    before = getattr(instance, "_spending_before_save", None)
+    instance._spending_before_save = None
+    if raw:
+        return
+    changes = RollupChanges()
+    changes.add_expense(spending_amount(instance.amount), instance.category, instance.spending_month())
+    if before is not None:
+        changes.add_expense(*before, sign=-1)
+    MonthlySpending.objects.apply(instance.user_id, changes)
+
+@receiver(pre_delete, sender=Expense)
+def remove_deleted_expense(sender, instance, **kwargs):
+    changes = RollupChanges()
+    changes.add_expense(*instance.saved_spending(), sign=-1)
+    MonthlySpending.objects.apply(instance.user_id, changes)
+
+@receiver(m2m_changed, sender=Receipt.budget.through)
+def apply_budget_link_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "pre_remove", "pre_clear", "post_clear"): #Removals are applied before the rows go so only real links are counted
+        return
+    if action in ("post_add", "pre_remove") and not pk_set:
+        return
+
+    if not reverse: #receipt.budget.add/remove/clear
+        if action == "post_clear":
+            return
+        amount, category = instance.saved_spending()
+        if action == "post_add":
+            budgets = Budget.objects.filter(pk__in=pk_set) #Django only passes the ids that were actually added
+        else:
+            budgets = Budget.objects.filter(receipts=instance)
+            if action == "pre_remove":
+                budgets = budgets.filter(pk__in=pk_set)
+        budgets.record_change(spending_change(When(accepts_category(category), then=Value(amount if action == "post_add" else -amount))))
+        return
+
+    #budget.receipts.add/remove/clear
+    budget = Budget.objects.filter(pk=instance.pk)
+    if action == "post_clear":
+        budget.update(current_spending=0, report_version=F("report_version") + 1)
+        return
+    if action == "pre_clear":
+        return
+
+    receipts = Receipt.objects.filter(pk__in=pk_set)
+    if action == "pre_remove":
+        receipts = receipts.filter(budget=instance)
+    if instance.filter_categories:
+        receipts = receipts.filter(receipt_category__in=instance.filter_categories)
+    total = spending_amount(receipts.aggregate(total=Sum("total_amount"))["total"])
+    budget.record_change(Value(total if action == "post_add" else -total))
+
+#Connected after every other handler so the version moves once the data it describes has
+@receiver([post_save, post_delete], sender=Receipt)
+@receiver([post_save, post_delete], sender=Expense)
+@receiver([post_save, post_delete], sender=Budget)
+def record_user_data_change(sender, instance, raw=False, **kwargs):
+    if not raw:
+        User.objects.record_change(instance.user_id)
+
+@receiver(m2m_changed, sender=Receipt.budget.through)
+def record_budget_link_change(sender, instance, action, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear"):
+        User.objects.record_change(instance.user_id)
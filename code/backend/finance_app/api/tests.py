@@ -1,10 +1,51 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.db.migrations.executor import MigrationExecutor
 from rest_framework.test import APIClient
+from django.test import AsyncClient
+from asgiref.sync import sync_to_async, async_to_sync
 from rest_framework import status
+from django.test import override_settings
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from unittest import mock, skipUnless
 from .models import *
+from .views import ImageDownloadError, save_receipt_data
+from .caching import analysis_cache
+from .fetching import fetch_image, afetch_image
+from .jobs import FAILED_JOB_ERROR, claim_job, submit_receipt_job
+from .exports import ITEM_COLUMNS
+from .backends import get_receipt_storage, get_receipt_analyzer, AzureBlobReceiptStorage, AzureReceiptAnalyzer, LoopClients, close_loop_clients, close_loop_clients_on_shutdown, native_aio
+from . import imaging
 from datetime import date
+from decimal import Decimal
 import openpyxl
+from PIL import Image
+from django.core.cache import caches
+from django.db import connection
+from django.db.models import Sum
+from django.test.utils import CaptureQueriesContext
+from .pagination import KeysetPagination
+from datetime import timedelta
+from django.utils.timezone import make_aware
+import datetime as dt
+import itertools
+import os
+import re
+import signal
+import base64
+import csv
+import json
+import zipfile
+from azure.ai.documentintelligence.models import AnalyzeResult
+from azure.core.pipeline.transport import AsyncHttpTransport
+from azure.core.rest._http_response_impl_async import AsyncHttpResponseImpl
+from azure.core.utils import CaseInsensitiveDict
 from io import BytesIO
+import tempfile
+import threading
+from io import StringIO
+from django.core.management import call_command
+from django.core.files.storage import default_storage
 
 class UserTests(TestCase):
     def setUp(self): #Create test user
@@ -22,6 +63,108 @@ class UserTests(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIn('Authorization', response.data) #Check if authorization is returned
 
+class AuthenticationTests(TestCase):
+    def setUp(self): #Create test user and start with no remembered credentials
+        caches['basic-auth'].clear()
+        self.user = User.objects.create_user(email="test@test.com",password="test12345",full_name="test",date_of_birth="2004-09-07")
+        self.client = APIClient()
+
+    def login(self):
+        return self.client.post('/login/', {'email': 'test@test.com', 'password': 'test12345'}).data
+
+    def test_login_returns_tokens(self): #Check if login hands out a JWT pair that authenticates requests
+        data = self.login()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {data['access']}")
+        with mock.patch.object(User, 'check_password') as mock_check:
+            response = self.client.get('/api/receipts/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        mock_check.assert_not_called()
+
+        response = self.client.post('/api/token/refresh/', {'refresh': data['refresh']})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('access', response.data)
+
+    def test_basic_credentials_hashed_once(self): #Check if repeat Basic requests skip the password hash
+        self.client.credentials(HTTP_AUTHORIZATION=self.login()['Authorization'])
+        with mock.patch.object(User, 'check_password', autospec=True, side_effect=User.check_password) as mock_check:
+            for _ in range(3):
+                self.assertEqual(self.client.get('/api/receipts/').status_code, status.HTTP_200_OK)
+        self.assertEqual(mock_check.call_count, 1)
+
+    def test_wrong_password_not_cached(self): #Check if a bad password is rejected every time
+        self.client.credentials(HTTP_AUTHORIZATION="Basic " + base64.b64encode(b"test@test.com:wrong").decode())
+        for _ in range(2):
+            self.assertEqual(self.client.get('/api/receipts/').status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_password_change_drops_cached_credentials(self): #Check if the old password stops working as soon as it is changed
+        self.client.credentials(HTTP_AUTHORIZATION=self.login()['Authorization'])
+        self.assertEqual(self.client.get('/api/receipts/').status_code, status.HTTP_200_OK)
+        self.user.set_password("new-password")
+        self.user.save()
+        self.assertEqual(self.client.get('/api/receipts/').status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_cache_never_holds_password(self): #Check if only a digest of the credentials is used as the key
+        self.client.credentials(HTTP_AUTHORIZATION=self.login()['Authorization'])
+        self.client.get('/api/receipts/')
+        stored = repr(dict(caches['basic-auth']._cache))
+        self.assertNotIn("test12345", stored)
+        self.assertNotIn("test@test.com", stored)
+
+class ConditionalGetTests(TestCase):
+    def setUp(self): #Create test user signed in with a JWT so every request loads the current user
+        caches['budget-reports'].clear() #Budget ids repeat between tests
+        self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
+        self.client = APIClient()
+        access = self.client.post('/login/', {'email': 'test@test.com', 'password': 'test12345'}).data['access']
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {access}")
+        self.budget = Budget.objects.create(user=self.user, name="Trip", limit_amount=500.00, start_date="2024-02-01", end_date="2024-02-28")
+
+    def test_unchanged_list_not_modified(self): #Check if a repeat request with the ETag is answered before the list is queried
+        response = self.client.get('/api/budgets/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response["ETag"].startswith('W/"'))
+        self.assertIn("Last-Modified", response)
+
+        with self.assertNumQueries(1): #Loading the user for authentication
+            response = self.client.get('/api/budgets/', HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_any_write_changes_etag(self): #Check if writes to receipts, budgets or expenses all invalidate the ETag
+        writes = [
+            lambda: Expense.objects.create(user=self.user, name="Taxi", amount=15.00, date="2024-02-11"),
+            lambda: Receipt.objects.create(user=self.user, merchant="Tesco", total_amount=5.00, transaction_date=make_aware(dt.datetime(2024, 2, 10))).assign_to_budget(),
+            lambda: self.client.patch(f'/api/budgets/{self.budget.id}/', {'name': 'Holiday'}, format='json'),
+            lambda: self.budget.receipts.clear(),
+            lambda: Receipt.objects.filter(user=self.user).delete(),
+        ]
+        etag = self.client.get(f'/api/budgets/{self.budget.id}/')["ETag"]
+        for write in writes:
+            write()
+            response = self.client.get(f'/api/budgets/{self.budget.id}/', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            etag = response["ETag"]
+
+    def test_reports_not_modified(self): #Check if report endpoints answer 304 while the budget is unchanged
+        for url in [f'/api/budget-report/{self.budget.id}/', f'/api/budget-report/{self.budget.id}/xlsx/', '/api/analytics/timeseries/']:
+            etag = self.client.get(url)["ETag"]
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_etag_is_per_user(self): #Check if one user's ETag never matches for another user
+        etag = self.client.get('/api/expenses/')["ETag"]
+        other = User.objects.create_user(email="other@test.com", password="test12345",full_name="other",date_of_birth="2004-09-07")
+        client = APIClient()
+        client.force_authenticate(user=other)
+        self.assertEqual(client.get('/api/expenses/', HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+    def test_profile_save_keeps_version(self): #Check if saving a user loaded before a change does not roll the version back
+        stale = User.objects.get(pk=self.user.pk)
+        Expense.objects.create(user=self.user, name="Taxi", amount=15.00, date="2024-02-11")
+        stale.full_name = "Renamed"
+        stale.save()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.data_version, 2) #Budget and expense created
+        self.assertEqual(self.user.full_name, "Renamed")
+
 class ExpenseTests(TestCase):
     def setUp(self): #Create test user and expense
         self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
@@ -105,6 +248,392 @@ class BudgetTests(TestCase):
         
         self.assertEqual(self.budget.current_spending, 20.00) #Only receipt1 should be counted
 
+    def test_filter_categories_stored_as_mask(self): #Check if the category filter round trips through the bitmask
+        self.budget.refresh_from_db()
+        self.assertEqual(self.budget.category_mask, CATEGORY_BITS[CategoryChoices.MEAL.value] | CATEGORY_BITS[CategoryChoices.ENTERTAINMENT.value])
+        self.assertEqual(self.budget.filter_categories, [CategoryChoices.MEAL.value, CategoryChoices.ENTERTAINMENT.value])
+        self.assertTrue(self.budget.accepts(CategoryChoices.MEAL.value))
+        self.assertFalse(self.budget.accepts(CategoryChoices.HEALTHCARE.value))
+        self.assertEqual(list(Budget.objects.accepting(CategoryChoices.ENTERTAINMENT.value)), [self.budget])
+        self.assertEqual(list(Budget.objects.accepting(CategoryChoices.FUEL.value)), [])
+
+    def test_filter_categories_api_shape(self): #Check if the API still takes and returns a list of category names
+        response = self.client.post('/api/budgets/', {
+            'name': "Travel",
+            'limit_amount': 100.00,
+            'start_date': "2024-02-01",
+            'end_date': "2024-02-28",
+            'filter_categories': [CategoryChoices.FUEL.value, CategoryChoices.HOTEL.value],
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertCountEqual(response.data['filter_categories'], [CategoryChoices.FUEL.value, CategoryChoices.HOTEL.value])
+        self.assertEqual(Budget.objects.get(pk=response.data['id']).category_mask, CATEGORY_BITS[CategoryChoices.FUEL.value] | CATEGORY_BITS[CategoryChoices.HOTEL.value])
+
+        response = self.client.get('/api/budgets/', {'filter_categories': CategoryChoices.MEAL.value})
+        self.assertEqual([budget['id'] for budget in response.data], [self.budget.id])
+        self.assertCountEqual(response.data[0]['filter_categories'], [CategoryChoices.MEAL.value, CategoryChoices.ENTERTAINMENT.value])
+
+class BudgetCategoryMaskMigrationTests(TransactionTestCase):
+    migrate_from = [('api', '0003_hot_query_indexes')]
+    migrate_to = [('api', '0004_budget_category_mask')]
+
+    def tearDown(self): #Leave the database on the latest migration for the other tests
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def test_categories_converted_to_mask(self): #Check if comma separated categories become the same bits and convert back
+        apps = self.migrate(self.migrate_from)
+        OldUser = apps.get_model('api', 'User')
+        OldBudget = apps.get_model('api', 'Budget')
+        user = OldUser.objects.create(email="test@test.com", full_name="test")
+        filtered = OldBudget.objects.create(user=user, name="Food", limit_amount=100, start_date="2024-02-01", end_date="2024-02-28", filter_categories=["Meal", "Healthcare"])
+        unfiltered = OldBudget.objects.create(user=user, name="All", limit_amount=100, start_date="2024-02-01", end_date="2024-02-28")
+
+        apps = self.migrate(self.migrate_to)
+        NewBudget = apps.get_model('api', 'Budget')
+        self.assertEqual(NewBudget.objects.get(pk=filtered.pk).category_mask, CATEGORY_BITS["Meal"] | CATEGORY_BITS["Healthcare"])
+        self.assertEqual(NewBudget.objects.get(pk=unfiltered.pk).category_mask, 0)
+
+        apps = self.migrate(self.migrate_from)
+        self.assertEqual(sorted(apps.get_model('api', 'Budget').objects.get(pk=filtered.pk).filter_categories), ["Healthcare", "Meal"])
+
+class BudgetListingTests(TestCase):
+    def setUp(self): #Create test user with overlapping budgets that share receipts
+        self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.add_budgets(3)
+
+    def add_budgets(self, count): #Budgets covering February, each receipt lands in all of them
+        for i in range(count):
+            Budget.objects.create(user=self.user, name=f"Budget {i}", limit_amount=500.00, start_date="2024-02-01", end_date="2024-02-28")
+        receipt = Receipt.objects.create(user=self.user, merchant="Nandos", total_amount=20.00, transaction_date="2024-02-10", receipt_category=CategoryChoices.MEAL.value)
+        receipt.assign_to_budget()
+
+    def test_list_is_compact_by_default(self): #Check if the budget list leaves out receipts unless asked
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/budgets/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 3)
+        self.assertNotIn('receipts', response.data[0])
+        self.assertEqual(response.data[0]['current_spending'], "20.00")
+
+    def test_expand_receipts_fixed_queries(self): #Check if expanding receipts takes two queries however many budgets there are
+        with self.assertNumQueries(2): #Budgets, receipts of all budgets
+            response = self.client.get('/api/budgets/', {'expand': 'receipts'})
+        self.assertEqual([len(budget['receipts']) for budget in response.data], [1, 1, 1])
+
+        self.add_budgets(20)
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/budgets/', {'expand': 'receipts'})
+        self.assertEqual(len(response.data), 23)
+
+    def test_sparse_fields(self): #Check if only the requested fields are sent
+        response = self.client.get('/api/budgets/', {'fields': 'id,name'})
+        self.assertEqual(set(response.data[0]), {'id', 'name'})
+
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/budgets/', {'fields': 'id,receipts'})
+        self.assertEqual(set(response.data[0]), {'id', 'receipts'})
+
+    def test_detail_keeps_receipts(self): #Check if a single budget still includes its receipts, unless expand is empty
+        budget = Budget.objects.filter(user=self.user).first()
+        response = self.client.get(f'/api/budgets/{budget.id}/')
+        self.assertEqual(len(response.data['receipts']), 1)
+
+        response = self.client.get(f'/api/budgets/{budget.id}/', {'expand': ''})
+        self.assertNotIn('receipts', response.data)
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self): #Create test user with receipts that share upload times and expenses with and without dates
+        self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        start = make_aware(dt.datetime(2024, 2, 1))
+        Receipt.objects.bulk_create([
+            Receipt(user=self.user, merchant=f"Shop {i}", total_amount=1.00, uploaded_at=start + timedelta(days=i // 3), receipt_category=CategoryChoices.MEAL.value if i % 2 else CategoryChoices.FUEL.value)
+            for i in range(25)
+        ])
+        Expense.objects.bulk_create([
+            Expense(user=self.user, name=f"Expense {i}", amount=1.00, date=None if i % 4 == 0 else date(2024, 2, 1) + timedelta(days=i // 2))
+            for i in range(17)
+        ])
+
+    def fetch_all(self, url, params): #Follow next links and return every row with the number of pages
+        rows, pages = [], 0
+        response = self.client.get(url, params)
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            rows += response.data['results']
+            pages += 1
+            if not response.data['next']:
+                return rows, pages
+            response = self.client.get(response.data['next'])
+
+    def test_unpaginated_list_unchanged(self): #Check if clients that do not ask for pages still get a plain list
+        response = self.client.get('/api/receipts/')
+        self.assertIsInstance(response.data, list)
+        self.assertEqual(len(response.data), 25)
+
+    def test_receipt_pages(self): #Check if paging returns every receipt once, newest first, even when upload times are shared
+        rows, pages = self.fetch_all('/api/receipts/', {'page_size': 4})
+        self.assertEqual(pages, 7)
+        self.assertEqual([row['id'] for row in rows], list(Receipt.objects.order_by('-uploaded_at', '-id').values_list('id', flat=True)))
+
+    def test_pages_keep_filters(self): #Check if filterset filters still apply to every page
+        rows, pages = self.fetch_all('/api/receipts/', {'page_size': 5, 'receipt_category': CategoryChoices.MEAL.value})
+        self.assertEqual(len(rows), 12)
+        self.assertTrue(all(row['receipt_category'] == CategoryChoices.MEAL.value for row in rows))
+
+    def test_expense_pages_with_missing_dates(self): #Check if expenses without a date come last and are not skipped
+        rows, pages = self.fetch_all('/api/expenses/', {'page_size': 3})
+        self.assertEqual(len({row['id'] for row in rows}), 17)
+        self.assertEqual([row['date'] for row in rows[-5:]], [None] * 5)
+
+    def test_page_query_count(self): #Check if a deep page is one query and no COUNT
+        response = self.client.get('/api/receipts/', {'page_size': 4})
+        for _ in range(3):
+            response = self.client.get(response.data['next'])
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(response.data['next'])
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('COUNT(', queries[0]['sql'].upper())
+
+    def test_invalid_cursor(self): #Check if a made up cursor is rejected
+        response = self.client.get('/api/receipts/', {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+class BudgetSpendingDeltaTests(TestCase):
+    def setUp(self): #Create test user, a budget for all categories and one for meals only
+        self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.budget = Budget.objects.create(user=self.user, name="Everything", limit_amount=500.00, start_date="2024-02-01", end_date="2024-02-28")
+        self.meal_budget = Budget.objects.create(user=self.user, name="Meals", limit_amount=500.00, start_date="2024-02-01", end_date="2024-02-28", filter_categories=[CategoryChoices.MEAL.value])
+        self.receipt = Receipt.objects.create(user=self.user, merchant="Nandos", total_amount=20.00, transaction_date="2024-02-10", receipt_category=CategoryChoices.MEAL.value)
+        self.receipt.assign_to_budget()
+
+    def assertSpending(self, budget, amount): #Check the stored spending and that it agrees with a full recompute
+        budget.refresh_from_db()
+        self.assertEqual(budget.current_spending, Decimal(amount))
+        budget.update_spending()
+        self.assertEqual(budget.current_spending, Decimal(amount))
+
+    def test_linking_adds_amount(self): #Check if assigning a receipt adds it to every matching budget
+        self.assertSpending(self.budget, "20.00")
+        self.assertSpending(self.meal_budget, "20.00")
+
+    def test_amount_change_is_one_update(self): #Check if changing the total applies the difference without a recompute
+        self.receipt.total_amount = Decimal("35.50")
+        with self.assertNumQueries(8): #Savepoint, read the stored amount, update the receipt, update the budgets, update the monthly rollup, reindex for search, bump user data version, release
+            self.receipt.save()
+        self.assertSpending(self.budget, "35.50")
+        self.assertSpending(self.meal_budget, "35.50")
+
+    def test_category_change_moves_amount(self): #Check if a new category stops the receipt counting in filtered budgets it is still linked to
+        self.receipt.receipt_category = CategoryChoices.HEALTHCARE.value
+        self.receipt.save()
+        self.assertSpending(self.budget, "20.00")
+        self.assertSpending(self.meal_budget, "0.00")
+
+    def test_delete_subtracts_amount(self): #Check if deleting a receipt removes its amount
+        self.receipt.delete()
+        self.assertSpending(self.budget, "0.00")
+        self.assertSpending(self.meal_budget, "0.00")
+
+    def test_removing_unlinked_budget_is_ignored(self): #Check if removing a budget the receipt is not in leaves spending alone
+        other_budget = Budget.objects.create(user=self.user, name="Other", limit_amount=100.00, start_date="2023-01-01", end_date="2023-01-31", current_spending=5)
+        self.receipt.budget.remove(other_budget)
+        other_budget.refresh_from_db()
+        self.assertEqual(other_budget.current_spending, Decimal("5.00"))
+        self.assertSpending(self.budget, "20.00")
+
+    def test_reverse_side_links(self): #Check if adding and clearing from the budget side keeps spending right
+        second = Receipt.objects.create(user=self.user, merchant="Boots", total_amount=10.00, transaction_date="2023-01-01", receipt_category=CategoryChoices.HEALTHCARE.value)
+        self.meal_budget.receipts.add(second) #Linked by hand but the category does not count
+        self.budget.receipts.add(second)
+        self.assertSpending(self.meal_budget, "20.00")
+        self.assertSpending(self.budget, "30.00")
+
+        self.budget.receipts.remove(second)
+        self.assertSpending(self.budget, "20.00")
+        self.budget.receipts.clear()
+        self.assertSpending(self.budget, "0.00")
+
+    def test_stale_budget_copy_does_not_overwrite(self): #Check if spending deltas are not lost when another copy of the budget is saved
+        stale_budget = Budget.objects.get(pk=self.budget.pk)
+        Receipt.objects.create(user=self.user, merchant="Tesco", total_amount=5.00, transaction_date="2024-02-11").assign_to_budget()
+        stale_budget.update_spending()
+        self.assertSpending(self.budget, "25.00")
+
+    def test_edits_from_stale_copies(self): #Check if two copies of a receipt loaded before either is saved leave spending matching the stored total
+        first, second = Receipt.objects.get(pk=self.receipt.pk), Receipt.objects.get(pk=self.receipt.pk)
+        first.total_amount = Decimal("30.00")
+        second.total_amount = Decimal("50.00")
+        first.save()
+        second.save()
+        self.assertSpending(self.budget, "50.00")
+        self.assertSpending(self.meal_budget, "50.00")
+
+@skipUnless(connection.features.has_select_for_update, "Needs row locks, SQLite has none")
+class ConcurrentReceiptEditTests(TransactionTestCase):
+    def setUp(self): #Create test user with one receipt counted in a budget
+        self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
+        self.budget = Budget.objects.create(user=self.user, name="Everything", limit_amount=500.00, start_date="2024-02-01", end_date="2024-02-28")
+        self.receipt = Receipt.objects.create(user=self.user, merchant="Nandos", total_amount=20.00, transaction_date="2024-02-10")
+        self.receipt.assign_to_budget()
+
+    def edit(self, amount): #Save a new total on a connection of this thread, as another request would
+        try:
+            receipt = Receipt.objects.get(pk=self.receipt.pk)
+            receipt.total_amount = Decimal(amount)
+            receipt.save()
+        finally:
+            connection.close()
+
+    def test_interleaved_edits(self): #Check if an edit that starts while another holds the stored amount waits for it
+        first_read, second_done = threading.Event(), threading.Event()
+        saved_spending = Receipt.saved_spending
+
+        def read_then_pause(receipt, *args, **kwargs):
+            result = saved_spending(receipt, *args, **kwargs)
+            if threading.current_thread().name == "first":
+                first_read.set()
+                second_done.wait(timeout=1) #Without the lock the second edit would finish here, from the same stored amount
+            return result
+
+        def second_edit():
+            first_read.wait(timeout=5)
+            try:
+                self.edit("50.00")
+            finally:
+                second_done.set()
+
+        with mock.patch.object(Receipt, 'saved_spending', read_then_pause):
+            threads = [threading.Thread(target=self.edit, args=("30.00",), name="first"), threading.Thread(target=second_edit)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.budget.refresh_from_db()
+        self.assertEqual(self.budget.current_spending, Receipt.objects.filter(budget=self.budget).aggregate(total=Sum("total_amount"))["total"])
+
+class AssignToBudgetQueryTests(TestCase):
+    def setUp(self): #Create test user with many overlapping budgets
+        self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
+        Budget.objects.bulk_create([
+            Budget(user=self.user, name=f"Budget {i}", limit_amount=500.00, start_date="2024-02-01", end_date="2024-02-28")
+            for i in range(30)
+        ])
+        self.meal_budget = Budget.objects.create(user=self.user, name="Meals", limit_amount=500.00, start_date="2024-02-01", end_date="2024-02-28", filter_categories=[CategoryChoices.MEAL.value])
+        self.receipt = Receipt.objects.create(user=self.user, merchant="Nandos", total_amount=20.00, transaction_date="2024-02-10", receipt_category=CategoryChoices.MEAL.value)
+
+    def test_first_assignment_query_count(self): #Check if linking to every matching budget takes the same queries however many budgets there are
+        with self.assertNumQueries(8): #Savepoint, lock receipt, matching budgets, current links, insert links, update spending, bump user data version, release
+            self.receipt.assign_to_budget()
+        self.assertEqual(self.receipt.budget.count(), 31)
+        self.assertEqual(Budget.objects.filter(current_spending=Decimal("20.00")).count(), 31)
+
+    def test_reassignment_query_count(self): #Check if moving the receipt between budgets only diffs the links
+        self.receipt.assign_to_budget()
+        self.receipt.receipt_category = CategoryChoices.HEALTHCARE.value
+        self.receipt.transaction_date = "2024-03-10"
+        self.receipt.save()
+        later_budget = Budget.objects.create(user=self.user, name="March", limit_amount=500.00, start_date="2024-03-01", end_date="2024-03-31")
+
+        with self.assertNumQueries(9): #Savepoint, lock receipt, matching budgets, current links, delete links, insert link, update spending, bump user data version, release
+            self.receipt.assign_to_budget()
+        self.assertEqual(list(self.receipt.budget.values_list("pk", flat=True)), [later_budget.pk])
+        later_budget.refresh_from_db()
+        self.meal_budget.refresh_from_db()
+        self.assertEqual(later_budget.current_spending, Decimal("20.00"))
+        self.assertEqual(self.meal_budget.current_spending, Decimal("0.00"))
+        self.assertEqual(Budget.objects.filter(current_spending=0).count(), 31)
+
+    def test_unchanged_assignment_does_not_write(self): #Check if assigning again with nothing changed only reads
+        self.receipt.assign_to_budget()
+        with self.assertNumQueries(5): #Savepoint, lock receipt, matching budgets, current links, release
+            self.receipt.assign_to_budget()
+        self.meal_budget.refresh_from_db()
+        self.assertEqual(self.meal_budget.current_spending, Decimal("20.00"))
+
+'''Lines of an EXPLAIN plan that read a whole table instead of using an index'''
+def sequential_scans(plan):
+    if connection.vendor == "postgresql":
+        return [line.strip() for line in plan.splitlines() if "Seq Scan" in line]
+    return [line.strip() for line in plan.splitlines() if re.search(r"\bSCAN \w+$", line.strip())] #SQLite, a SCAN without an index is a full table scan
+
+class QueryPlanTests(TestCase):
+    @classmethod
+    def setUpTestData(cls): #Seed a few users with enough rows that a missing index shows up in the plan
+        users = [User.objects.create_user(email=f"test{i}@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07") for i in range(3)]
+        cls.user = users[0]
+        start = make_aware(dt.datetime(2024, 1, 1))
+        categories = [choice.value for choice in CategoryChoices]
+        for user in users:
+            Budget.objects.bulk_create([
+                Budget(user=user, name=f"Month {month}", limit_amount=500.00, start_date=date(2024, month, 1), end_date=date(2024, month, 28))
+                for month in range(1, 13)
+            ])
+            Expense.objects.bulk_create([
+                Expense(user=user, name=f"Expense {i}", amount=5.00, date=date(2024, 1, 1) + timedelta(days=i))
+                for i in range(100)
+            ])
+            Receipt.objects.bulk_create([
+                Receipt(user=user, merchant=f"Shop {i}", total_amount=10.00, transaction_date=start + timedelta(days=i), uploaded_at=start + timedelta(days=i), receipt_category=categories[i % len(categories)])
+                for i in range(100)
+            ])
+        for receipt in Receipt.objects.filter(user=cls.user)[:30]:
+            receipt.assign_to_budget()
+        cls.budget = Budget.objects.filter(user=cls.user, receipts__isnull=False).first()
+        cls.receipt = Receipt.objects.filter(user=cls.user, budget=cls.budget).first()
+
+    def setUp(self):
+        if connection.vendor == "postgresql": #Small tables are cheaper to scan, make the planner show whether an index could be used
+            with connection.cursor() as cursor:
+                cursor.execute("SET enable_seqscan = off")
+
+    def hot_queries(self): #The querysets behind the list endpoints, budget matching, spending updates and reports
+        receipt_date = self.receipt.transaction_date
+        return {
+            "receipt list": Receipt.objects.filter(user=self.user).order_by("-uploaded_at"),
+            "receipt list by category": Receipt.objects.filter(user=self.user, receipt_category=CategoryChoices.MEAL.value).order_by("-uploaded_at"),
+            "expense list": Expense.objects.filter(user=self.user),
+            "expense date range": Expense.objects.filter(user=self.user, date__gte=date(2024, 2, 1), date__lte=date(2024, 2, 28)),
+            "budget list": Budget.objects.filter(user=self.user),
+            "budget matching": Budget.objects.filter(user=self.user, start_date__lte=receipt_date, end_date__gte=receipt_date).accepting(self.receipt.receipt_category),
+            "budgets of a receipt": Budget.objects.filter(receipts=self.receipt),
+            "receipt budget links": Receipt.budget.through.objects.filter(receipt_id=self.receipt.pk),
+            "receipts of a budget": Receipt.objects.filter(budget=self.budget).order_by("transaction_date", "uploaded_at"),
+            "pending receipt jobs": ReceiptJob.objects.filter(status=ReceiptJob.Status.PENDING).order_by("created_at"),
+            "receipt page": self.page_after(Receipt.objects.filter(user=self.user), ("-uploaded_at", "-id"), self.receipt),
+            "expense page": self.page_after(Expense.objects.filter(user=self.user), ("-date", "-id"), Expense.objects.filter(user=self.user).first()),
+            "budget page": self.page_after(Budget.objects.filter(user=self.user), ("-start_date", "-id"), self.budget),
+        }
+
+    def page_after(self, queryset, ordering, row): #The query the list endpoints run for a page after row
+        paginator = KeysetPagination()
+        paginator.ordering = ordering
+        paginator.fields = [queryset.model._meta.get_field(name.lstrip('-')) for name in ordering]
+        values = [getattr(row, field.attname) for field in paginator.fields]
+        return queryset.filter(paginator.after(values)).order_by(*paginator.order_by())[:51]
+
+    def test_hot_queries_use_indexes(self): #Check if none of the hot queries fall back to reading a whole table
+        for name, queryset in self.hot_queries().items():
+            with self.subTest(query=name):
+                plan = queryset.explain()
+                self.assertEqual(sequential_scans(plan), [], f"{name} scans a whole table:\n{plan}")
+
+    def test_detects_sequential_scan(self): #Check if the harness catches a query that can not use an index
+        plan = Receipt.objects.filter(merchant="Shop 1").explain()
+        self.assertNotEqual(sequential_scans(plan), [])
+
 class ReceiptTests(TestCase):
     def setUp(self): #Create test user an receipt
         self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
@@ -141,6 +670,67 @@ class ReceiptTests(TestCase):
         self.receipt.refresh_from_db()
         self.assertEqual(self.receipt.receipt_category, "Healthcare")
 
+class ReceiptSearchTests(TestCase):
+    def setUp(self): #Create test user and receipts to search
+        self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+        def items(*descriptions):
+            return [{"description": {"value": description}, "total_price": {"value": "1.00"}} for description in descriptions]
+        self.tesco = Receipt.objects.create(user=self.user, merchant="Tesco Ireland", total_amount=12.50, parsed_items=items("AA Batteries", "Milk"))
+        self.aldi = Receipt.objects.create(user=self.user, merchant="Aldi", total_amount=4.00, parsed_items=items("Batteries from Tesco"))
+        self.cafe = Receipt.objects.create(user=self.user, merchant="Café Nero", total_amount=3.20, parsed_items=items("Flat white"))
+        other = User.objects.create_user(email="other@test.com", password="test12345",full_name="other",date_of_birth="2004-09-07")
+        Receipt.objects.create(user=other, merchant="Tesco", total_amount=1.00, parsed_items=items("Batteries"))
+
+    def search(self, q, **params): #Ids of the receipts found
+        response = self.client.get('/api/search/receipts/', {'q': q, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [receipt["id"] for receipt in response.data["results"]], response.data
+
+    def test_ranked_by_field(self): #Check if every word must match and a merchant match ranks above an item match
+        self.assertEqual(self.search("tesco batteries")[0], [self.tesco.id, self.aldi.id])
+        self.assertEqual(self.search("milk")[0], [self.tesco.id])
+
+    def test_prefix_and_accents(self): #Check if partial words and words without accents match
+        self.assertCountEqual(self.search("batt")[0], [self.tesco.id, self.aldi.id])
+        self.assertEqual(self.search("cafe")[0], [self.cafe.id])
+
+    def test_index_follows_writes(self): #Check if edits and deletes are reflected straight away
+        self.cafe.merchant = "Starbucks"
+        self.cafe.save()
+        self.assertEqual(self.search("nero")[0], [])
+        self.assertEqual(self.search("starbucks")[0], [self.cafe.id])
+
+        self.tesco.delete()
+        self.assertEqual(self.search("tesco")[0], [self.aldi.id])
+
+    def test_pages(self): #Check if results page with a cursor without repeating or skipping receipts
+        Receipt.objects.bulk_create([Receipt(user=self.user, merchant=f"Lidl {i}") for i in range(5)]) #Not indexed, bulk_create sends no signals
+        for i in range(5):
+            Receipt.objects.create(user=self.user, merchant="Lidl", total_amount=i)
+        found, data = self.search("lidl", page_size=2)
+        while data["next"]:
+            data = self.client.get(data["next"]).data
+            found += [receipt["id"] for receipt in data["results"]]
+        self.assertEqual(len(found), 5)
+        self.assertEqual(len(set(found)), 5)
+
+    def test_index_is_scoped_to_user(self): #Check if indexed words belong to their user, so a search never reads other accounts' matches
+        if connection.vendor != "sqlite":
+            self.skipTest("FTS5 tokens are only used on SQLite")
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM api_receipt_search WHERE api_receipt_search MATCH %s", ['"batteries"'])
+            self.assertEqual(cursor.fetchone()[0], 0)
+            cursor.execute("SELECT rowid FROM api_receipt_search WHERE api_receipt_search MATCH %s", [f'"u{self.user.pk}xbatteries"'])
+            self.assertCountEqual([row[0] for row in cursor.fetchall()], [self.tesco.id, self.aldi.id])
+
+    def test_query_syntax_is_ignored(self): #Check if search operators typed by the user are treated as words
+        self.assertEqual(self.search('tesco" OR "aldi')[0], [])
+        response = self.client.get('/api/search/receipts/', {'q': '*"-'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
 class ProcessReceiptTests(TestCase):
     def setUp(self): #Create test user
         self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
@@ -156,8 +746,672 @@ class ProcessReceiptTests(TestCase):
         self.assertEqual(response.data["total_amount"], "107.77")
         self.assertEqual(response.data["receipt_category"], "Supplies")
         
+'''Create a small uploaded jpeg for the receipt pipeline'''
+def make_image_file(name="receipt.jpg", color=(255, 255, 255), size=(64, 64)):
+    image_io = BytesIO()
+    Image.new("RGB", size, color).save(image_io, format="JPEG")
+    return SimpleUploadedFile(name, image_io.getvalue(), content_type="image/jpeg")
+
+'''Stand in for the Azure analysis so the pipeline can run without network access'''
+def fake_analyse_receipt(receiptUrl, user, image_hash=None, thumbnails=None):
+    receipt = Receipt.objects.create(user=user, image_url=receiptUrl, thumbnails=thumbnails or {}, merchant="Tesco", total_amount=12.50, receipt_category=CategoryChoices.SUPPLIES.value)
+    return {"id": receipt.id, "merchant": receipt.merchant}
+
+@override_settings(RECEIPT_JOBS={'BACKEND': 'api.jobs.ImmediateJobBackend'}, MEDIA_ROOT=tempfile.mkdtemp())
+class ReceiptJobTests(TestCase):
+    def setUp(self): #Create test user
+        self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    @mock.patch('api.views.analyse_receipt', side_effect=fake_analyse_receipt)
+    @mock.patch('api.views.upload_image_to_azure', return_value="http://example.com/blob.jpg")
+    def test_job_mode_returns_job_id(self, mock_upload, mock_analyse): #Check if job mode accepts the scan and the job can be polled
+        image = make_image_file("receipt.jpg")
+        response = self.client.post('/api/process-receipt/?async=true', {'image': image})
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertIn("job_id", response.data)
+
+        response = self.client.get(f'/api/receipt-jobs/{response.data["job_id"]}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["status"], ReceiptJob.Status.SUCCEEDED)
+        self.assertEqual(response.data["receipt"]["merchant"], "Tesco")
+        self.assertEqual(mock_upload.call_count, 1 + len(settings.RECEIPT_THUMBNAIL_SIZES)) #The image and each of its thumbnails
+
+    @mock.patch('api.views.analyse_receipt', side_effect=RuntimeError("Analysis failed"))
+    @mock.patch('api.views.upload_image_to_azure', return_value="http://example.com/blob.jpg")
+    def test_failed_job_records_error(self, mock_upload, mock_analyse): #Check if a failing scan is retried, then marked as failed without the internal error
+        image = make_image_file("receipt.jpg")
+        response = self.client.post('/api/process-receipt/', {'image': image, 'async': '1'})
+        job = ReceiptJob.objects.get(id=response.data["job_id"])
+        self.assertEqual(job.status, ReceiptJob.Status.FAILED)
+        self.assertEqual(job.error, FAILED_JOB_ERROR)
+        self.assertEqual(job.attempts, settings.RECEIPT_JOB_MAX_ATTEMPTS)
+        self.assertEqual(mock_analyse.call_count, settings.RECEIPT_JOB_MAX_ATTEMPTS)
+        self.assertIsNone(job.image_path)
+        self.assertEqual(default_storage.listdir("receipt_jobs")[1], []) #The upload is deleted once the job gives up
+
+    @mock.patch('api.views.analyse_receipt')
+    @mock.patch('api.views.upload_image_to_azure', return_value="http://example.com/blob.jpg")
+    def test_failed_job_is_retried(self, mock_upload, mock_analyse): #Check if a scan that fails once succeeds on its next attempt
+        def fail_first_attempt(*args, **kwargs):
+            if mock_analyse.call_count == 1:
+                raise RuntimeError("Analysis failed")
+            return fake_analyse_receipt(*args, **kwargs)
+        mock_analyse.side_effect = fail_first_attempt
+        response = self.client.post('/api/process-receipt/', {'image': make_image_file("receipt.jpg"), 'async': '1'})
+        job = ReceiptJob.objects.get(id=response.data["job_id"])
+        self.assertEqual(job.status, ReceiptJob.Status.SUCCEEDED)
+        self.assertEqual(job.attempts, 2)
+        self.assertIsNone(job.error)
+
+    @mock.patch('api.fetching.fetch_session')
+    def test_download_error_is_not_retried(self, mock_session): #Check if a broken image url fails straight away with its message
+        mock_session.return_value.get.return_value = FakeImageResponse(b"", status_code=404)
+        response = self.client.post('/api/process-receipt/', {'image_url': "http://example.com/missing.jpg", 'async': '1'})
+        job = ReceiptJob.objects.get(id=response.data["job_id"])
+        self.assertEqual(job.status, ReceiptJob.Status.FAILED)
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(job.error, "Failed to download image from URL.")
+
+    def test_jobs_are_private(self): #Check if users can only see their own jobs
+        other_user = User.objects.create_user(email="other@test.com", password="test12345",full_name="other",date_of_birth="2004-09-07")
+        job = ReceiptJob.objects.create(user=other_user, image_url="http://example.com/receipt.jpg")
+        response = self.client.get(f'/api/receipt-jobs/{job.id}/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+@override_settings(RECEIPT_JOBS={'BACKEND': 'api.jobs.DatabaseJobBackend'}, MEDIA_ROOT=tempfile.mkdtemp())
+class ReceiptJobWorkerTests(TransactionTestCase): #Jobs run on worker threads with their own connections, which only see committed rows
+    def setUp(self): #Create test user and a job whose upload is waiting in storage
+        self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
+        self.job = submit_receipt_job(self.user, image_file=make_image_file("receipt.jpg"))
+
+    def work(self): #Drain the queue once, returns what the worker printed
+        output = StringIO()
+        call_command('process_receipt_jobs', once=True, workers=1, poll_interval=0, stdout=output)
+        return output.getvalue()
+
+    def abandon(self, attempts): #Leave the job as a worker that died mid job would
+        ReceiptJob.objects.filter(pk=self.job.pk).update(
+            status=ReceiptJob.Status.RUNNING, attempts=attempts,
+            started_at=now() - timedelta(seconds=settings.RECEIPT_JOB_CLAIM_TIMEOUT + 1),
+        )
+
+    @mock.patch('api.views.analyse_receipt', side_effect=fake_analyse_receipt)
+    @mock.patch('api.views.upload_image_to_azure', return_value="http://example.com/blob.jpg")
+    def test_abandoned_job_is_claimed_again(self, mock_upload, mock_analyse): #Check if a job left running past the claim timeout is run again
+        self.abandon(attempts=1)
+        self.work()
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, ReceiptJob.Status.SUCCEEDED)
+        self.assertEqual(self.job.attempts, 2)
+
+    def test_running_job_is_left_alone(self): #Check if a job claimed within the timeout is not taken from its worker
+        ReceiptJob.objects.filter(pk=self.job.pk).update(status=ReceiptJob.Status.RUNNING, attempts=1, started_at=now())
+        self.work()
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, ReceiptJob.Status.RUNNING)
+
+    def test_abandoned_job_out_of_attempts_fails(self): #Check if a job whose last attempt was abandoned is failed and its upload deleted
+        self.abandon(attempts=settings.RECEIPT_JOB_MAX_ATTEMPTS)
+        self.assertIn("Failed 1 abandoned job(s)", self.work())
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, ReceiptJob.Status.FAILED)
+        self.assertIsNone(self.job.image_path)
+        self.assertEqual(default_storage.listdir("receipt_jobs")[1], [])
+
+    def test_worker_survives_a_crashed_job(self): #Check if an exception escaping a job is logged and the loop carries on
+        def crash(job_id):
+            claim_job(job_id)
+            raise RuntimeError("Database went away")
+        with mock.patch('api.management.commands.process_receipt_jobs.run_receipt_job_in_thread', side_effect=crash), \
+                self.assertLogs('api.management.commands.process_receipt_jobs', level='ERROR'):
+            output = self.work()
+        self.assertIn("Processed 0 receipt job(s), 1 error(s)", output)
+
+'''Extracted receipt fields as returned by extract_receipt_data'''
+def fake_receipt_data(merchant="Tesco", total=20.00, category=CategoryChoices.MEAL.value):
+    return {
+        "merchant": merchant,
+        "total_amount": total,
+        "transaction_date": "2024-02-10",
+        "receipt_category": category,
+        "expense_category": category,
+        "parsed_items": [{"description": {"value": "Sandwich"}, "total_price": {"value": str(total)}}],
+        "expense_amounts": [total],
+    }
+
+class SaveReceiptDataTests(TestCase):
+    def setUp(self): #Create test user and budget
+        self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
+        self.budget = Budget.objects.create(user=self.user, name="Trip", limit_amount=500.00, start_date="2024-02-01", end_date="2024-02-28")
+
+    def receipt_data(self, items):
+        data = fake_receipt_data(total=items * 2.00)
+        data["parsed_items"] = [{"description": {"value": f"Item {i}"}, "total_price": {"value": "2.00"}} for i in range(items)]
+        data["expense_amounts"] = [2.00] * items
+        return data
+
+    def test_query_count_does_not_depend_on_items(self): #Check if a long receipt is stored in as many queries as a short one
+        save_receipt_data(self.user, "http://example.com/blob.jpg", self.receipt_data(1)) #The first receipt of a month also creates its rollups
+        with CaptureQueriesContext(connection) as one_item:
+            save_receipt_data(self.user, "http://example.com/blob.jpg", self.receipt_data(1))
+        with CaptureQueriesContext(connection) as many_items:
+            save_receipt_data(self.user, "http://example.com/blob.jpg", self.receipt_data(60))
+        self.assertEqual(len(one_item), len(many_items))
+        self.assertEqual(Expense.objects.filter(user=self.user).count(), 62)
+        self.budget.refresh_from_db()
+        self.assertEqual(self.budget.current_spending, Decimal("124.00"))
+
+    def test_failure_keeps_nothing(self): #Check if a failure part way leaves no expenses, receipt or spending behind
+        with mock.patch.object(Receipt, 'assign_to_budget', side_effect=RuntimeError("Budget assignment failed")):
+            with self.assertRaises(RuntimeError):
+                save_receipt_data(self.user, "http://example.com/blob.jpg", self.receipt_data(3))
+        self.assertFalse(Expense.objects.filter(user=self.user).exists())
+        self.assertFalse(Receipt.objects.filter(user=self.user).exists())
+        self.budget.refresh_from_db()
+        self.assertEqual(self.budget.current_spending, Decimal("0.00"))
+
+class ProcessReceiptBatchTests(TestCase):
+    def setUp(self): #Create test user and budget
+        self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.budget = Budget.objects.create(user=self.user, name="Trip", limit_amount=500.00, start_date="2024-02-01", end_date="2024-02-28")
+
+    @mock.patch('api.views.extract_receipt_data', side_effect=[fake_receipt_data(total=20.00), fake_receipt_data(total=30.00)])
+    @mock.patch('api.views.upload_image_to_azure', return_value="http://example.com/blob.jpg")
+    def test_batch_upload(self, mock_upload, mock_extract): #Check if every image in the batch becomes a receipt and the budget is kept up to date without recomputing
+        images = [make_image_file(f"receipt{i}.jpg") for i in range(2)]
+        with mock.patch.object(Budget, 'update_spending', autospec=True, side_effect=Budget.update_spending) as mock_update:
+            response = self.client.post('/api/process-receipt/batch/', {'images': images})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["created"], 2)
+        self.assertEqual(mock_update.call_count, 0)
+
+        self.budget.refresh_from_db()
+        self.assertEqual(self.budget.current_spending, 50.00)
+        self.assertEqual(Expense.objects.filter(user=self.user).count(), 2)
+
+    @mock.patch('api.views.extract_receipt_data', return_value=fake_receipt_data())
+    @mock.patch('api.views.upload_image_to_azure', return_value="http://example.com/blob.jpg")
+    @mock.patch('api.views.download_image', side_effect=ImageDownloadError("Failed to download image from URL."))
+    def test_batch_reports_errors_per_image(self, mock_download, mock_upload, mock_extract): #Check if a failing image does not stop the rest of the batch
+        image = make_image_file("receipt.jpg")
+        response = self.client.post('/api/process-receipt/batch/', {'images': [image], 'image_urls': ["http://example.com/missing.jpg"]})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["results"][0]["status"], "created")
+        self.assertEqual(response.data["results"][1]["status"], "error")
+        self.assertEqual(response.data["results"][1]["error"], "Failed to download image from URL.")
+
+    def test_batch_requires_images(self): #Check if an empty batch is rejected
+        response = self.client.post('/api/process-receipt/batch/', {})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+'''Minimal prebuilt-receipt result as returned by Document Intelligence'''
+def fake_analyze_result(merchant="Tesco", total=12.50):
+    return AnalyzeResult({
+        "apiVersion": "2024-11-30",
+        "modelId": "prebuilt-receipt",
+        "content": "",
+        "documents": [{
+            "docType": "receipt",
+            "fields": {
+                "MerchantName": {"type": "string", "valueString": merchant},
+                "Total": {"type": "currency", "valueCurrency": {"amount": total, "currencyCode": "EUR"}},
+                "TransactionDate": {"type": "date", "valueDate": "2024-02-10"},
+                "ReceiptType": {"type": "string", "valueString": "Supplies"},
+                "Items": {"type": "array", "valueArray": [
+                    {"type": "object", "valueObject": {
+                        "Description": {"type": "string", "valueString": "Batteries"},
+                        "TotalPrice": {"type": "currency", "valueCurrency": {"amount": total, "currencyCode": "EUR"}},
+                    }},
+                ]},
+            },
+        }],
+    })
+
+@mock.patch('api.views.upload_image_to_azure', return_value="http://example.com/blob.jpg")
+@mock.patch('api.views.get_receipt_analyzer')
+class ReceiptAnalysisCacheTests(TestCase):
+    def setUp(self): #Create test user and start with an empty cache
+        self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        caches['receipt-analysis'].clear()
+
+    def test_resubmitted_image_skips_analysis(self, mock_analyzer, mock_upload): #Check if the same photo is only analysed once but still creates a receipt each time
+        mock_analyzer.return_value.analyze.return_value = fake_analyze_result()
+
+        for _ in range(2):
+            response = self.client.post('/api/process-receipt/', {'image': make_image_file()})
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(response.data["merchant"], "Tesco")
+
+        self.assertEqual(mock_analyzer.return_value.analyze.call_count, 1)
+        self.assertEqual(Receipt.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(analysis_cache.stats(), {"hits": 1, "misses": 1, "hit_rate": 0.5})
+
+    def test_different_images_are_analysed(self, mock_analyzer, mock_upload): #Check if a different photo misses the cache
+        mock_analyzer.return_value.analyze.return_value = fake_analyze_result()
+
+        self.client.post('/api/process-receipt/', {'image': make_image_file(color=(255, 255, 255))})
+        self.client.post('/api/process-receipt/', {'image': make_image_file(color=(0, 0, 0))})
+        self.assertEqual(mock_analyzer.return_value.analyze.call_count, 2)
+
+    def test_stats_are_admin_only(self, mock_analyzer, mock_upload): #Check if only staff can see the cache counters
+        response = self.client.get('/api/receipt-analysis-cache/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        admin = User.objects.create_superuser(email="admin@test.com", password="test12345")
+        self.client.force_authenticate(user=admin)
+        response = self.client.get('/api/receipt-analysis-cache/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("hit_rate", response.data)
+
+@override_settings(
+    RECEIPT_STORAGE={'BACKEND': 'api.backends.FileSystemReceiptStorage', 'OPTIONS': {'location': tempfile.mkdtemp()}},
+    RECEIPT_ANALYZER={'BACKEND': 'api.backends.ReplayReceiptAnalyzer'},
+)
+class OfflineReceiptPipelineTests(TestCase):
+    def setUp(self): #Create test user
+        self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        caches['receipt-analysis'].clear()
+
+    def test_process_receipt_offline(self): #Check if the whole pipeline runs with the filesystem storage and replayed analysis
+        response = self.client.post('/api/process-receipt/', {'image': make_image_file()})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["merchant"], "TESCO\nIRELAND")
+        self.assertEqual(response.data["total_amount"], "107.77")
+        self.assertEqual(response.data["receipt_category"], "Supplies")
+        self.assertTrue(response.data["image_url"].startswith("http://localhost:8000/media/receipts/"))
+        self.assertEqual(Expense.objects.filter(user=self.user).count(), len(response.data["parsed_items"]))
+
+    def test_thumbnails_are_stored(self): #Check if each thumbnail is stored next to the image and no bigger than its size
+        response = self.client.post('/api/process-receipt/', {'image': make_image_file(size=(900, 1200))})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(set(response.data["thumbnails"]), {"128", "512"})
+        stem = response.data["image_url"].rsplit(".", 1)[0]
+        storage = get_receipt_storage()
+        for size, url in response.data["thumbnails"].items():
+            self.assertEqual(url, f"{stem}_{size}.jpg")
+            self.assertEqual(max(Image.open(BytesIO(storage.read(url))).size), int(size))
+
+    def test_backfill_thumbnails(self): #Check if the backfill command gives older receipts thumbnails and invalidates cached lists
+        storage = get_receipt_storage()
+        image_io = BytesIO()
+        Image.new("RGB", (900, 1200), (255, 255, 255)).save(image_io, format="JPEG")
+        image_io.seek(0)
+        receipt = Receipt.objects.create(user=self.user, image_url=storage.save(image_io, "old_receipt.jpg"), merchant="Tesco", total_amount=10.00)
+        Receipt.objects.create(user=self.user, image_url=None, merchant="Cash", total_amount=5.00) #Nothing to make thumbnails from
+        version = User.objects.get(pk=self.user.pk).data_version
+
+        call_command('backfill_receipt_thumbnails', workers=2, stdout=StringIO(), stderr=StringIO())
+        receipt.refresh_from_db()
+        self.assertEqual(receipt.thumbnails["128"], receipt.image_url.replace("old_receipt.jpg", "old_receipt_128.jpg"))
+        self.assertEqual(max(Image.open(BytesIO(storage.read(receipt.thumbnails["512"]))).size), 512)
+        self.assertGreater(User.objects.get(pk=self.user.pk).data_version, version)
+
+    def test_backends_are_shared(self): #Check if the clients are only created once per process
+        self.assertIs(get_receipt_storage(), get_receipt_storage())
+        self.assertIs(get_receipt_analyzer(), get_receipt_analyzer())
+
+@override_settings(
+    RECEIPT_STORAGE={'BACKEND': 'api.backends.FileSystemReceiptStorage', 'OPTIONS': {'location': tempfile.mkdtemp()}},
+    RECEIPT_ANALYZER={'BACKEND': 'api.backends.ReplayReceiptAnalyzer'},
+    RECEIPT_JOBS={'BACKEND': 'api.jobs.ImmediateJobBackend'},
+)
+class AsyncProcessReceiptTests(TestCase):
+    def setUp(self): #Create test user signed in with a JWT, the async view authenticates the same way as the others
+        self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
+        access = APIClient().post('/login/', {'email': 'test@test.com', 'password': 'test12345'}).data['access']
+        self.client = AsyncClient()
+        self.headers = {"Authorization": f"Bearer {access}"}
+        caches['receipt-analysis'].clear()
+
+    async def test_process_receipt_async(self): #Check if the async pipeline stores the same receipt as the sync one
+        with mock.patch('api.backends.ReplayReceiptAnalyzer.analyze', side_effect=AssertionError("sync analysis used")):
+            response = await self.client.post('/api/process-receipt/async/', {'image': make_image_file()}, headers=self.headers)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        data = response.json()
+        self.assertEqual(data["merchant"], "TESCO\nIRELAND")
+        self.assertEqual(data["total_amount"], "107.77")
+        self.assertTrue(data["image_url"].startswith("http://localhost:8000/media/receipts/"))
+        self.assertEqual(await Expense.objects.filter(user=self.user).acount(), len(data["parsed_items"]))
+
+    async def test_analysis_cache_is_used(self): #Check if the same image is only analysed once
+        await self.client.post('/api/process-receipt/async/', {'image': make_image_file()}, headers=self.headers)
+        with mock.patch('api.backends.ReplayReceiptAnalyzer.aanalyze') as aanalyze:
+            response = await self.client.post('/api/process-receipt/async/', {'image': make_image_file()}, headers=self.headers)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        aanalyze.assert_not_called()
+
+    async def test_job_mode(self): #Check if the async view can hand the scan to a job
+        response = await self.client.post('/api/process-receipt/async/?async=true', {'image': make_image_file()}, headers=self.headers)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertIn("job_id", response.json())
+
+    async def test_requires_authentication(self): #Check if anonymous uploads are refused
+        response = await AsyncClient().post('/api/process-receipt/async/', {'image': make_image_file()})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    async def test_no_image(self): #Check if a request without an image or url is rejected
+        response = await self.client.post('/api/process-receipt/async/', {}, headers=self.headers)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+'''Streamed HTTP response for a patched fetch session, counts how much of the body was read'''
+class FakeImageResponse:
+    def __init__(self, body, content_type="image/jpeg", status_code=200, content_length=True):
+        self.body = body
+        self.status_code = status_code
+        self.headers = {"Content-Type": content_type}
+        if content_length:
+            self.headers["Content-Length"] = str(len(body))
+        self.bytes_read = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), chunk_size):
+            chunk = self.body[start:start + chunk_size]
+            self.bytes_read += len(chunk)
+            yield chunk
+
+    #The same response as aiohttp serves it
+    @property
+    def status(self):
+        return self.status_code
+
+    @property
+    def content(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def iter_chunked(self, chunk_size):
+        for chunk in self.iter_content(chunk_size):
+            yield chunk
+
+'''aiohttp session for a patched async fetch, answers every url with one response'''
+class FakeImageSession:
+    def __init__(self, response):
+        self.response = response
+        self.closed = False
+
+    def get(self, image_url):
+        return self.response
+
+    async def close(self):
+        self.closed = True
+
+@override_settings(
+    RECEIPT_STORAGE={'BACKEND': 'api.backends.FileSystemReceiptStorage', 'OPTIONS': {'location': tempfile.mkdtemp()}},
+    RECEIPT_ANALYZER={'BACKEND': 'api.backends.ReplayReceiptAnalyzer'},
+    RECEIPT_IMAGE_FETCH_MAX_BYTES=256 * 1024,
+)
+class ImageFetchTests(TestCase):
+    def setUp(self): #Create test user and a session that answers with whatever response the test sets
+        self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        caches['receipt-analysis'].clear()
+        session_patch = mock.patch('api.fetching.fetch_session')
+        self.session = session_patch.start().return_value
+        self.addCleanup(session_patch.stop)
+
+    def test_process_receipt_from_url(self): #Check if a receipt can be created from an image url
+        self.session.get.return_value = FakeImageResponse(make_image_file().read())
+        response = self.client.post('/api/process-receipt/', {'image_url': "http://example.com/receipt.jpg"})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(response.data["image_url"].endswith(".jpg"))
+        self.assertTrue(self.session.get.call_args.kwargs["stream"])
+
+    def test_declared_size_over_cap_is_not_read(self): #Check if a too large Content-Length is refused before the body is read
+        fake_response = FakeImageResponse(b"x" * (300 * 1024))
+        self.session.get.return_value = fake_response
+        with self.assertRaisesMessage(ImageDownloadError, "larger than"):
+            fetch_image("http://example.com/huge.jpg")
+        self.assertEqual(fake_response.bytes_read, 0)
+
+    def test_streamed_size_over_cap_stops_reading(self): #Check if a body without Content-Length is cut off at the cap
+        fake_response = FakeImageResponse(b"x" * (1024 * 1024), content_length=False)
+        self.session.get.return_value = fake_response
+        with self.assertRaisesMessage(ImageDownloadError, "larger than"):
+            fetch_image("http://example.com/huge.jpg")
+        self.assertLess(fake_response.bytes_read, 1024 * 1024)
+
+    def test_slow_download_is_cut_off(self): #Check if a server trickling bytes under the read timeout is stopped at the total deadline
+        fake_response = FakeImageResponse(b"x" * (200 * 1024), content_length=False)
+        self.session.get.return_value = fake_response
+        with override_settings(RECEIPT_IMAGE_FETCH_TIMEOUT=10), mock.patch('api.fetching.time.monotonic', side_effect=itertools.count(0, 4)): #Each chunk arrives 4 s after the last
+            with self.assertRaisesMessage(ImageDownloadError, "took too long"):
+                fetch_image("http://example.com/slow.jpg")
+        self.assertLess(fake_response.bytes_read, 200 * 1024)
+
+    def test_non_image_is_refused(self): #Check if an HTML page is refused from its headers
+        fake_response = FakeImageResponse(b"<html></html>", content_type="text/html; charset=utf-8")
+        self.session.get.return_value = fake_response
+        response = self.client.post('/api/process-receipt/', {'image_url': "http://example.com/page"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(fake_response.bytes_read, 0)
+
+    def test_failed_status(self): #Check if error responses are reported as download errors
+        self.session.get.return_value = FakeImageResponse(b"", status_code=404)
+        with self.assertRaisesMessage(ImageDownloadError, "Failed to download image from URL."):
+            fetch_image("http://example.com/missing.jpg")
+
+class FakeRawResponse:
+    async def close(self):
+        pass
+
+'''Azure transport that answers from a function instead of the network, records the requests sent and whether it was closed'''
+class FakeAzureTransport(AsyncHttpTransport):
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+        self.closed = False
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        self.closed = True
+
+    async def sleep(self, duration): #Polls without waiting
+        pass
+
+    async def send(self, request, **kwargs):
+        self.requests.append(request)
+        status_code, headers, body = self.respond(request)
+        response = AsyncHttpResponseImpl(
+            request=request, internal_response=FakeRawResponse(), status_code=status_code, reason="OK",
+            content_type=headers.get("Content-Type"), headers=CaseInsensitiveDict(headers),
+            stream_download_generator=None, block_size=4096,
+        )
+        response._content = body
+        return response
+
+def blob_service_response(request): #Blob stored
+    return 201, {"ETag": '"0x1"', "Last-Modified": "Sat, 18 Oct 2026 10:00:00 GMT"}, b""
+
+def document_intelligence_response(request): #Analysis accepted, then finished on the first poll
+    if request.method == "POST":
+        return 202, {"Operation-Location": "https://example.cognitiveservices.azure.com/documentintelligence/documentModels/prebuilt-receipt/analyzeResults/1?api-version=2024-11-30", "Retry-After": "0"}, b""
+    with open(os.path.join(os.path.dirname(__file__), "analysis_fixtures", "tesco_ireland.json")) as f:
+        return 200, {"Content-Type": "application/json"}, json.dumps({"status": "succeeded", "analyzeResult": json.load(f)}).encode()
+
+@override_settings(
+    RECEIPT_STORAGE={'BACKEND': 'api.backends.FileSystemReceiptStorage', 'OPTIONS': {'location': tempfile.mkdtemp()}},
+    RECEIPT_ANALYZER={'BACKEND': 'api.backends.ReplayReceiptAnalyzer'},
+    RECEIPT_IMAGE_FETCH_MAX_BYTES=256 * 1024,
+)
+class NativeAioTests(TestCase):
+    def setUp(self): #Create test user and Azure backends whose aio clients talk to fake transports
+        self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
+        caches['receipt-analysis'].clear()
+        self.blob_transport = FakeAzureTransport(blob_service_response)
+        self.analysis_transport = FakeAzureTransport(document_intelligence_response)
+        transport_patch = mock.patch('api.backends.pooled_aio_transport', side_effect=[self.blob_transport, self.analysis_transport])
+        self.pooled_aio_transport = transport_patch.start()
+        self.addCleanup(transport_patch.stop)
+        self.storage = AzureBlobReceiptStorage(account_name="account", account_key="a2V5", container_name="receipts")
+        self.analyzer = AzureReceiptAnalyzer(endpoint="https://example.cognitiveservices.azure.com/", api_key="key")
+
+    async def test_azure_clients(self): #Check if upload and analysis go through the aio clients, one per loop, closed with the loop
+        token = native_aio.set(True)
+        try:
+            first_url = await self.storage.asave(BytesIO(b"image"), "first.jpg")
+            second_url = await self.storage.asave(BytesIO(b"image"), "second.jpg")
+            result = await self.analyzer.aanalyze(first_url)
+            await close_loop_clients()
+        finally:
+            native_aio.reset(token) #async_to_sync would carry the flag over to the next test
+        self.assertTrue(first_url.startswith("https://account.blob.core.windows.net/receipts/first.jpg?"))
+        self.assertIn("sig=", second_url)
+        self.assertEqual(result.documents[0].fields["MerchantName"].value_string, "TESCO\nIRELAND")
+        self.assertEqual([request.method for request in self.blob_transport.requests], ["PUT", "PUT"])
+        self.assertEqual([request.method for request in self.analysis_transport.requests], ["POST", "GET"])
+        self.assertEqual(self.pooled_aio_transport.call_count, 2)
+        self.assertTrue(self.blob_transport.closed)
+        self.assertTrue(self.analysis_transport.closed)
+
+    async def test_lifespan_shutdown_closes_clients(self): #Check if the ASGI server's shutdown closes the clients opened on its loop, and HTTP still reaches Django
+        session = FakeImageSession(FakeImageResponse(b"image"))
+        clients = LoopClients(lambda: session) #Held like a backend holds its clients, close_loop_clients only sees live ones
+        clients.get()
+        django_application = mock.AsyncMock()
+        application = close_loop_clients_on_shutdown(django_application)
+        messages = iter([{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}])
+        sent = []
+
+        async def receive():
+            return next(messages)
+
+        async def send(message):
+            sent.append(message["type"])
+
+        await application({"type": "http"}, receive, send)
+        django_application.assert_awaited_once()
+        self.assertFalse(session.closed)
+        await application({"type": "lifespan"}, receive, send)
+        self.assertEqual(sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"])
+        self.assertTrue(session.closed)
+
+    def test_sync_clients_outside_native_loop(self): #Check if a loop made for one call, as under WSGI, opens no aio clients
+        with mock.patch.object(AzureBlobReceiptStorage, 'save', return_value="https://example.com/receipt.jpg") as save, \
+                mock.patch.object(AzureReceiptAnalyzer, 'analyze', return_value=None) as analyze:
+            self.assertEqual(async_to_sync(self.storage.asave)(BytesIO(b"image"), "receipt.jpg"), "https://example.com/receipt.jpg")
+            async_to_sync(self.analyzer.aanalyze)("https://example.com/receipt.jpg")
+        save.assert_called_once()
+        analyze.assert_called_once()
+        self.pooled_aio_transport.assert_not_called()
+
+    async def test_afetch_image(self): #Check if the aiohttp download is capped and closed like the sync one
+        token = native_aio.set(True)
+        session = FakeImageSession(FakeImageResponse(b"image"))
+        try:
+            with mock.patch('api.fetching.async_fetch_sessions', LoopClients(lambda: session)):
+                self.assertEqual(await afetch_image("http://example.com/receipt.jpg"), b"image")
+                session.response = FakeImageResponse(b"x" * (1024 * 1024), content_length=False)
+                with self.assertRaisesMessage(ImageDownloadError, "larger than"):
+                    await afetch_image("http://example.com/huge.jpg")
+                self.assertLess(session.response.bytes_read, 1024 * 1024)
+                session.response = FakeImageResponse(b"", status_code=404)
+                with self.assertRaisesMessage(ImageDownloadError, "Failed to download image from URL."):
+                    await afetch_image("http://example.com/missing.jpg")
+                await close_loop_clients()
+        finally:
+            native_aio.reset(token)
+        self.assertTrue(session.closed)
+
+    def test_async_route_under_wsgi(self): #Check if the async route served by WSGI downloads with the pooled sync session
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        with mock.patch('api.fetching.fetch_session') as fetch_session, \
+                mock.patch('api.fetching.async_fetch_sessions', LoopClients(mock.Mock(side_effect=AssertionError("aiohttp session opened")))):
+            fetch_session.return_value.get.return_value = FakeImageResponse(make_image_file().read())
+            response = client.post('/api/process-receipt/async/', {'image_url': "http://example.com/receipt.jpg"})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        fetch_session.return_value.get.assert_called_once()
+
+    async def test_async_route_under_asgi(self): #Check if the async route served by ASGI downloads with the loop's aiohttp session
+        access = (await sync_to_async(APIClient().post)('/login/', {'email': 'test@test.com', 'password': 'test12345'})).data['access']
+        session = FakeImageSession(FakeImageResponse(make_image_file().read()))
+        with mock.patch('api.fetching.fetch_session', side_effect=AssertionError("sync session used")), \
+                mock.patch('api.fetching.async_fetch_sessions', LoopClients(lambda: session)):
+            response = await AsyncClient().post('/api/process-receipt/async/', {'image_url': "http://example.com/receipt.jpg"}, headers={"Authorization": f"Bearer {access}"})
+            await close_loop_clients()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(session.closed)
+
+class ImageCompressionTests(TestCase):
+    def make_image_data(self, size, format="JPEG", mode="RGB", exif=None): #Encode a noisy image so the JPEG has a realistic size
+        img = Image.merge("RGB", [Image.effect_noise(size, 40)] * 3).convert(mode)
+        image_io = BytesIO()
+        img.save(image_io, format=format, **({"exif": exif} if exif else {}))
+        return image_io.getvalue()
+
+    def test_large_image_is_downscaled(self): #Check if big photos are shrunk to the maximum dimension
+        compressed = Image.open(BytesIO(imaging.compress_image_data(self.make_image_data((3024, 4032)), max_dimension=2000, target_bytes=10 * 1024 * 1024)))
+        self.assertEqual(compressed.format, "JPEG")
+        self.assertEqual(max(compressed.size), 2000)
+
+    def test_target_size_is_respected(self): #Check if the output is brought under the byte target
+        compressed = imaging.compress_image_data(self.make_image_data((1500, 2000)), target_bytes=300 * 1024)
+        self.assertLessEqual(len(compressed), 300 * 1024)
+
+    def test_png_with_alpha_becomes_jpeg(self): #Check if transparent images are converted
+        compressed = Image.open(BytesIO(imaging.compress_image_data(self.make_image_data((400, 600), format="PNG", mode="RGBA"))))
+        self.assertEqual(compressed.format, "JPEG")
+
+    def test_exif_rotation_is_applied(self): #Check if sideways phone photos are turned upright
+        exif = Image.Exif()
+        exif[0x0112] = 6 #Orientation, rotate 90 degrees
+        compressed = Image.open(BytesIO(imaging.compress_image_data(self.make_image_data((600, 400), exif=exif))))
+        self.assertEqual(compressed.size, (400, 600))
+
+    def test_thumbnails_share_the_decode(self): #Check if each thumbnail fits its size and keeps the aspect ratio
+        compressed, thumbnails = imaging.compress_with_thumbnails(self.make_image_data((1500, 2000)), thumbnail_sizes=(128, 512))
+        self.assertEqual(Image.open(BytesIO(compressed)).format, "JPEG")
+        self.assertEqual(Image.open(BytesIO(thumbnails[128])).size, (96, 128))
+        self.assertEqual(Image.open(BytesIO(thumbnails[512])).size, (384, 512))
+
+    def test_process_pool_matches_inline(self): #Check if compressing on the process pool gives the same bytes
+        image_data = self.make_image_data((800, 600))
+        self.assertEqual(imaging.compress_renditions(image_data, processes=1), imaging.compress_renditions(image_data, processes=0))
+
+    def test_broken_process_pool_is_replaced(self): #Check if a pool worker being killed does not break later compressions
+        image_data = self.make_image_data((800, 600))
+        expected = imaging.compress_renditions(image_data, processes=0)
+        self.assertEqual(imaging.compress_renditions(image_data, processes=1), expected) #Starts the pool
+        executor = imaging.get_executor(1)
+        for process in list(executor._processes.values()): #As the OOM killer would
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+        self.assertEqual(imaging.compress_renditions(image_data, processes=1), expected)
+        self.assertIsNot(imaging.get_executor(1), executor)
+
+        for process in list(imaging.get_executor(1)._processes.values()):
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+        self.assertEqual(async_to_sync(imaging.acompress_renditions)(image_data, processes=1), expected)
+
 class BudgetReportTests(TestCase):
     def setUp(self): #Create test user and budget
+        caches['budget-reports'].clear() #Budget ids repeat between tests
         self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
         self.client = APIClient()
         self.client.force_authenticate(user=self.user)
@@ -200,8 +1454,116 @@ class BudgetReportTests(TestCase):
         self.assertEqual(response.data["category_spending"]["Meal"], 100.00)
         self.assertEqual(response.data["category_spending"]["Entertainment"], 50.00)
 
+    def test_budget_report_item_counts(self): #Check if parsed items are counted in the database, receipts without items count as one
+        self.receipt1.parsed_items = [{"name": "Chicken", "price": 60.00}, {"name": "Chips", "price": 40.00}]
+        self.receipt1.save()
+        Receipt.objects.create(user=self.user, merchant="Boots", total_amount=5.00, transaction_date="2024-02-16", receipt_category=CategoryChoices.MEAL.value, parsed_items=[]).budget.add(self.budget)
+
+        response = self.client.get(f'/api/budget-report/{self.budget.id}/')
+        self.assertEqual(response.data["total_spent"], Decimal("155.00"))
+        self.assertEqual(response.data["category_spending"], {"Meal": Decimal("105.00"), "Entertainment": Decimal("50.00")})
+        self.assertEqual(response.data["category_items"], {"Meal": 3, "Entertainment": 1})
+        self.assertEqual(response.data["total_items"], 4)
+        self.assertNotIn("receipts", response.data["budget"])
+
+    def test_budget_report_query_count(self): #Check if the report takes the same queries however many receipts the budget has
+        Receipt.objects.bulk_create([
+            Receipt(user=self.user, merchant=f"Shop {i}", total_amount=1.00, transaction_date="2024-02-20", receipt_category=CategoryChoices.FUEL.value, parsed_items=[{"name": "Fuel"}])
+            for i in range(50)
+        ])
+        self.budget.receipts.add(*Receipt.objects.filter(merchant__startswith="Shop"))
+        with self.assertNumQueries(2): #Budget, spending grouped by category
+            response = self.client.get(f'/api/budget-report/{self.budget.id}/')
+        self.assertEqual(response.data["category_items"]["Fuel"], 50)
+        self.assertEqual(response.data["total_spent"], Decimal("200.00"))
+
+class BudgetReportCacheTests(TestCase):
+    def setUp(self): #Create test user and a budget with one receipt
+        caches['budget-reports'].clear()
+        self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.budget = Budget.objects.create(user=self.user, name="Test Budget", limit_amount=500.00, start_date="2024-02-01", end_date="2024-02-28")
+        self.receipt = Receipt.objects.create(user=self.user, merchant="Nandos", total_amount=100.00, transaction_date="2024-02-10", receipt_category=CategoryChoices.MEAL.value)
+        self.receipt.assign_to_budget()
+
+    def report(self):
+        return self.client.get(f'/api/budget-report/{self.budget.id}/').data
+
+    def version(self):
+        return Budget.objects.values_list("report_version", flat=True).get(pk=self.budget.pk)
+
+    def test_repeat_view_is_one_lookup(self): #Check if an unchanged budget is served from the cache without aggregating again
+        self.report()
+        with self.assertNumQueries(1): #Only the budget itself
+            with mock.patch('api.views.budget_spending_summary') as mock_summary:
+                data = self.report()
+        mock_summary.assert_not_called()
+        self.assertEqual(data["total_spent"], Decimal("100.00"))
+
+    def test_recategorise_invalidates(self): #Check if changing a receipt's category shows up in the next report
+        self.report()
+        version = self.version()
+        response = self.client.patch(f'/api/receipts/{self.receipt.id}/', {"receipt_category": CategoryChoices.HEALTHCARE.value}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreater(self.version(), version)
+        self.assertEqual(self.report()["category_spending"], {"Healthcare": Decimal("100.00")})
+
+    def test_link_unlink_and_delete_invalidate(self): #Check if linking, unlinking and deleting receipts each move the version on
+        versions = [self.version()]
+        other = Receipt.objects.create(user=self.user, merchant="Boots", total_amount=5.00, receipt_category=CategoryChoices.HEALTHCARE.value)
+        self.budget.receipts.add(other)
+        versions.append(self.version())
+        other.budget.remove(self.budget)
+        versions.append(self.version())
+        self.assertEqual(self.report()["total_spent"], Decimal("100.00"))
+        response = self.client.delete(f'/api/receipts/{self.receipt.id}/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        versions.append(self.version())
+        self.assertEqual(versions, sorted(set(versions)))
+        self.assertEqual(self.report()["total_spent"], Decimal("0"))
+
+    def test_unrelated_budget_keeps_cache(self): #Check if a change to another budget's receipts does not touch this budget's version
+        version = self.version()
+        other_budget = Budget.objects.create(user=self.user, name="March", limit_amount=50.00, start_date="2024-03-01", end_date="2024-03-31")
+        Receipt.objects.create(user=self.user, merchant="Tesco", total_amount=5.00, transaction_date="2024-03-10").assign_to_budget()
+        self.assertEqual(self.version(), version)
+        self.assertEqual(Budget.objects.get(pk=other_budget.pk).report_version, 1)
+
+    def test_budget_edit_invalidates(self): #Check if editing the budget itself is reflected in the cached report
+        self.report()
+        self.client.patch(f'/api/budgets/{self.budget.id}/', {"name": "Renamed"}, format='json')
+        self.assertEqual(self.report()["budget"]["name"], "Renamed")
+
+    def test_stale_save_keeps_version(self): #Check if saving a budget loaded earlier moves the version on rather than winding it back
+        stale_budget = Budget.objects.get(pk=self.budget.pk)
+        Receipt.objects.create(user=self.user, merchant="Tesco", total_amount=5.00, transaction_date="2024-02-11").assign_to_budget()
+        version = self.version()
+        stale_budget.name = "Renamed"
+        stale_budget.save()
+        self.assertEqual(self.version(), version + 1)
+        self.assertEqual(stale_budget.report_version, version + 1)
+
+    def test_save_and_update_invalidate(self): #Check if edits outside the API, e.g. from the admin, are not served from an old cached report
+        self.report()
+        budget = Budget.objects.get(pk=self.budget.pk)
+        budget.limit_amount = Decimal("750.00")
+        budget.save(update_fields=["limit_amount"])
+        self.assertEqual(self.report()["budget"]["limit_amount"], "750.00")
+
+        Budget.objects.filter(pk=self.budget.pk).update(name="Renamed")
+        self.assertEqual(self.report()["budget"]["name"], "Renamed")
+
+    def test_xlsx_cached(self): #Check if the second download of an unchanged budget is served from the cache
+        first = b"".join(self.client.get(f'/api/budget-report/{self.budget.id}/xlsx/').streaming_content)
+        with mock.patch('api.views.write_budget_report_xlsx') as mock_write:
+            second = b"".join(self.client.get(f'/api/budget-report/{self.budget.id}/xlsx/').streaming_content)
+        mock_write.assert_not_called()
+        self.assertEqual(first, second)
+
 class BudgetReportXlsxTests(TestCase):
     def setUp(self): #Create test user and budget for xlsx export
+        caches['budget-reports'].clear() #Budget ids repeat between tests
         self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
         self.client = APIClient()
         self.client.force_authenticate(user=self.user)
@@ -241,7 +1603,7 @@ class BudgetReportXlsxTests(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response["Content-Type"], "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
         
-        excel_file = BytesIO(response.content)
+        excel_file = BytesIO(b"".join(response.streaming_content))
         workbook = openpyxl.load_workbook(excel_file)
         
         #Check budget summary
@@ -257,9 +1619,227 @@ class BudgetReportXlsxTests(TestCase):
         receipts_sheet = workbook["Receipts"]
         self.assertEqual(receipts_sheet.cell(row=2, column=2).value, "Nandos")
         self.assertEqual(float(receipts_sheet.cell(row=2, column=3).value), 100.00)
+
+    def test_budget_report_xlsx_items_and_widths(self): #Check if every item gets a row and column widths fit the longest value
+        self.receipt1.parsed_items = [
+            {"description": {"value": "Chicken"}, "total_price": {"value": 60.0}},
+            {"description": {"value": "A very long item description"}, "total_price": {"value": 30.0}},
+            {"description": {"value": "Chips"}, "total_price": {"value": 10.0}},
+        ]
+        self.receipt1.save()
+        Receipt.objects.create(user=self.user, merchant="No Total", transaction_date="2024-02-20").budget.add(self.budget)
+
+        response = self.client.get(f'/api/budget-report/{self.budget.id}/xlsx/')
+        self.assertTrue(response.streaming)
+        workbook = openpyxl.load_workbook(BytesIO(b"".join(response.streaming_content)))
+        rows = list(workbook["Receipts"].iter_rows(values_only=True))
+        self.assertEqual(rows[1][1:], ("Nandos", "100.00", "10/02/2024", "Meal", "Chicken", "60.00"))
+        self.assertEqual(rows[2], (None, None, None, None, None, "A very long item description", "30.00"))
+        self.assertEqual(rows[3][5:], ("Chips", "10.00"))
+        self.assertEqual(rows[4][1:], ("Cineworld", "50.00", "15/02/2024", "Entertainment", "No Items", "-"))
+        self.assertEqual(rows[5][1:3], ("No Total", None))
+        self.assertEqual(workbook["Receipts"].column_dimensions["F"].width, len("A very long item description") + 2)
         
+class AccountExportTests(TestCase):
+    def setUp(self): #Create test user with receipts, items and expenses, and another user whose data must not leak
+        self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.receipt = Receipt.objects.create(user=self.user, merchant="Tesco, Ireland", total_amount=12.50, transaction_date="2024-02-10", receipt_category=CategoryChoices.SUPPLIES.value, parsed_items=[
+            {"description": {"value": "Milk"}, "quantity": {"value": "2"}, "total_price": {"value": "2.50"}},
+            {"description": {"value": "Bread"}, "total_price": {"value": "10.00"}},
+        ])
+        Receipt.objects.create(user=self.user, merchant="Nandos", total_amount=20.00)
+        Expense.objects.create(user=self.user, name="Taxi", amount=15.00, category=CategoryChoices.TRANSPORTATION.value, date="2024-02-11")
+        other = User.objects.create_user(email="other@test.com", password="test12345",full_name="other",date_of_birth="2004-09-07")
+        Receipt.objects.create(user=other, merchant="Secret", total_amount=1.00)
+
+    def content(self, response): #Body of a streamed response
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        return b"".join(response.streaming_content)
+
+    def test_receipts_csv(self): #Check if receipts stream as csv with a header row, only for the user
+        response = self.client.get('/api/export/receipts.csv')
+        self.assertEqual(response["Content-Type"], "text/csv")
+        rows = list(csv.reader(self.content(response).decode().splitlines()))
+        self.assertEqual(rows[0][:3], ["id", "merchant", "total_amount"])
+        self.assertEqual([row[1] for row in rows[1:]], ["Tesco, Ireland", "Nandos"])
+
+    def test_items_ndjson(self): #Check if each parsed line item becomes one json line
+        response = self.client.get('/api/export/items.ndjson')
+        lines = [json.loads(line) for line in self.content(response).decode().splitlines()]
+        self.assertEqual(lines, [
+            {"receipt_id": self.receipt.id, "line": 1, "description": "Milk", "quantity": "2", "total_price": "2.50"},
+            {"receipt_id": self.receipt.id, "line": 2, "description": "Bread", "quantity": None, "total_price": "10.00"},
+        ])
+
+    def test_items_with_bad_shape_are_skipped(self): #Check if items edited into another shape through the API do not cut the export short
+        response = self.client.patch(f'/api/receipts/{self.receipt.id}/', {'parsed_items': [ #Fields that are not {"value": ...}
+            {"description": "Eggs", "quantity": 3, "total_price": {"value": "4.00"}},
+            "milk",
+        ]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        rows = list(csv.reader(self.content(self.client.get('/api/export/items.csv')).decode().splitlines()))
+        self.assertEqual(rows, [ITEM_COLUMNS, [str(self.receipt.id), "1", "", "", "4.00"]])
+
+    def test_expenses_ndjson(self): #Check if expenses serialise decimals and dates
+        lines = self.content(self.client.get('/api/export/expenses.ndjson')).decode().splitlines()
+        self.assertEqual(json.loads(lines[0])["amount"], "15.00")
+        self.assertEqual(json.loads(lines[0])["date"], "2024-02-11")
+
+    def test_account_zip(self): #Check if the zip bundles every dataset and can be read back
+        response = self.client.get('/api/export/account.zip', {'type': 'ndjson'})
+        self.assertEqual(response["Content-Type"], "application/zip")
+        with zipfile.ZipFile(BytesIO(self.content(response))) as archive:
+            self.assertEqual(archive.namelist(), ["receipts.ndjson", "items.ndjson", "expenses.ndjson"])
+            self.assertEqual(len(archive.read("items.ndjson").decode().splitlines()), 2)
+
+    def test_large_export_is_chunked(self): #Check if a big export is sent in several pieces rather than built up in one
+        Expense.objects.bulk_create([Expense(user=self.user, name=f"Expense {i}", amount=1.00) for i in range(5000)])
+        response = self.client.get('/api/export/expenses.csv')
+        chunks = list(response.streaming_content)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(len(b"".join(chunks).decode().splitlines()), 5002)
+
+    def test_unknown_export(self): #Check if unknown datasets and types are rejected
+        self.assertEqual(self.client.get('/api/export/budgets.csv').status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get('/api/export/receipts.xml').status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get('/api/export/account.zip', {'type': 'xml'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+class MonthlySpendingTests(TestCase):
+    def setUp(self): #Create test user
+        self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def rollups(self): #Non-empty rollups as (month, category, receipt total, receipt count, expense total, expense count)
+        return sorted(
+            (rollup.month.strftime("%Y-%m"), rollup.category, rollup.receipt_total, rollup.receipt_count, rollup.expense_total, rollup.expense_count)
+            for rollup in MonthlySpending.objects.filter(user=self.user).exclude(receipt_count=0, expense_count=0)
+        )
+
+    def test_receipt_changes(self): #Check if receipts move the rollups as they are created, edited and deleted
+        receipt = Receipt.objects.create(user=self.user, merchant="Nandos", total_amount=20.00, transaction_date=make_aware(dt.datetime(2024, 2, 10)), receipt_category=CategoryChoices.MEAL.value)
+        Receipt.objects.create(user=self.user, merchant="Tesco", total_amount=5.00, transaction_date=make_aware(dt.datetime(2024, 2, 12)), receipt_category=CategoryChoices.MEAL.value)
+        self.assertEqual(self.rollups(), [("2024-02", "Meal", Decimal("25.00"), 2, Decimal("0.00"), 0)])
+
+        receipt.total_amount = 30.00
+        receipt.transaction_date = make_aware(dt.datetime(2024, 3, 1))
+        receipt.receipt_category = CategoryChoices.FUEL.value
+        receipt.save()
+        self.assertEqual(self.rollups(), [
+            ("2024-02", "Meal", Decimal("5.00"), 1, Decimal("0.00"), 0),
+            ("2024-03", "Fuel", Decimal("30.00"), 1, Decimal("0.00"), 0),
+        ])
+
+        receipt.delete()
+        self.assertEqual(self.rollups(), [("2024-02", "Meal", Decimal("5.00"), 1, Decimal("0.00"), 0)])
+
+    def test_expense_changes(self): #Check if expenses move the rollups and undated ones are left out
+        expense = Expense.objects.create(user=self.user, name="Taxi", amount=15.00, category=CategoryChoices.TRANSPORTATION.value, date="2024-02-11")
+        Expense.objects.create(user=self.user, name="Undated", amount=99.00)
+        self.assertEqual(self.rollups(), [("2024-02", "Transportation", Decimal("0.00"), 0, Decimal("15.00"), 1)])
+
+        expense.amount = 20.00
+        expense.save()
+        self.assertEqual(self.rollups(), [("2024-02", "Transportation", Decimal("0.00"), 0, Decimal("20.00"), 1)])
+
+        expense.delete()
+        self.assertEqual(self.rollups(), [])
+
+    def test_bulk_created_expenses_counted(self): #Check if expenses from receipt scans and imports are counted although bulk_create sends no signals
+        save_receipt_data(self.user, "http://example.com/blob.jpg", fake_receipt_data(total=20.00))
+        self.client.post('/api/import/expenses/', "amount,category,date\n5.00,Meal,2024-02-20\n", content_type="text/csv")
+        self.assertEqual(self.rollups(), [("2024-02", "Meal", Decimal("20.00"), 1, Decimal("25.00"), 2)])
+
+    def test_rebuild_matches_signals(self): #Check if the rebuild command counts the same as the signals
+        Receipt.objects.create(user=self.user, total_amount=20.00, uploaded_at=make_aware(dt.datetime(2024, 1, 31, 23, 30)), receipt_category=CategoryChoices.MEAL.value)
+        Receipt.objects.create(user=self.user, total_amount=None, transaction_date=make_aware(dt.datetime(2024, 2, 1)))
+        Expense.objects.create(user=self.user, amount=15.00, category=CategoryChoices.MEAL.value, date="2024-01-05")
+        expected = self.rollups()
+
+        MonthlySpending.objects.update(receipt_total=0) #Drifted
+        call_command("rebuild_spending_rollups", user=[self.user.email], stdout=StringIO())
+        self.assertEqual(self.rollups(), expected)
+        self.assertEqual(expected[0], ("2024-01", "Meal", Decimal("20.00"), 1, Decimal("15.00"), 1))
+
+    def test_timeseries(self): #Check if the endpoint answers from the rollups with per category series and monthly totals
+        for day, category, amount in [(10, "Meal", 20.00), (12, "Fuel", 40.00), (40, "Meal", 5.00)]:
+            Receipt.objects.create(user=self.user, total_amount=amount, transaction_date=make_aware(dt.datetime(2024, 1, 1) + timedelta(days=day)), receipt_category=category)
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/analytics/timeseries/', {'start': '2024-01', 'end': '2024-02'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([(point["month"], point["category"], point["receipt_total"]) for point in response.data["series"]], [
+            ("2024-01", "Fuel", "40.00"), ("2024-01", "Meal", "20.00"), ("2024-02", "Meal", "5.00"),
+        ])
+        self.assertEqual([(point["month"], point["receipt_total"], point["receipt_count"]) for point in response.data["totals"]], [
+            ("2024-01", "60.00", 2), ("2024-02", "5.00", 1),
+        ])
+
+        response = self.client.get('/api/analytics/timeseries/', {'category': 'Meal', 'start': '2024-02'})
+        self.assertEqual([point["month"] for point in response.data["series"]], ["2024-02"])
+
+    def test_timeseries_rejects_bad_params(self): #Check if malformed months and unknown categories are rejected
+        self.assertEqual(self.client.get('/api/analytics/timeseries/', {'start': '2024-13'}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get('/api/analytics/timeseries/', {'category': 'Sweets'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+class ExpenseImportTests(TestCase):
+    def setUp(self): #Create test user
+        self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_csv_body(self): #Check if a csv body is imported, blank cells taking the defaults
+        body = "name,amount,category,vendor,date\nTaxi,15.00,Transportation,Uber,2024-02-11\n,4.50,,,\n"
+        response = self.client.post('/api/import/expenses/', body, content_type="text/csv")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data, {"created": 2, "failed": 0, "errors": []})
+        expense = Expense.objects.get(user=self.user, amount=Decimal("4.50"))
+        self.assertEqual((expense.name, expense.category, expense.date), ("Expense", CategoryChoices.OTHER.value, None))
+
+    def test_export_round_trip(self): #Check if a csv upload made by the expense export imports again
+        Expense.objects.create(user=self.user, name="Taxi", amount=15.00, category=CategoryChoices.TRANSPORTATION.value, date="2024-02-11")
+        exported = b"".join(self.client.get('/api/export/expenses.csv').streaming_content)
+        response = self.client.post('/api/import/expenses/', {'file': SimpleUploadedFile("expenses.csv", exported)}, format="multipart")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Expense.objects.filter(user=self.user, name="Taxi", date="2024-02-11").count(), 2)
+
+    def test_json_reports_row_errors(self): #Check if bad rows are reported by number and the good rows are still kept
+        rows = [{"name": "Lunch", "amount": "9.99"}, {"name": "No amount"}, {"amount": "abc"}, "not an expense", {"amount": "1.00", "category": "Meal"}]
+        response = self.client.post('/api/import/expenses/', json.dumps(rows), content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["created"], 2)
+        self.assertEqual(response.data["failed"], 3)
+        self.assertEqual([error["row"] for error in response.data["errors"]], [2, 3, 4])
+        self.assertIn("amount", response.data["errors"][0]["errors"])
+        self.assertEqual(Expense.objects.filter(user=self.user).count(), 2)
+
+    @mock.patch('api.imports.BATCH_SIZE', 100)
+    @mock.patch('api.imports.READ_BYTES', 50)
+    def test_large_json_in_batches(self): #Check if a big list is read in pieces and inserted one batch at a time
+        rows = [{"name": f"Expense {i}", "amount": "1.00", "date": "2024-01-01"} for i in range(1050)]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/import/expenses/', json.dumps(rows), content_type="application/json")
+        self.assertEqual(response.data["created"], 1050)
+        inserts = [query for query in queries if query["sql"].startswith('INSERT INTO "api_expense"')]
+        self.assertEqual(len(inserts), 11)
+        self.assertEqual(Expense.objects.filter(user=self.user).count(), 1050)
+
+    def test_unreadable_file_keeps_nothing(self): #Check if a broken file is rejected without importing part of it
+        body = '[{"amount": "1.00"}, {"amount": "2.00"} {"amount": "3.00"}]'
+        with mock.patch('api.imports.BATCH_SIZE', 1):
+            response = self.client.post('/api/import/expenses/', body, content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Expense.objects.filter(user=self.user).exists())
+
+    def test_unknown_format(self): #Check if other formats are rejected
+        response = self.client.post('/api/import/expenses/', "<expenses/>", content_type="application/xml")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
 class IntegrationTest(TestCase):
     def setUp(self): #Create test user
+        caches['budget-reports'].clear() #Budget ids repeat between tests
         self.client = APIClient()
         self.user = User.objects.create_user(email="test@test.com", password="test12345",full_name="test",date_of_birth="2004-09-07")
         self.client.force_authenticate(user=self.user)
@@ -370,3 +1950,27 @@ class IntegrationTest(TestCase):
         response = self.client.get(f'/api/budget-report/{self.budget_id}/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data["total_spent"], 0.00)  #Budget should be cleared after deletion
+
+class BenchmarkSuiteTests(TestCase):
+    def test_benchmark_api_runs_every_scenario(self): #Check if the suite measures every hot path on a tiny seed and keeps none of it
+        caches['budget-reports'].set("real-report", "kept")
+        output = StringIO()
+        call_command('benchmark_api', users=1, budgets=2, receipts=20, expenses=20, runs=1, warmup=0, stdout=output, stderr=StringIO())
+        results = json.loads(output.getvalue())["results"]
+        self.assertEqual(
+            {result["scenario"] for result in results},
+            {"receipt_list", "receipt_list_all", "budget_list", "expense_list", "expense_list_all", "budget_report", "budget_report_xlsx", "assign_to_budget", "analyse_receipt"},
+        )
+        self.assertTrue(all(result["queries"]["max"] > 0 for result in results))
+        self.assertFalse(User.objects.exists())
+        self.assertEqual(caches['budget-reports'].get("real-report"), "kept") #The benchmark clears its own throwaway caches only
+
+    def test_receipt_concurrency_counts_errors(self): #Check if failed scans are reported instead of making a run look fast
+        failures = [RuntimeError("Analysis failed"), None] * 2
+        output = StringIO()
+        with mock.patch('api.management.commands.benchmark_receipt_concurrency.scan_receipt_image', side_effect=failures), \
+                mock.patch('api.management.commands.benchmark_receipt_concurrency.ascan_receipt_image', side_effect=failures):
+            call_command('benchmark_receipt_concurrency', scans=4, concurrency=[2], latency=0, stdout=output, stderr=StringIO())
+        results = json.loads(output.getvalue())["results"]
+        self.assertEqual({result["mode"]: result["errors"] for result in results}, {"threads": 2, "asyncio": 2})
+        self.assertTrue(all(result["timings"]["runs"] == 2 for result in results))
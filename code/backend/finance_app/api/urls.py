@@ -2,6 +2,7 @@ from django.urls import path, include
 from rest_framework import routers
 from api import views
 from .views import *
+from django.conf import settings
 from drf_spectacular.views import SpectacularAPIView, SpectacularRedocView, SpectacularSwaggerView
 
 router = routers.DefaultRouter()
@@ -9,6 +10,7 @@ router.register('users', UserViewSet, basename='users')
 router.register('expenses', ExpenseViewSet, basename='expenses')
 router.register('receipts', ReceiptViewSet, basename='receipts')
 router.register('budgets', BudgetViewSet, basename='budgets')
+router.register('receipt-jobs', ReceiptJobViewSet, basename='receipt-jobs')
 
 
 urlpatterns = [
@@ -16,9 +18,16 @@ urlpatterns = [
     path('api/schema/', SpectacularAPIView.as_view(), name='schema'),
     path('', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
     path('api/schema/redoc', SpectacularRedocView.as_view(url_name='schema'), name='redoc'),
-    path('api/process-receipt/', ProcessReceiptView.as_view(), name='process-receipt'),
+    path('api/process-receipt/', (AsyncProcessReceiptView if settings.RECEIPT_PROCESSING_ASYNC else ProcessReceiptView).as_view(), name='process-receipt'),
+    path('api/process-receipt/async/', AsyncProcessReceiptView.as_view(), name='process-receipt-async'),
+    path('api/process-receipt/batch/', ProcessReceiptBatchView.as_view(), name='process-receipt-batch'),
+    path('api/receipt-analysis-cache/', ReceiptAnalysisCacheStatsView.as_view(), name='receipt-analysis-cache'),
     path("api/budget-report/<int:budget_id>/", BudgetReportView.as_view(), name="budget-report"),
     path('login/', EmailPasswordLoginView.as_view(), name='login'),
     path('logout/', LogoutView.as_view(), name='logout'),
     path("api/budget-report/<int:budget_id>/xlsx/", BudgetReportXlsxView.as_view(), name="budget_report_xlsx"),
+    path('api/search/receipts/', ReceiptSearchView.as_view(), name='receipt-search'),
+    path('api/analytics/timeseries/', SpendingTimeseriesView.as_view(), name='spending-timeseries'),
+    path('api/import/expenses/', ExpenseImportView.as_view(), name='expense-import'),
+    path('api/export/<slug:dataset>.<slug:file_type>', AccountExportView.as_view(), name='account-export'),
 ]
\ No newline at end of file
@@ -1,39 +1,53 @@
-from azure.ai.documentintelligence import DocumentIntelligenceClient
-from azure.ai.documentintelligence.models import AnalyzeResult, AnalyzeDocumentRequest
-from azure.core.credentials import AzureKeyCredential
-from azure.storage.blob import (
-    BlobServiceClient,
-    generate_blob_sas,
-    BlobSasPermissions,
-    ContentSettings,
-)
-from django.http import HttpResponse
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
+from azure.ai.documentintelligence.models import AnalyzeResult
+from django.http import FileResponse, JsonResponse, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from django.shortcuts import get_object_or_404
+from django.utils.decorators import method_decorator
+from django.db import transaction
+from django.db.models import Prefetch
 from django.conf import settings
 from django.contrib.auth import authenticate, logout
 from rest_framework import viewsets, filters, status
 from rest_framework.views import APIView
+from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from rest_framework.exceptions import APIException
+from asgiref.sync import sync_to_async
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, AllowAny
-from datetime import datetime, timedelta
+from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
+from rest_framework_simplejwt.tokens import RefreshToken
+from datetime import datetime
 from dotenv import load_dotenv
-from PIL import Image
-import requests
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import logging
 import base64
 import os
 import time
-import openpyxl
+import uuid
+import tempfile
 from io import BytesIO
-from openpyxl.utils import get_column_letter
-from openpyxl.styles import Font
 from .models import *
 from .serializers import *
+from .jobs import submit_receipt_job
+from .pagination import KeysetPagination, RankedPagination
+from .search import search_index, search_terms
+from .imports import import_expenses, ImportFormatError, StreamParser, CONTENT_TYPES as IMPORT_CONTENT_TYPES, FORMATS as IMPORT_FORMATS
+from .exports import export_chunks, zip_export_chunks, DATASETS as EXPORT_DATASETS, FORMATS as EXPORT_FORMATS
+from .reports import write_budget_report_xlsx, RECEIPT_FIELDS, XLSX_CONTENT_TYPE
+from .caching import analysis_cache, budget_report_cache, hash_image, conditional_on_user_data
+from .backends import get_receipt_storage, get_receipt_analyzer, native_aio
+from .fetching import ImageDownloadError, fetch_image, afetch_image
+from . import imaging
 import django_filters.rest_framework as filters
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 '''Handles user authentication and management'''
 class UserViewSet(viewsets.ModelViewSet):
     queryset = User.objects.all()
@@ -66,9 +80,12 @@ class EmailPasswordLoginView(APIView):
         user = authenticate(request, email=email, password=password)
 
         if user:
+            refresh = RefreshToken.for_user(user)
             return Response({
                 "message": "Login successful!",
-                "Authorization": f"Basic {base64.b64encode(f'{email}:{password}'.encode()).decode()}" #encodes email and password for basic authentication
+                "access": str(refresh.access_token), #Send as "Bearer <access>", no password check per request
+                "refresh": str(refresh), #Exchange at api/token/refresh/ for a new access token
+                "Authorization": f"Basic {base64.b64encode(f'{email}:{password}'.encode()).decode()}" #encodes email and password for basic authentication, kept for app versions without token support
             }, status=status.HTTP_200_OK)
 
         return Response({"error": "Invalid email or password"}, status=status.HTTP_401_UNAUTHORIZED)
@@ -82,33 +99,76 @@ class LogoutView(APIView):
         return Response({"message": "Logged out successfully!"}, status=status.HTTP_200_OK)
   
 '''Expense viewset'''
+@method_decorator(conditional_on_user_data, name='list')
+@method_decorator(conditional_on_user_data, name='retrieve')
 class ExpenseViewSet(viewsets.ModelViewSet):
     serializer_class = ExpenseSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+    keyset_ordering = ('-date', '-id')
     def get_queryset(self): #Returns expenses for authenticated user
         return Expense.objects.filter(user=self.request.user)    
     
     def perform_create(self, serializer): #Assign expense to user
         serializer.save(user=self.request.user)
 
+'''Filters for the budget list, filter_categories matches budgets that filter on all of the given categories'''
+class BudgetFilter(filters.FilterSet):
+    filter_categories = filters.MultipleChoiceFilter(choices=CategoryChoices.choices, method='filter_by_categories')
+
+    class Meta:
+        model = Budget
+        fields = ['id', 'start_date', 'end_date']
+
+    def filter_by_categories(self, queryset, name, value):
+        return queryset.including(value) if value else queryset
+
+'''Read ?fields= and ?expand= into serializer context, expand falls back to default_expand when it is not given'''
+def sparse_fields_context(request, default_expand=()):
+    params = request.query_params
+    fields = [name for name in params.get('fields', '').split(',') if name]
+    expand = [name for name in params.get('expand', '').split(',') if name] if 'expand' in params else list(default_expand)
+    return {'fields': fields or None, 'expand': expand}
+
 '''Budget viewset'''
+@method_decorator(conditional_on_user_data, name='list')
+@method_decorator(conditional_on_user_data, name='retrieve')
 class BudgetViewSet(viewsets.ModelViewSet):
     serializer_class = BudgetSerializer
     permission_classes = [IsAuthenticated]
-    def get_queryset(self): #Returns budget for authenticated user
-        return Budget.objects.filter(user=self.request.user)    
+    pagination_class = KeysetPagination
+    keyset_ordering = ('-start_date', '-id')
+    def get_queryset(self): #Returns budget for authenticated user, with receipts fetched in one extra query when they will be sent
+        budgets = Budget.objects.filter(user=self.request.user)
+        if BudgetSerializer.includes_field('receipts', self.get_serializer_context()):
+            budgets = budgets.prefetch_related(Prefetch('receipts', queryset=Receipt.objects.order_by('-uploaded_at')))
+        return budgets
     filter_backends = (filters.DjangoFilterBackend,)
-    filterset_fields = ['id', 'start_date', 'end_date', 'filter_categories']
+    filterset_class = BudgetFilter
+
+    def get_serializer_context(self): #The list is a compact summary unless ?expand=receipts, a single budget keeps its receipts
+        context = super().get_serializer_context()
+        if self.request.method == 'GET':
+            context.update(sparse_fields_context(self.request, default_expand=() if self.action == 'list' else ('receipts',)))
+        return context
 
     def perform_create(self, serializer): #Assign budget to user
         serializer.save(user=self.request.user)
 
+    def perform_update(self, serializer): #Changing the category filter changes which receipts count, so recompute, which also moves the report version on
+        budget = serializer.save()
+        budget.update_spending()
+
 '''Receipt viewset'''
+@method_decorator(conditional_on_user_data, name='list')
+@method_decorator(conditional_on_user_data, name='retrieve')
 class ReceiptViewSet(viewsets.ModelViewSet):
     serializer_class = ReceiptSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+    keyset_ordering = ('-uploaded_at', '-id')
     def get_queryset(self): #Return receipt for authenticated user
-        return Receipt.objects.filter(user=self.request.user).order_by('-uploaded_at')
+        return Receipt.objects.filter(user=self.request.user).order_by(*self.keyset_ordering)
     filter_backends = (filters.DjangoFilterBackend,)
     filterset_fields = ['id','receipt_category']
     
@@ -116,6 +176,7 @@ class ReceiptViewSet(viewsets.ModelViewSet):
         receipt = serializer.save(user=self.request.user)
         receipt.assign_to_budget()
         
+    @transaction.atomic #The category read here and the budgets moved below belong to the same edit
     def update(self, request, *args, **kwargs): #Ensure that changing the category triggers budget updats
         instance = self.get_object()
         old_category = instance.receipt_category  #Store the previous category before update
@@ -126,26 +187,7 @@ class ReceiptViewSet(viewsets.ModelViewSet):
         new_category = instance.receipt_category  #Get the updated category
 
         if old_category != new_category:  #Check if the category was changed
-            affected_budgets = list(instance.budget.all())
-            instance.budget.clear() #Remove from old budget
-            instance.assign_to_budget()
-
-            for budget in affected_budgets:  
-                budget.update_spending()  #Update old budgets that lost this receipt
-
-            for budget in instance.budget.all():  
-                budget.update_spending()  #Update new budgets that gained this receipt
-        return response
-
-    def destroy(self, request, *args, **kwargs):
-        instance = self.get_object()
-        affected_budgets = list(instance.budget.all())  #Store budgets before deletion
-
-        response = super().destroy(request, *args, **kwargs)
-
-        for budget in affected_budgets:
-            budget.update_spending()
-
+            instance.assign_to_budget() #Moves the receipt between budgets, spending follows through the budget signals
         return response
 
 
@@ -159,93 +201,286 @@ class ProcessReceiptView(APIView):
         image_url = request.data.get('image_url')
         uploaded_file = request.FILES.get('image')
         
-        if uploaded_file: #Check if there is a uploaded file
-            blob_name = generate_filename(uploaded_file.name) #Generate a name
-            receiptUrl = upload_image_to_azure(uploaded_file, blob_name) #Turn the uploaded file into a url and store it in blob storage
-        elif image_url: #Check if a image url is given instead
-            try:
-                response = requests.get(image_url, timeout=10) #Download the image from the URL
-                if response.status_code != 200:
-                    return Response({"error": "Failed to download image from URL."}, status=status.HTTP_400_BAD_REQUEST)
-
-                image_content = ContentFile(response.content) #Convert to Django file
-                blob_name = generate_filename("receipt_from_url.jpg") #Generate a name
-                receiptUrl = upload_image_to_azure(image_content, blob_name) #Turn the uploaded file into a url and store it in blob storage
-
-            except requests.exceptions.RequestException as e:
-                return Response({"error": f"Error fetching image from URL: {str(e)}"}, status=status.HTTP_400_BAD_REQUEST)        
-        else:
+        if not uploaded_file and not image_url:
             return Response({"error": "No image file or image_url provided."}, status=status.HTTP_400_BAD_REQUEST)
-        
-        extracted_data = analyse_receipt(receiptUrl, request) #Process the image and return extracted data from receipt
+
+        if is_job_mode(request): #Accept the scan straight away and let a worker process it
+            job = submit_receipt_job(request.user, image_file=uploaded_file, image_url=image_url)
+            return Response({
+                "job_id": str(job.id),
+                "status": job.status,
+                "status_url": request.build_absolute_uri(f"/api/receipt-jobs/{job.id}/"),
+            }, status=status.HTTP_202_ACCEPTED)
+
+        try:
+            extracted_data = process_receipt_image(request.user, image_file=uploaded_file, image_url=image_url) #Process the image and return extracted data from receipt
+        except ImageDownloadError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         return Response(extracted_data, status=status.HTTP_201_CREATED)
 
-'''Create unique name for image'''
-def generate_filename(filename):
-    timestamp = int(time.time()) #Get current timestamp
-    extension = filename.split('.')[-1] #Extract file extension
-    return f"{timestamp}.{extension}" #Return unique filename
+'''ProcessReceiptView for ASGI servers. Waiting on the download, storage and OCR holds no thread, so one worker keeps hundreds of scans in flight.
+Authentication, parsing and database writes are sync and run through sync_to_async'''
+@method_decorator(csrf_exempt, name='dispatch') #As for APIView, SessionAuthentication checks CSRF itself
+class AsyncProcessReceiptView(View):
+    http_method_names = ['post']
+    parser_classes = [MultiPartParser, FormParser, JSONParser]
+
+    def initialize_request(self, request): #DRF request with the user authenticated and the body parsed, returns it or an error response
+        drf_request = Request(
+            request,
+            parsers=[parser() for parser in self.parser_classes],
+            authenticators=[authenticator() for authenticator in api_settings.DEFAULT_AUTHENTICATION_CLASSES],
+        )
+        try:
+            if not drf_request.user.is_authenticated:
+                return drf_request, JsonResponse({"detail": "Authentication credentials were not provided."}, status=status.HTTP_401_UNAUTHORIZED)
+            drf_request.data #Parse while still on a thread
+        except APIException as e:
+            return drf_request, JsonResponse({"detail": str(e.detail)}, status=e.status_code)
+        return drf_request, None
+
+    async def post(self, request):
+        #Under WSGI every request runs on an event loop of its own, so only ASGI requests use the per loop aiohttp clients
+        token = native_aio.set(isinstance(request, ASGIRequest))
+        try:
+            return await self.process(request)
+        finally:
+            native_aio.reset(token)
+
+    async def process(self, request):
+        request, error = await sync_to_async(self.initialize_request)(request)
+        if error is not None:
+            return error
 
-'''Uploads an image to Azure Blob Storage and returns a URL'''
-def upload_image_to_azure(image_file, blob_name):
-    
-    AZURE_STORAGE_ACCOUNT_NAME = os.getenv("AZURE_STORAGE_ACCOUNT_NAME")
-    AZURE_STORAGE_ACCOUNT_KEY = os.getenv("AZURE_STORAGE_ACCOUNT_KEY")
-    AZURE_CONTAINER_NAME = os.getenv("AZURE_CONTAINER_NAME")
+        image_url = request.data.get('image_url')
+        uploaded_file = request.FILES.get('image')
+        if not uploaded_file and not image_url:
+            return JsonResponse({"error": "No image file or image_url provided."}, status=status.HTTP_400_BAD_REQUEST)
+
+        if is_job_mode(request):
+            job = await sync_to_async(submit_receipt_job)(request.user, image_file=uploaded_file, image_url=image_url)
+            return JsonResponse({
+                "job_id": str(job.id),
+                "status": job.status,
+                "status_url": request.build_absolute_uri(f"/api/receipt-jobs/{job.id}/"),
+            }, status=status.HTTP_202_ACCEPTED)
+
+        try:
+            extracted_data = await aprocess_receipt_image(request.user, image_file=uploaded_file, image_url=image_url)
+        except ImageDownloadError as e:
+            return JsonResponse({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return JsonResponse(extracted_data, status=status.HTTP_201_CREATED)
+
+'''Viewset to poll the status of receipt processing jobs'''
+class ReceiptJobViewSet(viewsets.ReadOnlyModelViewSet):
+    serializer_class = ReceiptJobSerializer
+    permission_classes = [IsAuthenticated]
+    def get_queryset(self): #Return jobs for authenticated user
+        return ReceiptJob.objects.filter(user=self.request.user).select_related('receipt').order_by('-created_at')
 
+'''Viewset that processes several receipt images in one request'''
+class ProcessReceiptBatchView(APIView):
+    permission_classes = [IsAuthenticated]
 
-    compressed_image = compress_image(image_file) #Compress the image
-    
-    blob_service_client = BlobServiceClient( #Connect to Azure Blob Storage
-        f'https://{AZURE_STORAGE_ACCOUNT_NAME}.blob.core.windows.net',
-        credential=AZURE_STORAGE_ACCOUNT_KEY
+    def post(self, request):
+        uploaded_files = request.FILES.getlist('images')
+        image_urls = request.data.getlist('image_urls') if hasattr(request.data, 'getlist') else request.data.get('image_urls', [])
+
+        sources = [(uploaded_file.name, uploaded_file, None) for uploaded_file in uploaded_files]
+        sources += [(image_url, None, image_url) for image_url in image_urls if image_url]
+
+        if not sources:
+            return Response({"error": "No images or image_urls provided."}, status=status.HTTP_400_BAD_REQUEST)
+        if len(sources) > settings.RECEIPT_BATCH_MAX_IMAGES:
+            return Response({"error": f"A batch can contain at most {settings.RECEIPT_BATCH_MAX_IMAGES} images."}, status=status.HTTP_400_BAD_REQUEST)
+
+        results = process_receipt_batch(request.user, sources)
+        created = sum(1 for result in results if result["status"] == "created")
+        return Response({
+            "created": created,
+            "failed": len(results) - created,
+            "results": results,
+        }, status=status.HTTP_201_CREATED if created else status.HTTP_400_BAD_REQUEST)
+
+'''Hit and miss counters for the receipt analysis cache'''
+class ReceiptAnalysisCacheStatsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(analysis_cache.stats(), status=status.HTTP_200_OK)
+
+'''Check if the client asked for the scan to be processed as a background job'''
+def is_job_mode(request):
+    value = request.query_params.get('async', request.data.get('async', ''))
+    return str(value).lower() in ('1', 'true', 'yes')
+
+'''Download a receipt image from a url, returns its bytes'''
+def download_image(image_url):
+    return fetch_image(image_url) #Streamed through a pooled session and capped at RECEIPT_IMAGE_FETCH_MAX_BYTES
+
+'''Upload, analyse and store a receipt image for a user, returns the serialized receipt'''
+def process_receipt_image(user, image_file=None, image_url=None, filename=None):
+    receiptUrl, image_hash, thumbnails = upload_receipt_image(image_file=image_file, image_url=image_url, filename=filename)
+    return analyse_receipt(receiptUrl, user, image_hash=image_hash, thumbnails=thumbnails)
+
+'''Compress the image and get it and its thumbnails into blob storage, returns its url, the hash of the compressed bytes and the thumbnail urls'''
+def upload_receipt_image(image_file=None, image_url=None, filename=None):
+    if image_file is None: #Check if a image url is given instead
+        image_data, filename = download_image(image_url), filename or "receipt_from_url.jpg"
+    else:
+        image_data, filename = image_file.read(), filename or image_file.name
+    blob_name = generate_filename(filename) #Generate a name
+    compressed_image, thumbnail_images = compress_image(image_data) #Compress the image, this also normalises it so resubmitted photos hash the same
+    image_hash = hash_image(compressed_image)
+    receiptUrl = upload_image_to_azure(compressed_image, blob_name) #Turn the file into a url and store it in blob storage
+    thumbnails = upload_thumbnails(thumbnail_images, blob_name)
+    return receiptUrl, image_hash, thumbnails
+
+'''Upload and analyse a receipt image without touching the database, safe to run on worker threads'''
+def scan_receipt_image(image_file=None, image_url=None):
+    receiptUrl, image_hash, thumbnails = upload_receipt_image(image_file=image_file, image_url=image_url)
+    return receiptUrl, extract_receipt_data(receiptUrl, image_hash=image_hash), thumbnails
+
+'''Scan several receipt images concurrently and store them, returns one result per image'''
+def process_receipt_batch(user, sources):
+    max_workers = min(settings.RECEIPT_BATCH_MAX_WORKERS, len(sources))
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="receipt-batch") as executor: #Uploads and analyses are network bound so they run in parallel
+        futures = [executor.submit(scan_receipt_image, image_file=image_file, image_url=image_url) for _, image_file, image_url in sources]
+
+    results = []
+    for index, ((source, _, _), future) in enumerate(zip(sources, futures)): #Database writes stay on the request thread
+        try:
+            receiptUrl, extracted_data, thumbnails = future.result()
+            receipt = save_receipt_data(user, receiptUrl, extracted_data, thumbnails=thumbnails)
+        except ImageDownloadError as e:
+            results.append({"index": index, "source": source, "status": "error", "error": str(e)})
+            continue
+        except Exception as e:
+            logger.exception("Failed to process receipt image %s", source)
+            results.append({"index": index, "source": source, "status": "error", "error": str(e)})
+            continue
+
+        results.append({"index": index, "source": source, "status": "created", "receipt": ReceiptSerializer(receipt).data})
+    return results
+
+'''Download a receipt image from a url without blocking the event loop, returns its bytes'''
+async def adownload_image(image_url):
+    return await afetch_image(image_url)
+
+'''Async process_receipt_image, only the database writes at the end take a thread'''
+async def aprocess_receipt_image(user, image_file=None, image_url=None, filename=None):
+    receiptUrl, image_hash, thumbnails = await aupload_receipt_image(image_file=image_file, image_url=image_url, filename=filename)
+    extracted_data = await aextract_receipt_data(receiptUrl, image_hash=image_hash)
+    return await sync_to_async(store_receipt)(user, receiptUrl, extracted_data, thumbnails=thumbnails)
+
+'''Async scan_receipt_image'''
+async def ascan_receipt_image(image_file=None, image_url=None):
+    receiptUrl, image_hash, thumbnails = await aupload_receipt_image(image_file=image_file, image_url=image_url)
+    return receiptUrl, await aextract_receipt_data(receiptUrl, image_hash=image_hash), thumbnails
+
+'''Async upload_receipt_image'''
+async def aupload_receipt_image(image_file=None, image_url=None, filename=None):
+    if image_file is None:
+        image_data, filename = await adownload_image(image_url), filename or "receipt_from_url.jpg"
+    else:
+        image_data, filename = await sync_to_async(image_file.read, thread_sensitive=False)(), filename or image_file.name #Large uploads are spooled to disk
+    blob_name = generate_filename(filename)
+    compressed_image, thumbnail_images = await acompress_image(image_data)
+    image_hash = hash_image(compressed_image)
+    storage = get_receipt_storage()
+    receiptUrl, *thumbnail_urls = await asyncio.gather( #The original and its thumbnails are uploaded side by side
+        storage.asave(compressed_image, blob_name),
+        *(storage.asave(BytesIO(data), thumbnail_name(blob_name, size)) for size, data in thumbnail_images.items()),
     )
+    return receiptUrl, image_hash, {str(size): url for size, url in zip(thumbnail_images, thumbnail_urls)}
+
+'''Async extract_receipt_data'''
+async def aextract_receipt_data(receiptUrl, image_hash=None):
+    if image_hash:
+        cached_data = await sync_to_async(analysis_cache.get, thread_sensitive=False)(image_hash)
+        if cached_data is not None:
+            return cached_data
+
+    receipts = await get_receipt_analyzer().aanalyze(receiptUrl, image_hash=image_hash)
+    extracted_data = parse_receipt_result(receipts)
+
+    if image_hash:
+        await sync_to_async(analysis_cache.set, thread_sensitive=False)(image_hash, extracted_data)
+    return extracted_data
+
+'''Async compress_image, the work runs on the compression process pool or a worker thread'''
+async def acompress_image(image_data):
+    compressed_data, thumbnail_images = await imaging.acompress_renditions(
+        image_data,
+        max_dimension=settings.RECEIPT_IMAGE_MAX_DIMENSION,
+        target_bytes=settings.RECEIPT_IMAGE_TARGET_BYTES,
+        thumbnail_sizes=settings.RECEIPT_THUMBNAIL_SIZES,
+        processes=settings.RECEIPT_IMAGE_PROCESSES,
+    )
+    return BytesIO(compressed_data), thumbnail_images
 
-    blob_client = blob_service_client.get_blob_client(container=AZURE_CONTAINER_NAME, blob=blob_name)
-    blob_client.upload_blob(compressed_image, overwrite=True)
-    blob_client.set_http_headers(content_settings=ContentSettings(content_type="image/png")) #Make sure it returns a Url
-    # Upload Image
-
-    
-    sas_token = generate_blob_sas( # Generate SAS URL with expiration time which is 1 year in this case
-        account_name=AZURE_STORAGE_ACCOUNT_NAME,
-        container_name=AZURE_CONTAINER_NAME,
-        blob_name=blob_name,
-        account_key=AZURE_STORAGE_ACCOUNT_KEY,
-        permission=BlobSasPermissions(read=True),
-        expiry=datetime.utcnow() + timedelta(days=365 * 100)  # URL expires in 1 year
+'''Create unique name for image'''
+def generate_filename(filename):
+    timestamp = int(time.time()) #Get current timestamp
+    extension = filename.split('.')[-1] #Extract file extension
+    return f"{timestamp}_{uuid.uuid4().hex[:8]}.{extension}" #Return unique filename, the suffix stops concurrent uploads overwriting each other
+
+'''Blob name of a thumbnail, stored next to the original'''
+def thumbnail_name(blob_name, size):
+    return f"{os.path.splitext(blob_name)[0]}_{size}.jpg"
+
+'''Uploads thumbnails next to the original image, returns their urls by size'''
+def upload_thumbnails(thumbnail_images, blob_name):
+    return {str(size): upload_image_to_azure(BytesIO(data), thumbnail_name(blob_name, size)) for size, data in thumbnail_images.items()}
+
+'''Uploads a compressed image to the receipt storage and returns a URL'''
+def upload_image_to_azure(compressed_image, blob_name):
+    return get_receipt_storage().save(compressed_image, blob_name) #Azure Blob Storage by default, see settings.RECEIPT_STORAGE
+
+'''Compress the image to reduce file size before uploading, returns it with its thumbnail bytes by size'''
+def compress_image(image_data):
+    compressed_data, thumbnail_images = imaging.compress_renditions( #Downscaled for OCR and re-encoded as a JPEG close to the target size, thumbnails come from the same decode
+        image_data,
+        max_dimension=settings.RECEIPT_IMAGE_MAX_DIMENSION,
+        target_bytes=settings.RECEIPT_IMAGE_TARGET_BYTES,
+        thumbnail_sizes=settings.RECEIPT_THUMBNAIL_SIZES,
+        processes=settings.RECEIPT_IMAGE_PROCESSES,
     )
+    return BytesIO(compressed_data), thumbnail_images
 
-    sas_url = f"{blob_client.url}?{sas_token}"
+'''Analyse and extract data from the receipt'''
+def analyse_receipt(receiptUrl, user, image_hash=None, thumbnails=None):
+    extracted_data = extract_receipt_data(receiptUrl, image_hash=image_hash)
+    return store_receipt(user, receiptUrl, extracted_data, thumbnails=thumbnails)
 
-    return sas_url
+'''Save extracted data as a receipt and return it serialized'''
+def store_receipt(user, receiptUrl, extracted_data, thumbnails=None):
+    receipt = save_receipt_data(user, receiptUrl, extracted_data, thumbnails=thumbnails)
+    serializer = ReceiptSerializer(receipt)
+    return serializer.data
 
-'''Compress the image to reduce file size before uploading'''
-def compress_image(image_file):
-    
-    img = Image.open(image_file)
+'''Run the prebuilt receipt model on an uploaded image, does not touch the database'''
+def extract_receipt_data(receiptUrl, image_hash=None):
+    if image_hash: #The same photo has been analysed before, skip the Azure call
+        cached_data = analysis_cache.get(image_hash)
+        if cached_data is not None:
+            return cached_data
 
-    img = img.convert("RGB") #Convert to JPEG (reduces file size)
+    receipts: AnalyzeResult = get_receipt_analyzer().analyze(receiptUrl, image_hash=image_hash) #Document Intelligence by default, see settings.RECEIPT_ANALYZER
+    extracted_data = parse_receipt_result(receipts)
 
-    img_io = BytesIO()
-    img.save(img_io, format="JPEG", quality=90) #Adjust quality
-    img_io.seek(0)
+    if image_hash:
+        analysis_cache.set(image_hash, extracted_data)
+    return extracted_data
 
-    return img_io
+CATEGORY_LOOKUP = {c.value.lower(): c.value for c in CategoryChoices} #Receipt types from the model, lower cased, to our categories
+
+'''Turn the result of the receipt model into plain receipt fields'''
+def parse_receipt_result(receipts):
+    merchant_name = total = transaction_date_field = receipt_category = None
+    receipt_items = []
+    expense_amounts = []
 
-'''Analyse and extract data from the receipt'''
-def analyse_receipt(receiptUrl, request):
-    endpoint = str(os.getenv("DOCUMENTINTELLIGENCE_ENDPOINT"))
-    key = str(os.getenv("DOCUMENTINTELLIGENCE_API_KEY"))
-
-    document_intelligence_client = DocumentIntelligenceClient(endpoint=endpoint, credential=AzureKeyCredential(key)) #Initialise azure document intelligence client
-    if receiptUrl:
-        poller = document_intelligence_client.begin_analyze_document(
-            "prebuilt-receipt", #se the prebuilt model 'receipt' for scanning and processing
-            AnalyzeDocumentRequest(url_source=receiptUrl)
-        )
-    receipts: AnalyzeResult = poller.result()
-    
     if receipts.documents:
         for idx, receipt in enumerate(receipts.documents):
             if receipt.fields:
@@ -275,166 +510,184 @@ def analyse_receipt(receiptUrl, request):
                             item_details["total_price"] = {
                             "value": str(item_total_price.get("valueCurrency").get("amount")),
                             }
-                            #Categorise the items
-                            category = receipt_category.get('valueString')
-                            category_choices = {c.value.lower(): c.value for c in CategoryChoices}
-                            assigned_category = category_choices.get(category.lower(), CategoryChoices.OTHER)
-                            
-                        Expense.objects.create(
-                            user=request.user,
-                            amount=item_total_price.get("valueCurrency").get("amount"),
-                            category=assigned_category,
-                            date=transaction_date_field.get("valueDate") if transaction_date_field else None,
-                            vendor=merchant_name.get('valueString') if merchant_name else "Unknown Merchant",
-                        )
+                            expense_amounts.append(item_total_price.get("valueCurrency").get("amount")) #Each priced line becomes an expense
                         receipt_items.append(item_details)
-    #Categorise the receipts
-    category = receipt_category.get('valueString').split(".")[0]
-    category_choices = {c.value.lower(): c.value for c in CategoryChoices}
-    assigned_category = category_choices.get(category.lower(), CategoryChoices.OTHER)
-    
-    receipt = Receipt.objects.create(
-                                    user=request.user,
-                                    image_url=receiptUrl if receiptUrl else None,
-                                    merchant=merchant_name.get('valueString') if merchant_name else "Unknown Merchant",
-                                    total_amount = float(total.get("valueCurrency", {}).get("amount")) if total else 0.00,
-                                    parsed_items=receipt_items,
-                                    transaction_date=transaction_date_field.get("valueDate") if transaction_date_field else None,
-                                    receipt_category=assigned_category,
-                                    )
-    receipt.assign_to_budget()
-    serializer = ReceiptSerializer(receipt)
-    return serializer.data
+
+    #Categorise the receipt and its items
+    category = (receipt_category.get('valueString') if receipt_category else None) or ""
+
+    return {
+        "merchant": merchant_name.get('valueString') if merchant_name else "Unknown Merchant",
+        "total_amount": float(total.get("valueCurrency", {}).get("amount")) if total else 0.00,
+        "transaction_date": transaction_date_field.get("valueDate") if transaction_date_field else None,
+        "receipt_category": CATEGORY_LOOKUP.get(category.split(".")[0].lower(), CategoryChoices.OTHER),
+        "expense_category": CATEGORY_LOOKUP.get(category.lower(), CategoryChoices.OTHER),
+        "parsed_items": receipt_items,
+        "expense_amounts": expense_amounts,
+    }
+
+'''Create the receipt, its expenses and its budget links from extracted data in one transaction, nothing is kept if any step fails'''
+def save_receipt_data(user, receiptUrl, extracted_data, thumbnails=None):
+    with transaction.atomic():
+        expenses = Expense.objects.bulk_create([ #One INSERT for every line item rather than one each
+            Expense(
+                user=user,
+                amount=amount,
+                category=extracted_data["expense_category"],
+                date=extracted_data["transaction_date"],
+                vendor=extracted_data["merchant"],
+            )
+            for amount in extracted_data["expense_amounts"]
+        ])
+        MonthlySpending.objects.apply(user.pk, RollupChanges.for_expenses(expenses))
+
+        receipt = Receipt.objects.create(
+                                        user=user,
+                                        image_url=receiptUrl if receiptUrl else None,
+                                        merchant=extracted_data["merchant"],
+                                        total_amount=extracted_data["total_amount"],
+                                        parsed_items=extracted_data["parsed_items"],
+                                        transaction_date=extracted_data["transaction_date"],
+                                        receipt_category=extracted_data["receipt_category"],
+                                        thumbnails=thumbnails or {},
+                                        )
+        receipt.assign_to_budget()
+    return receipt
  
+'''Spending and item counts of a budget's receipts per category, grouped in the database so only one row per category is loaded'''
+def budget_spending_summary(budget):
+    rows = list(Receipt.objects.filter(budget=budget).spending_by_category())
+    return {
+        "total_spent": sum((row["total"] for row in rows), Decimal("0")),
+        "category_spending": {row["receipt_category"]: row["total"] for row in rows},
+        "total_items": sum(row["items"] for row in rows),
+        "category_items": {row["receipt_category"]: row["items"] for row in rows},
+    }
+
 '''Viewset to produce a report of a budget'''   
+@method_decorator(conditional_on_user_data, name='get')
 class BudgetReportView(APIView):  
     permission_classes = [IsAuthenticated]
 
     def get(self, request, budget_id):
         budget = get_object_or_404(Budget, id=budget_id, user=request.user)
-        receipts = Receipt.objects.filter(budget=budget)
-        
-        #Calculate spending summary
-        total_spent = sum(receipt.total_amount or 0 for receipt in receipts)
-        category_spending = {}
-        total_items = 0
-        category_items = {}
-        
-        for receipt in receipts:
-            category = receipt.receipt_category
-            category_spending[category] = category_spending.get(category, 0) + (receipt.total_amount or 0)
-            
-            item_count = len(receipt.parsed_items) if receipt.parsed_items else 1
-            total_items += item_count
-            category_items[category] = category_items.get(category, 0) + item_count
-        
-        response_data = {
-            "budget": BudgetSerializer(budget).data,
-            "total_spent": total_spent,
-            "category_spending": category_spending,
-            "total_items": total_items,
-            "category_items": category_items,
-        }
+        response_data = budget_report_cache.get(budget, "summary") #Repeat views of an unchanged budget skip the aggregation
+        if response_data is None:
+            response_data = {
+                "budget": BudgetSerializer(budget, context={'expand': []}).data, #Receipts are summarised below, serialising them would load every one
+                **budget_spending_summary(budget),
+            }
+            budget_report_cache.set(budget, "summary", response_data)
         return Response(response_data, status=status.HTTP_200_OK)
 
-'''Viewset to export a report as a excel file'''
-class BudgetReportXlsxView(APIView):
+'''Streams everything a user owns, one dataset as csv or ndjson, or every dataset in account.zip with ?type=csv or ?type=ndjson'''
+class AccountExportView(APIView):
     permission_classes = [IsAuthenticated]
 
-    def get(self, request, budget_id, *args, **kwargs):
+    def get(self, request, dataset, file_type):
+        if dataset == "account" and file_type == "zip":
+            inner_type = request.query_params.get("type", "csv")
+            if inner_type not in EXPORT_FORMATS:
+                return Response({"error": f"type must be one of {', '.join(EXPORT_FORMATS)}."}, status=status.HTTP_400_BAD_REQUEST)
+            response = StreamingHttpResponse(zip_export_chunks(request.user, inner_type), content_type="application/zip")
+        elif dataset in EXPORT_DATASETS and file_type in EXPORT_FORMATS:
+            response = StreamingHttpResponse(export_chunks(request.user, dataset, file_type), content_type=EXPORT_FORMATS[file_type][1])
+        else:
+            return Response({"error": "Unknown export."}, status=status.HTTP_404_NOT_FOUND)
 
-        budget = get_object_or_404(Budget, id=budget_id, user=request.user)
-        receipts = Receipt.objects.filter(budget=budget)
+        response["Content-Disposition"] = f'attachment; filename="{dataset}.{file_type}"'
+        return response
+
+'''Ranked full-text search over the merchants and line items of the user's receipts, ?q=tesco batteries matches receipts with every word'''
+@method_decorator(conditional_on_user_data, name='get')
+class ReceiptSearchView(APIView):
+    permission_classes = [IsAuthenticated]
+    pagination_class = RankedPagination
+
+    def get(self, request):
+        terms = search_terms(request.query_params.get('q', ''))
+        if not terms:
+            return Response({"error": "q must contain a word to search for."}, status=status.HTTP_400_BAD_REQUEST)
+
+        paginator = self.pagination_class()
+        index = search_index()
+        hits = paginator.paginate_queryset(lambda after, limit: index.hits(request.user.pk, terms, after=after, limit=limit), request, view=self)
+        receipts = Receipt.objects.in_bulk([receipt_id for receipt_id, _ in hits])
+        results = ReceiptSerializer([receipts[receipt_id] for receipt_id, _ in hits if receipt_id in receipts], many=True).data
+        return paginator.get_paginated_response(results)
+
+'''Spending over time from the monthly rollups, per month and category and in total per month.
+?start=YYYY-MM and ?end=YYYY-MM limit the months, ?category= can be given more than once'''
+@method_decorator(conditional_on_user_data, name='get')
+class SpendingTimeseriesView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        rollups = MonthlySpending.objects.filter(user=request.user).exclude(receipt_count=0, expense_count=0) #Cells emptied by deletes are kept for reuse
+        try:
+            for param, lookup in (("start", "month__gte"), ("end", "month__lte")):
+                if request.query_params.get(param):
+                    rollups = rollups.filter(**{lookup: datetime.strptime(request.query_params[param], "%Y-%m").date()})
+        except ValueError:
+            return Response({"error": "start and end must be given as YYYY-MM."}, status=status.HTTP_400_BAD_REQUEST)
+
+        categories = request.query_params.getlist("category")
+        if set(categories) - set(CategoryChoices.values):
+            return Response({"error": "Unknown category."}, status=status.HTTP_400_BAD_REQUEST)
+        if categories:
+            rollups = rollups.filter(category__in=categories)
+
+        series = list(rollups.order_by("month", "category"))
+        totals = {}
+        for rollup in series: #At most one row per month and category, summing here is cheaper than a second query
+            total = totals.setdefault(rollup.month, MonthlySpending(month=rollup.month))
+            for field in ROLLUP_FIELDS:
+                setattr(total, field, getattr(total, field) + getattr(rollup, field))
+        return Response({
+            "series": MonthlySpendingSerializer(series, many=True).data,
+            "totals": MonthlySpendingTotalSerializer(totals.values(), many=True).data,
+        }, status=status.HTTP_200_OK)
+
+'''Imports expenses from a CSV file or a JSON list, sent as the request body or as a multipart upload named file'''
+class ExpenseImportView(APIView):
+    permission_classes = [IsAuthenticated]
+    parser_classes = [MultiPartParser, StreamParser] #The body is read as it is imported, never parsed into memory first
 
-        category_spending = {}
-        total_items = 0
-        category_items = {}
+    def post(self, request):
+        upload = request.FILES.get('file') if request.content_type.startswith('multipart/') else None
+        if upload is not None:
+            file_type, stream = upload.name.rsplit('.', 1)[-1].lower(), upload #Large uploads are spooled to disk by Django
+        else:
+            file_type, stream = IMPORT_CONTENT_TYPES.get(request.content_type.split(';')[0].strip()), request.data
+        if file_type not in IMPORT_FORMATS or not hasattr(stream, 'read'):
+            return Response({"error": "Send a CSV or JSON file, as text/csv or application/json or as a .csv or .json upload named file."}, status=status.HTTP_400_BAD_REQUEST)
 
-        for receipt in receipts:
-            category = receipt.receipt_category
-            category_spending[category] = category_spending.get(category, 0) + (receipt.total_amount or 0)
+        try:
+            result = import_expenses(request.user, IMPORT_FORMATS[file_type](stream))
+        except ImportFormatError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result, status=status.HTTP_201_CREATED if result["created"] else status.HTTP_400_BAD_REQUEST)
 
-            item_count = len(receipt.parsed_items) if receipt.parsed_items else 1
-            total_items += item_count
-            category_items[category] = category_items.get(category, 0) + item_count
+'''Viewset to export a report as a excel file'''
+@method_decorator(conditional_on_user_data, name='get')
+class BudgetReportXlsxView(APIView):
+    permission_classes = [IsAuthenticated]
 
-        wb = openpyxl.Workbook() #Create a excel workbook
-        bold_font = Font(bold=True)
-        
-        summary_ws = wb.active #Create budget summart sheet
-        summary_ws.title = "Budget Summary"
-
-        summary_headers = ["Budget Name", "User", "Limit Amount", "Total Spent", "Start Date", "End Date"]
-        summary_values = [
-            budget.name, budget.user.email, f"{budget.limit_amount:.2f}",
-            f"{budget.current_spending:.2f}", budget.start_date.strftime('%d-%m-%Y'), budget.end_date.strftime('%d-%m-%Y')
-        ]
-
-        for col_num, (header, value) in enumerate(zip(summary_headers, summary_values), start=1):
-            summary_ws.cell(row=1, column=col_num, value=header).font = bold_font
-            summary_ws.cell(row=2, column=col_num, value=value)
-        
-        breakdown_ws = wb.create_sheet(title="Spending Breakdown") #Create spending breakdown sheet
-        breakdown_ws.append(["Category", "Total Spent", "Item Count"])
-
-        for cell in breakdown_ws[1]:
-            cell.font = bold_font
-            
-        for category, amount in category_spending.items():
-            breakdown_ws.append([category, f"{amount:.2f}", category_items.get(category, 0)])
-
-        receipts_ws = wb.create_sheet(title="Receipts") #Create receipts sheet
-        receipts_headers = ["ID", "Merchant", "Total Amount", "Transaction Date", "Category", "Item Name", "Item Price"]
-        receipts_ws.append(receipts_headers)
-        for col_num, header in enumerate(receipts_headers, start=1):
-            cell = receipts_ws.cell(row=1, column=col_num, value=header)
-            cell.font = bold_font  # Apply bold font
-
-        receipts = receipts.order_by("transaction_date", "uploaded_at")
-        for receipt in receipts:
-            transaction_date = receipt.transaction_date.strftime('%d/%m/%Y') if receipt.transaction_date else receipt.uploaded_at.strftime('%d/%m/%Y')
-            receipt_row = [
-                receipt.id,
-                receipt.merchant,
-                f"{round(receipt.total_amount, 2):.2f}",
-                transaction_date,
-                receipt.receipt_category
-            ]
-
-            if isinstance(receipt.parsed_items, list) and receipt.parsed_items:
-                first_item = receipt.parsed_items[0]
-                item_name = first_item.get("description", {}).get("value", "Unknown Item")
-                item_price = float(first_item.get("total_price", {}).get("value", "0.00"))
-                receipt_row.append(item_name)
-                receipt_row.append(f"{item_price:.2f}")
-            else:
-                receipt_row.append("No Items")
-                receipt_row.append("-")
-
-            receipts_ws.append(receipt_row)
-            
-            if isinstance(receipt.parsed_items, list) and len(receipt.parsed_items) > 1: #If there are more than one items
-                for item in receipt.parsed_items[1:]:
-                    item_name = item.get("description", {}).get("value", "Unknown Item")
-                    item_price = float(item.get("total_price", {}).get("value", "0.00"))
-                    receipts_ws.append(["", "", "", "", "", item_name, f"{item_price:.2f}"])
-
-        ws = [summary_ws,breakdown_ws,receipts_ws]
-        for sheet in ws: #Make the columns of the sheets look nice
-            for col_num, col_cells in enumerate(sheet.columns, 1):
-                max_length = 0
-                col_letter = get_column_letter(col_num)
-                for cell in col_cells:
-                    try:
-                        if cell.value:
-                            max_length = max(max_length, len(str(cell.value)))
-                    except:
-                        pass
-                adjusted_width = (max_length + 2)
-                sheet.column_dimensions[col_letter].width = adjusted_width
-            
-        response = HttpResponse(content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-        response["Content-Disposition"] = f'attachment; filename=budget_{budget_id}_report.xlsx'
-        wb.save(response)
-
-        return response
\ No newline at end of file
+    def get(self, request, budget_id, *args, **kwargs):
+
+        budget = get_object_or_404(Budget.objects.select_related('user'), id=budget_id, user=request.user)
+        filename = f"budget_{budget_id}_report.xlsx"
+        cached = budget_report_cache.get(budget, "xlsx")
+        if cached is not None:
+            return FileResponse(BytesIO(cached), as_attachment=True, filename=filename, content_type=XLSX_CONTENT_TYPE)
+
+        summary = budget_spending_summary(budget)
+        receipts = Receipt.objects.filter(budget=budget).order_by("transaction_date", "uploaded_at").only(*RECEIPT_FIELDS)
+        output = tempfile.TemporaryFile() #Written in write-only mode and streamed from disk, the workbook is never held in memory
+        write_budget_report_xlsx(output, budget, summary, receipts.iterator(chunk_size=1000))
+        if output.tell() <= budget_report_cache.max_entry_bytes:
+            output.seek(0)
+            budget_report_cache.set(budget, "xlsx", output.read())
+        output.seek(0)
+
+        return FileResponse(output, as_attachment=True, filename=filename, content_type=XLSX_CONTENT_TYPE)
\ No newline at end of file
@@ -13,4 +13,8 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'finance_app.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from api.backends import close_loop_clients_on_shutdown #Needs the apps loaded by get_asgi_application
+
+application = close_loop_clients_on_shutdown(django_application)
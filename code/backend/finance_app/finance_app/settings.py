@@ -108,6 +108,39 @@ DATABASES = {
 }
 
 
+# Caches
+# receipt-analysis holds Document Intelligence results keyed by image hash, entries expire
+# after TIMEOUT seconds and the oldest are culled once MAX_ENTRIES is reached
+# basic-auth remembers verified Basic credentials for BASIC_AUTH_CACHE_TTL seconds, keyed by a salted digest
+# budget-reports holds rendered budget reports keyed by budget and report version, a change to a
+# budget's receipts bumps the version so stale entries are simply never read again
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'receipt-analysis': {
+        'BACKEND': os.getenv('RECEIPT_ANALYSIS_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('RECEIPT_ANALYSIS_CACHE_LOCATION', 'receipt-analysis'),
+        'TIMEOUT': int(os.getenv('RECEIPT_ANALYSIS_CACHE_TTL', 60 * 60 * 24 * 30)),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('RECEIPT_ANALYSIS_CACHE_MAX_ENTRIES', 10000)),
+        },
+    },
+    'basic-auth': {
+        'BACKEND': os.getenv('BASIC_AUTH_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('BASIC_AUTH_CACHE_LOCATION', 'basic-auth'),
+    },
+    'budget-reports': {
+        'BACKEND': os.getenv('BUDGET_REPORT_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('BUDGET_REPORT_CACHE_LOCATION', 'budget-reports'),
+        'TIMEOUT': int(os.getenv('BUDGET_REPORT_CACHE_TTL', 60 * 60 * 24)),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('BUDGET_REPORT_CACHE_MAX_ENTRIES', 1000)),
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -144,6 +177,8 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 STATIC_ROOT = BASE_DIR / 'staticfiles'
+MEDIA_URL = 'media/'
+MEDIA_ROOT = BASE_DIR / 'media'
 WSGI_APPLICATION = 'finance_app.wsgi.application'
 
 
@@ -170,10 +205,68 @@ REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (   
         'rest_framework_simplejwt.authentication.JWTAuthentication',
         'rest_framework.authentication.SessionAuthentication',  # Enable session-based login
-        'rest_framework.authentication.BasicAuthentication', 
+        'api.authentication.CachedBasicAuthentication', #Older app versions send Basic credentials on every request
     ),
 }
 
+# Receipt processing jobs
+# BACKEND is one of api.jobs.ThreadPoolJobBackend (in-process), api.jobs.DatabaseJobBackend
+# (run `python manage.py process_receipt_jobs` as the worker) or api.jobs.ImmediateJobBackend
+RECEIPT_JOBS = {
+    'BACKEND': os.getenv('RECEIPT_JOB_BACKEND', 'api.jobs.ThreadPoolJobBackend'),
+    'OPTIONS': {
+        'max_workers': int(os.getenv('RECEIPT_JOB_WORKERS', 4)),
+    },
+}
+# A failed job is queued again until it has been tried RECEIPT_JOB_MAX_ATTEMPTS times. A job still running
+# RECEIPT_JOB_CLAIM_TIMEOUT seconds after it was claimed is taken to have lost its worker, the
+# process_receipt_jobs worker claims it again, or fails it once it is out of attempts
+RECEIPT_JOB_MAX_ATTEMPTS = int(os.getenv('RECEIPT_JOB_MAX_ATTEMPTS', 3))
+RECEIPT_JOB_CLAIM_TIMEOUT = int(os.getenv('RECEIPT_JOB_CLAIM_TIMEOUT', 600))
+
+# Receipt storage and analysis
+# RECEIPT_STORAGE is api.backends.AzureBlobReceiptStorage or api.backends.FileSystemReceiptStorage,
+# RECEIPT_ANALYZER is api.backends.AzureReceiptAnalyzer, api.backends.ReplayReceiptAnalyzer (recorded
+# results from api/analysis_fixtures) or api.backends.RecordingReceiptAnalyzer. Clients are created
+# once per process and shared between threads.
+RECEIPT_STORAGE = {
+    'BACKEND': os.getenv('RECEIPT_STORAGE_BACKEND', 'api.backends.AzureBlobReceiptStorage'),
+    'OPTIONS': {},
+}
+RECEIPT_ANALYZER = {
+    'BACKEND': os.getenv('RECEIPT_ANALYZER_BACKEND', 'api.backends.AzureReceiptAnalyzer'),
+    'OPTIONS': {},
+}
+
+# Receipt image compression, images are downscaled to RECEIPT_IMAGE_MAX_DIMENSION on the longest
+# edge and re-encoded to get close to RECEIPT_IMAGE_TARGET_BYTES. RECEIPT_IMAGE_PROCESSES is the size
+# of the compression process pool, 0 compresses on the request thread.
+RECEIPT_IMAGE_MAX_DIMENSION = int(os.getenv('RECEIPT_IMAGE_MAX_DIMENSION', 2000))
+RECEIPT_IMAGE_TARGET_BYTES = int(os.getenv('RECEIPT_IMAGE_TARGET_BYTES', 400 * 1024))
+RECEIPT_IMAGE_PROCESSES = int(os.getenv('RECEIPT_IMAGE_PROCESSES', 2))
+
+# Longest edge of the thumbnails stored next to every receipt image, made in the same pass as the
+# compression. Receipts from before thumbnails get them from manage.py backfill_receipt_thumbnails.
+RECEIPT_THUMBNAIL_SIZES = [int(size) for size in os.getenv('RECEIPT_THUMBNAIL_SIZES', '128,512').split(',') if size.strip()]
+
+# Receipt images submitted as image_url are streamed through a pooled session and refused once
+# they pass RECEIPT_IMAGE_FETCH_MAX_BYTES, or straight away when the headers show they will.
+# RECEIPT_IMAGE_FETCH_TIMEOUT is in seconds for the whole download, not only for each read.
+RECEIPT_IMAGE_FETCH_MAX_BYTES = int(os.getenv('RECEIPT_IMAGE_FETCH_MAX_BYTES', 20 * 1024 * 1024))
+RECEIPT_IMAGE_FETCH_TIMEOUT = int(os.getenv('RECEIPT_IMAGE_FETCH_TIMEOUT', 10))
+RECEIPT_IMAGE_FETCH_POOL_SIZE = int(os.getenv('RECEIPT_IMAGE_FETCH_POOL_SIZE', 20))
+
+# Serve api/process-receipt/ with the async view, for ASGI deployments (finance_app.asgi). It is
+# always available at api/process-receipt/async/. Needs aiohttp for the Azure aio clients.
+RECEIPT_PROCESSING_ASYNC = os.getenv('RECEIPT_PROCESSING_ASYNC', 'false').lower() in ('1', 'true', 'yes')
+
+# Batch receipt uploads
+RECEIPT_BATCH_MAX_IMAGES = int(os.getenv('RECEIPT_BATCH_MAX_IMAGES', 20))
+RECEIPT_BATCH_MAX_WORKERS = int(os.getenv('RECEIPT_BATCH_MAX_WORKERS', 4))
+
+# Seconds a verified Basic credential is trusted without hashing the password again
+BASIC_AUTH_CACHE_TTL = int(os.getenv('BASIC_AUTH_CACHE_TTL', 300))
+
 '''
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=60),